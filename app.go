@@ -907,6 +907,9 @@ func (a *App) copyAILLMTemplate(projectPath string) []Script {
 		}
 	}
 
+	// 共享模块（推理核心、模型快照）：各服务脚本通过 Mount 引用，只复制，不作为可运行脚本
+	a.copySharedModules(sourceDir, projectPath, "llm_engine.py", "model_snapshot.py")
+
 	a.LogInfo(fmt.Sprintf("[TemplateCopy] AI LLM 模板复制完成: %d个文件", len(scripts)))
 	return scripts
 }
@@ -950,6 +953,9 @@ func (a *App) copyWhisperSTTTemplate(projectPath string) []Script {
 		}
 	}
 
+	// 共享模块（推理后端、长音频切块流水线）通过 Mount 引用；后端基准测试在本地直接运行。只复制，不作为可运行脚本
+	a.copySharedModules(sourceDir, projectPath, "audio_pipeline.py", "benchmark_backends.py")
+
 	a.LogInfo(fmt.Sprintf("[TemplateCopy] Whisper 模板复制完成: %d个文件", len(scripts)))
 	return scripts
 }
@@ -993,6 +999,9 @@ func (a *App) copyEmbeddingServiceTemplate(projectPath string) []Script {
 		}
 	}
 
+	// 共享模块（两级嵌入缓存）通过 Mount 引用，只复制，不作为可运行脚本
+	a.copySharedModules(sourceDir, projectPath, "embedding_cache.py")
+
 	a.LogInfo(fmt.Sprintf("[TemplateCopy] Embedding 模板复制完成: %d个文件", len(scripts)))
 	return scripts
 }
@@ -1003,6 +1012,25 @@ func (a *App) copyLoRATrainingTemplate(projectPath string) []Script {
 	return a.copySingleScript(sourceDir, projectPath, "lora_training.py", "LoRA 训练服务", "LoRA 模型训练和推理")
 }
 
+// copySharedModules 辅助函数：复制模板的共享模块（由服务脚本通过 Mount 引用），不加入可运行脚本列表
+func (a *App) copySharedModules(sourceDir, projectPath string, fileNames ...string) {
+	for _, fileName := range fileNames {
+		sourcePath := filepath.Join(sourceDir, fileName)
+		destPath := filepath.Join(projectPath, fileName)
+
+		data, err := os.ReadFile(sourcePath)
+		if err != nil {
+			a.LogError(fmt.Sprintf("[TemplateCopy] 读取源文件失败: %s, error=%v", sourcePath, err))
+			continue
+		}
+		if writeErr := os.WriteFile(destPath, data, 0644); writeErr != nil {
+			a.LogError(fmt.Sprintf("[TemplateCopy] 写入失败: %s, error=%v", destPath, writeErr))
+			continue
+		}
+		a.LogInfo(fmt.Sprintf("[TemplateCopy] 复制成功: %s (%d字节)", fileName, len(data)))
+	}
+}
+
 // copySingleScript 辅助函数：复制单个脚本
 func (a *App) copySingleScript(sourceDir, projectPath, fileName, name, desc string) []Script {
 	scripts := []Script{}
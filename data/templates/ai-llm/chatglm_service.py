@@ -23,6 +23,9 @@ image = (
 
 model_volume = modal.Volume.from_name("chatglm-models", create_if_missing=True)
 
+# 投机解码的草稿模型（须与主模型共用 tokenizer），GLM-4 没有小尺寸版本，默认关闭
+DRAFT_MODEL = None
+
 
 @app.cls(
     image=image,
@@ -30,7 +33,9 @@ model_volume = modal.Volume.from_name("chatglm-models", create_if_missing=True)
     volumes={"/models": model_volume},
     timeout=600,
     container_idle_timeout=300,
+    mounts=[modal.Mount.from_local_python_packages("llm_engine")],
 )
+@modal.concurrent(max_inputs=64)  # 并发请求由连续批处理引擎合并解码；引擎不可用时回退路径串行执行
 class ChatGLM:
     @modal.enter()
     def load_model(self):
@@ -53,6 +58,11 @@ class ChatGLM:
         )
         self.model.eval()
         print("✓ ChatGLM 模型加载完成")
+
+        # 连续批处理引擎，模型不兼容时回退到 model.generate
+        from llm_engine import create_engine
+        self.engine = create_engine(self.model, self.tokenizer, draft_model_name=DRAFT_MODEL)
+
     
     @modal.method()
     def chat(self, messages: list[dict], max_tokens: int = 1024, temperature: float = 0.7) -> str:
@@ -60,18 +70,59 @@ class ChatGLM:
             messages, add_generation_prompt=True, tokenize=True, return_tensors="pt", return_dict=True
         ).to(self.model.device)
         
+        if self.engine is not None:
+            generated_ids = self.engine.generate(
+                inputs["input_ids"][0].tolist(), max_new_tokens=max_tokens, temperature=temperature
+            )
+            return self.tokenizer.decode(generated_ids, skip_special_tokens=True).strip()
+        
         import torch
+        from llm_engine import fallback_generate
         with torch.no_grad():
-            outputs = self.model.generate(**inputs, max_new_tokens=max_tokens, do_sample=True, temperature=temperature)
+            outputs = fallback_generate(self.model, **inputs, max_new_tokens=max_tokens, do_sample=True, temperature=temperature)
             outputs = outputs[:, inputs['input_ids'].shape[1]:]
         
         return self.tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
 
+    @modal.method()
+    def chat_stream(self, messages: list[dict], max_tokens: int = 1024, temperature: float = 0.7):
+        """流式对话：逐段产出 OpenAI 兼容的 SSE 事件（chat.completion.chunk）"""
+        from llm_engine import openai_sse, stream_chat
+        
+        inputs = self.tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True, tokenize=True, return_tensors="pt", return_dict=True
+        )
+        input_ids = inputs["input_ids"][0].tolist()
+        deltas = stream_chat(self.model, self.tokenizer, self.engine, input_ids, max_tokens, temperature)
+        yield from openai_sse(deltas, "glm-4-9b")
+
+    @modal.method()
+    def stats(self) -> dict:
+        """连续批处理引擎指标：tokens/s、排队等待、批大小、KV 缓存占用和投机接受率"""
+        if self.engine is None:
+            return {"engine": "disabled"}
+        return self.engine.stats()
+
 
 @app.function(image=image)
 @modal.web_endpoint(method="POST")
 def chat_api(data: dict):
+    """
+    OpenAI 兼容的对话接口，"stream": true 时以 SSE 逐段返回
+    """
     glm = ChatGLM()
+    if data.get("stream"):
+        from fastapi.responses import StreamingResponse
+        
+        return StreamingResponse(
+            glm.chat_stream.remote_gen(
+                messages=data.get("messages", []),
+                max_tokens=data.get("max_tokens", 1024),
+                temperature=data.get("temperature", 0.7),
+            ),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
     response = glm.chat.remote(messages=data.get("messages", []), max_tokens=data.get("max_tokens", 1024))
     return {"choices": [{"message": {"role": "assistant", "content": response}}], "model": "glm-4-9b"}
 
@@ -6,7 +6,15 @@ DeepSeek V3 翻译服务
 - 高质量机器翻译
 - 中英文互译
 - 多语言支持
+- 长文档按句子/段落分块批量翻译，重复片段命中翻译缓存
+- 批量片段翻译：先查翻译记忆，未命中的按长度分桶批量翻译，NDJSON 流式返回
 """
+import hashlib
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import modal
 
 app = modal.App("deepseek-v3-translation")
@@ -21,11 +29,30 @@ image = (
     )
 )
 
+model_volume = modal.Volume.from_name("deepseek-models", create_if_missing=True)
+
+# 翻译缓存（翻译记忆）：按 (源语言, 目标语言, 原文) 的哈希保存译文，跨容器共享
+translation_cache = modal.Dict.from_name("deepseek-translation-cache", create_if_missing=True)
+
+# 文档分块参数
+CHUNK_MAX_TOKENS = 512          # 每个分块的原文 token 上限
+MAX_BATCH_CHUNKS = 8            # 一次 generate 批量翻译的分块数
+MAX_NEW_TOKENS = 2048           # 单个分块译文的 token 上限
+SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？；…])|(?<=[.!?;])\s+")
+PARAGRAPH_BOUNDARY = re.compile(r"(\n\s*\n|\n)")
+CJK_LANGS = {"Chinese", "Japanese"}
+
+# 批量片段翻译参数
+BULK_MAX_BATCH_SEGMENTS = 32    # 一次 generate 最多翻译的片段数
+BULK_MAX_BATCH_TOKENS = 8192    # 一批补齐后的原文 token 总数上限（最长片段 × 片段数）
+MEMORY_LOOKUP_WORKERS = 32      # 并发查询翻译记忆的线程数
+
 
 @app.cls(
     image=image,
     gpu="H100",
-    timeout=600,
+    volumes={"/models": model_volume},
+    timeout=3600,  # 长文档和批量片段翻译在单次方法调用内完成，需与 Web 端点的超时一致
     container_idle_timeout=300,
 )
 class DeepSeekV3Translator:
@@ -35,8 +62,11 @@ class DeepSeekV3Translator:
         
         print("🤖 加载 DeepSeek V3 模型...")
         
+        # 权重缓存在 Volume 上，后续冷启动不再从 Hub 下载
+        start = time.monotonic()
         self.tokenizer = AutoTokenizer.from_pretrained(
             "deepseek-ai/DeepSeek-V3",
+            cache_dir="/models",
             trust_remote_code=True
         )
         
@@ -44,10 +74,12 @@ class DeepSeekV3Translator:
             "deepseek-ai/DeepSeek-V3",
             torch_dtype="auto",
             device_map="auto",
+            cache_dir="/models",
             trust_remote_code=True,
         )
+        model_volume.commit()
         
-        print("✓ DeepSeek V3 模型加载完成")
+        print(f"✓ DeepSeek V3 模型加载完成，耗时 {time.monotonic() - start:.1f}s")
 
     @modal.method()
     def translate(
@@ -56,10 +88,7 @@ class DeepSeekV3Translator:
         source_lang: str = "Chinese",
         target_lang: str = "English"
     ) -> str:
-        prompt = f"""Translate the following {source_lang} text to {target_lang}. Only output the translation, no explanations.
-
-{source_lang}: {text}
-{target_lang}:"""
+        prompt = _translation_prompt(text, source_lang, target_lang)
         
         messages = [{"role": "user", "content": prompt}]
         
@@ -73,6 +102,236 @@ class DeepSeekV3Translator:
         
         result = self.tokenizer.decode(outputs[0][len(inputs[0]):], skip_special_tokens=True)
         return result.strip()
+    
+    @modal.method()
+    def translate_document(
+        self,
+        text: str,
+        source_lang: str = "Chinese",
+        target_lang: str = "English"
+    ) -> dict:
+        """
+        翻译长文档：按段落和句子边界切成 token 受限的分块，批量翻译后按原顺序拼回
+        
+        Returns:
+            {"translation": 译文, "chunks": 分块数, "cache_hits": 命中缓存的分块数}
+        """
+        print(f"📄 翻译文档: {len(text)} 字符")
+        
+        result, n_chunks, cache_hits = self._translate_long_text(text, source_lang, target_lang)
+        
+        print(f"✓ 文档翻译完成: {n_chunks} 个分块，{cache_hits} 个命中缓存")
+        return {"translation": result, "chunks": n_chunks, "cache_hits": cache_hits}
+    
+    def _translate_long_text(self, text: str, source_lang: str, target_lang: str) -> tuple[str, int, int]:
+        """分块翻译长文本并按原顺序拼回，返回 (译文, 分块数, 命中缓存的分块数)"""
+        # 段落分隔符原样保留，每个段落独立分块，重复的段落产生相同的分块
+        parts = PARAGRAPH_BOUNDARY.split(text)
+        layout = []  # 每项为分隔符字符串，或段落对应的分块下标列表
+        chunks = []
+        for i, part in enumerate(parts):
+            if i % 2 == 1 or not part.strip():
+                layout.append(part)
+                continue
+            paragraph_chunks = self._split_chunks(part.strip())
+            layout.append(list(range(len(chunks), len(chunks) + len(paragraph_chunks))))
+            chunks.extend(paragraph_chunks)
+        
+        translations, cache_hits = self._translate_chunks(chunks, source_lang, target_lang)
+        
+        joiner = "" if target_lang in CJK_LANGS else " "
+        result = "".join(
+            item if isinstance(item, str) else joiner.join(translations[j] for j in item)
+            for item in layout
+        )
+        return result, len(chunks), cache_hits
+    
+    def _split_chunks(self, paragraph: str) -> list[str]:
+        """把段落按句子边界装箱成不超过 CHUNK_MAX_TOKENS 的分块，超长句子按 token 硬切"""
+        chunks, current, current_tokens = [], [], 0
+        for sentence in filter(None, (s.strip() for s in SENTENCE_BOUNDARY.split(paragraph))):
+            ids = self.tokenizer.encode(sentence, add_special_tokens=False)
+            if len(ids) > CHUNK_MAX_TOKENS:
+                pieces = [
+                    self.tokenizer.decode(ids[k:k + CHUNK_MAX_TOKENS])
+                    for k in range(0, len(ids), CHUNK_MAX_TOKENS)
+                ]
+            else:
+                pieces = [sentence]
+            
+            for piece, n in ((p, min(len(ids), CHUNK_MAX_TOKENS)) for p in pieces):
+                if current and current_tokens + n > CHUNK_MAX_TOKENS:
+                    chunks.append(self._join_sentences(current))
+                    current, current_tokens = [], 0
+                current.append(piece)
+                current_tokens += n
+        if current:
+            chunks.append(self._join_sentences(current))
+        return chunks
+    
+    def _join_sentences(self, sentences: list[str]) -> str:
+        # 中日文句子之间不加空格
+        return "".join(
+            s if i == 0 or re.match(r"[\u3000-\u9fff\uff00-\uffef]", s[:1]) else " " + s
+            for i, s in enumerate(sentences)
+        )
+    
+    def _translate_chunks(self, chunks: list[str], source_lang: str, target_lang: str) -> tuple[list[str], int]:
+        """先查翻译缓存，未命中的分块去重后按长度排序分批翻译，结果写回缓存；返回 (译文, 命中数)"""
+        keys = [_cache_key(chunk, source_lang, target_lang) for chunk in chunks]
+        found = _memory_lookup(set(keys))
+        cache_hits = sum(key in found for key in keys)
+        
+        missing = {key: chunk for key, chunk in zip(keys, chunks) if key not in found}
+        # 长度相近的分块放在同一批，减少 padding
+        pending = sorted(missing.items(), key=lambda item: len(item[1]))
+        for start in range(0, len(pending), MAX_BATCH_CHUNKS):
+            batch = pending[start:start + MAX_BATCH_CHUNKS]
+            results = self._translate_batch([chunk for _, chunk in batch], source_lang, target_lang)
+            new_entries = {key: result for (key, _), result in zip(batch, results)}
+            found.update(new_entries)
+            translation_cache.update(new_entries)
+        
+        return [found[key] for key in keys], cache_hits
+    
+    @modal.method()
+    def translate_segments(
+        self,
+        segments: list[str],
+        source_lang: str = "Chinese",
+        target_lang: str = "English"
+    ):
+        """
+        批量翻译片段，按完成顺序逐个产出结果
+        
+        先用精确哈希去重并查询翻译记忆，未命中的片段按 token 长度排序分桶，
+        每批在补齐后的 token 总数受限的前提下尽量多放片段，翻译完一批立即产出该批结果。
+        空白片段原样返回；超过 CHUNK_MAX_TOKENS 的片段按文档翻译的方式分块翻译，避免译文被截断。
+        
+        Yields:
+            {"index": 片段下标, "translation": 译文, "source": "memory" | "model" | "empty"}，
+            最后一条为汇总 {"done": true, "segments": ..., "memory_hits": ..., "segments_per_s": ...}
+        """
+        start = time.monotonic()
+        print(f"📚 批量翻译 {len(segments)} 个片段...")
+        
+        # 相同片段只翻译一次
+        indices_by_key = {}
+        texts_by_key = {}
+        for i, segment in enumerate(segments):
+            if not segment.strip():
+                yield {"index": i, "translation": segment, "source": "empty"}
+                continue
+            key = _cache_key(segment, source_lang, target_lang)
+            indices_by_key.setdefault(key, []).append(i)
+            texts_by_key[key] = segment
+        
+        memory = _memory_lookup(indices_by_key)
+        for key, translation in memory.items():
+            for i in indices_by_key[key]:
+                yield {"index": i, "translation": translation, "source": "memory"}
+        
+        # 按长度分桶：相邻长度的片段放在一批，padding 最少
+        pending = sorted(
+            ((len(self.tokenizer.encode(texts_by_key[key], add_special_tokens=False)), key)
+             for key in indices_by_key if key not in memory),
+        )
+        
+        # 超长片段单独分块翻译，其余片段分桶批量翻译
+        for n_tokens, key in [item for item in pending if item[0] > CHUNK_MAX_TOKENS]:
+            result, _, _ = self._translate_long_text(texts_by_key[key], source_lang, target_lang)
+            translation_cache[key] = result
+            for i in indices_by_key[key]:
+                yield {"index": i, "translation": result, "source": "model"}
+        pending = [item for item in pending if item[0] <= CHUNK_MAX_TOKENS]
+        
+        batch = []
+        for n_tokens, key in pending + [(None, None)]:
+            if batch and (
+                key is None
+                or len(batch) >= BULK_MAX_BATCH_SEGMENTS
+                or n_tokens * (len(batch) + 1) > BULK_MAX_BATCH_TOKENS
+            ):
+                max_tokens = batch[-1][0]
+                results = self._translate_batch(
+                    [texts_by_key[k] for _, k in batch], source_lang, target_lang,
+                    max_new_tokens=min(MAX_NEW_TOKENS, 2 * max_tokens + 64),
+                )
+                new_entries = {k: result for (_, k), result in zip(batch, results)}
+                translation_cache.update(new_entries)
+                for k, result in new_entries.items():
+                    for i in indices_by_key[k]:
+                        yield {"index": i, "translation": result, "source": "model"}
+                batch = []
+            if key is not None:
+                batch.append((n_tokens, key))
+        
+        elapsed = time.monotonic() - start
+        memory_hits = sum(len(indices_by_key[key]) for key in memory)
+        print(f"✓ 批量翻译完成: {len(segments)} 个片段，{memory_hits} 个命中翻译记忆，{len(segments) / elapsed:.1f} 片段/秒")
+        yield {
+            "done": True,
+            "segments": len(segments),
+            "unique_segments": len(indices_by_key),
+            "memory_hits": memory_hits,
+            "elapsed_s": elapsed,
+            "segments_per_s": len(segments) / elapsed if elapsed > 0 else 0,
+        }
+    
+    def _translate_batch(self, texts: list[str], source_lang: str, target_lang: str,
+                         max_new_tokens: int = None) -> list[str]:
+        """一次 generate 翻译多个分块（左侧 padding）"""
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": _translation_prompt(text, source_lang, target_lang)}],
+                tokenize=False,
+                add_generation_prompt=True,
+            )
+            for text in texts
+        ]
+        
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        inputs = self.tokenizer(
+            prompts, return_tensors="pt", padding=True, add_special_tokens=False
+        ).to(self.model.device)
+        
+        outputs = self.model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens or min(MAX_NEW_TOKENS, 2 * CHUNK_MAX_TOKENS + 64),
+            temperature=0.3,
+            do_sample=True,
+            top_p=0.95,
+            pad_token_id=self.tokenizer.pad_token_id,
+        )
+        
+        prompt_len = inputs["input_ids"].shape[1]
+        return [
+            self.tokenizer.decode(output[prompt_len:], skip_special_tokens=True).strip()
+            for output in outputs
+        ]
+
+
+def _translation_prompt(text: str, source_lang: str, target_lang: str) -> str:
+    return f"""Translate the following {source_lang} text to {target_lang}. Only output the translation, no explanations.
+
+{source_lang}: {text}
+{target_lang}:"""
+
+
+def _memory_lookup(keys) -> dict:
+    """并发查询翻译记忆，返回命中的 {键: 译文}"""
+    keys = list(keys)
+    if not keys:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(MEMORY_LOOKUP_WORKERS, len(keys))) as pool:
+        values = pool.map(translation_cache.get, keys)
+    return {key: value for key, value in zip(keys, values) if value is not None}
+
+
+def _cache_key(text: str, source_lang: str, target_lang: str) -> str:
+    return hashlib.sha256(f"{source_lang}\0{target_lang}\0{text}".encode("utf-8")).hexdigest()
 
 
 @app.function(image=image)
@@ -87,6 +346,55 @@ def translate_api(data: dict):
     return {"status": "success", "translation": result}
 
 
+@app.function(image=image, timeout=3600)
+@modal.web_endpoint(method="POST")
+def translate_document_api(data: dict):
+    """
+    长文档翻译
+    
+    POST /translate_document_api
+    {
+        "text": "多段落长文本...",
+        "source_lang": "Chinese",
+        "target_lang": "English"
+    }
+    """
+    translator = DeepSeekV3Translator()
+    result = translator.translate_document.remote(
+        text=data.get("text", ""),
+        source_lang=data.get("source_lang", "Chinese"),
+        target_lang=data.get("target_lang", "English")
+    )
+    return {"status": "success", **result}
+
+
+@app.function(image=image, timeout=3600)
+@modal.web_endpoint(method="POST")
+def translate_bulk_api(data: dict):
+    """
+    批量片段翻译，以 NDJSON 流式返回（每行一个结果，最后一行为汇总）
+    
+    POST /translate_bulk_api
+    {
+        "segments": ["片段1", "片段2", ...],
+        "source_lang": "Chinese",
+        "target_lang": "English"
+    }
+    """
+    from fastapi.responses import StreamingResponse
+    
+    translator = DeepSeekV3Translator()
+    results = translator.translate_segments.remote_gen(
+        segments=data.get("segments", []),
+        source_lang=data.get("source_lang", "Chinese"),
+        target_lang=data.get("target_lang", "English")
+    )
+    return StreamingResponse(
+        (json.dumps(result, ensure_ascii=False) + "\n" for result in results),
+        media_type="application/x-ndjson",
+    )
+
+
 @app.local_entrypoint()
 def main():
     translator = DeepSeekV3Translator()
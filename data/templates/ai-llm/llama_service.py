@@ -23,6 +23,11 @@ image = (
 
 model_volume = modal.Volume.from_name("llm-models", create_if_missing=True)
 
+# 投机解码为可选模式，默认关闭；设为 True 时加载草稿模型（与主模型共用 tokenizer）
+# Llama 3.2 草稿模型的 rope_scaling（rope_type=llama3）需要 transformers>=4.43，启用前先升级镜像中的版本
+SPECULATIVE_DECODING = False
+DRAFT_MODEL = "meta-llama/Llama-3.2-1B-Instruct"
+
 
 @app.cls(
     image=image,
@@ -30,46 +35,86 @@ model_volume = modal.Volume.from_name("llm-models", create_if_missing=True)
     volumes={"/models": model_volume},
     timeout=600,
     container_idle_timeout=300,
+    mounts=[modal.Mount.from_local_python_packages("llm_engine", "model_snapshot")],
 )
+@modal.concurrent(max_inputs=64)  # 并发请求由连续批处理引擎合并解码；引擎不可用时回退路径串行执行
 class LlamaChat:
     @modal.enter()
     def load_model(self):
-        from transformers import AutoModelForCausalLM, AutoTokenizer
-        import torch
+        from model_snapshot import load_model
         
         print("🤖 加载 Llama 3 模型...")
         
         model_name = "meta-llama/Meta-Llama-3-8B-Instruct"
         
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            model_name, cache_dir="/models"
-        )
-        
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16,
-            device_map="auto",
-            cache_dir="/models",
-            load_in_8bit=True,
+        # 首次加载后把 8-bit 权重保存为快照，之后冷启动直接加载量化好的分片
+        self.model, self.tokenizer, self.load_info = load_model(
+            model_name, model_volume, cache_dir="/models", load_in_8bit=True
         )
         
         print("✓ 模型加载完成")
+
+        # 连续批处理引擎，模型不兼容时回退到 model.generate
+        from llm_engine import create_engine
+        self.engine = create_engine(
+            self.model, self.tokenizer, draft_model_name=DRAFT_MODEL if SPECULATIVE_DECODING else None
+        )
+
     
     @modal.method()
     def chat(self, messages: list[dict], max_tokens: int = 512, temperature: float = 0.7) -> str:
         prompt = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
         inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
         
-        outputs = self.model.generate(**inputs, max_new_tokens=max_tokens, temperature=temperature, do_sample=True)
-        response = self.tokenizer.decode(outputs[0][inputs.input_ids.shape[1]:], skip_special_tokens=True)
+        if self.engine is not None:
+            generated_ids = self.engine.generate(
+                inputs.input_ids[0].tolist(), max_new_tokens=max_tokens, temperature=temperature
+            )
+        else:
+            from llm_engine import fallback_generate
+            outputs = fallback_generate(self.model, **inputs, max_new_tokens=max_tokens, temperature=temperature, do_sample=True)
+            generated_ids = outputs[0][inputs.input_ids.shape[1]:]
+        response = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
         
         return response.strip()
 
+    @modal.method()
+    def chat_stream(self, messages: list[dict], max_tokens: int = 512, temperature: float = 0.7):
+        """流式对话：逐段产出 OpenAI 兼容的 SSE 事件（chat.completion.chunk）"""
+        from llm_engine import openai_sse, stream_chat
+        
+        prompt = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        input_ids = self.tokenizer(prompt).input_ids
+        deltas = stream_chat(self.model, self.tokenizer, self.engine, input_ids, max_tokens, temperature)
+        yield from openai_sse(deltas, "llama-3-8b")
+
+    @modal.method()
+    def stats(self) -> dict:
+        """连续批处理引擎指标（tokens/s、排队等待、批大小、KV 缓存占用、投机接受率）和冷启动耗时"""
+        if self.engine is None:
+            return {"engine": "disabled", "cold_start": self.load_info}
+        return {**self.engine.stats(), "cold_start": self.load_info}
+
 
 @app.function(image=image)
 @modal.web_endpoint(method="POST")
 def chat_api(data: dict):
+    """
+    OpenAI 兼容的对话接口，"stream": true 时以 SSE 逐段返回
+    """
     llm = LlamaChat()
+    if data.get("stream"):
+        from fastapi.responses import StreamingResponse
+        
+        return StreamingResponse(
+            llm.chat_stream.remote_gen(
+                messages=data.get("messages", []),
+                max_tokens=data.get("max_tokens", 512),
+                temperature=data.get("temperature", 0.7),
+            ),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
     response = llm.chat.remote(
         messages=data.get("messages", []),
         max_tokens=data.get("max_tokens", 512),
@@ -0,0 +1,900 @@
+"""
+LLM 连续批处理推理核心
+供 ai-llm/*_service.py 共用，替代逐个会话调用 model.generate
+
+工作方式：
+- 后台线程循环执行解码步，每一步为所有进行中的请求各生成一个 token
+- 新请求在两个解码步之间完成 prefill 并加入当前批次，不必等待整批结束
+- KV 缓存按页（BLOCK_SIZE 个 token）从预分配的显存池中分配，请求结束立即归还
+- 显存池不足时抢占最晚加入的请求，稍后重新 prefill 继续生成
+- 写满的缓存页按 token 前缀哈希登记，后续请求（多轮对话的下一轮、相同的系统提示词）
+  直接复用这些页，只 prefill 新增的 token；无人引用的页按 LRU 淘汰
+- 可选投机解码：只有一个请求在生成时，由同系列的小草稿模型连续提出若干 token，
+  主模型一次前向验证；接受率过低时自动暂停投机，退回普通解码
+- stats() 报告吞吐量 (tokens/s)、排队等待时间、缓存占用和投机接受率
+- stream_chat / openai_sse 把生成结果逐段包装成 OpenAI 兼容的 SSE 事件
+
+适用于返回 (key, value) 元组、形状为 [batch, heads, seq, head_dim] 的 transformers 模型
+（Llama / Qwen2 / Mistral / Yi 等），不兼容的模型在 create_engine 预热时会被识别出来
+
+本地 CPU 自检（随机初始化的小模型，对比 model.generate 的贪心输出）:
+    python llm_engine.py
+"""
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+BLOCK_SIZE = 16                 # 每页 KV 缓存的 token 数
+MAX_BATCH_SIZE = 32             # 同时解码的最大请求数
+MAX_CACHE_TOKENS = 65536        # KV 缓存池容量（token 数），决定显存占用
+MAX_PREFILL_TOKENS = 4096       # 每个解码步之间最多 prefill 的 token 数，避免长 prompt 卡住正在生成的请求
+STATS_WINDOW = 1000             # 统计排队等待分位数时保留的最近请求数
+FALLBACK_CONCURRENCY = 1        # 引擎不可用时同时运行的 model.generate 数，避免并发请求挤爆显存
+WARMUP_PROMPTS = ["Hello", "The quick brown fox jumps over the lazy dog, then runs back home."]
+WARMUP_TOKENS = 8               # 预热时每个请求贪心生成的 token 数，与 model.generate 对比
+
+# 投机解码参数
+SPEC_TOKENS = 4                 # 草稿模型每轮提出的 token 数
+SPEC_WINDOW = 32                # 按最近多少轮计算接受率
+SPEC_MIN_ACCEPTANCE = 0.4       # 接受率低于此值时暂停投机
+SPEC_COOLDOWN_STEPS = 512       # 暂停后经过多少个解码步再重新尝试
+
+
+class Sequence:
+    """一个生成请求：输入、已生成的 token、占用的缓存页和结果通道"""
+
+    def __init__(self, input_ids: list[int], max_new_tokens: int, temperature: float, top_p: float):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.output_ids = []
+        self.block_table = []      # 占用的缓存页号
+        self.cached = 0            # 已写入 KV 缓存的 token 数
+        self.hashed_blocks = 0     # 已登记前缀哈希的页数
+        self.prefix_hash = None    # 最后一个已登记页的前缀哈希
+        self.draft_past = None     # 草稿模型的 KV 缓存（投机解码）
+        self.draft_cached = 0
+        self.tokens = queue.Queue()  # 流式输出的 token id，结束时放入 None
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.cancelled = False
+
+    @property
+    def context(self) -> list[int]:
+        return self.input_ids + self.output_ids
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class PagedKVCache:
+    """分页 KV 缓存：所有层的 K/V 存在一块预分配的显存里，槽位号 = 页号 * block_size + 页内偏移"""
+
+    def __init__(self, num_layers: int, num_heads: int, head_dim: int, num_blocks: int,
+                 block_size: int, dtype, device):
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.data = torch.zeros(
+            (num_layers, 2, num_blocks * block_size, num_heads, head_dim), dtype=dtype, device=device
+        )
+        # 第 0 页保留为全零的填充页，批内较短的序列左侧用它补齐
+        self.free_blocks = collections.deque(range(1, num_blocks))
+        self.ref_counts = [0] * num_blocks
+        # 前缀缓存：写满的页以 (上一页的前缀哈希, 本页 token) 为键登记，可被多个请求共享
+        self.prefix_blocks = {}                      # 键 -> 页号
+        self.block_keys = {}                         # 页号 -> 键
+        self.evictable = collections.OrderedDict()   # 无人引用但保留内容的已登记页，按最近使用排序
+
+    def available(self) -> int:
+        return len(self.free_blocks) + len(self.evictable)
+
+    def blocks_needed(self, seq: Sequence, length: int) -> int:
+        return max(0, -(-length // self.block_size) - len(seq.block_table))
+
+    def reserve(self, seq: Sequence, length: int) -> bool:
+        """保证 seq 的缓存页能容纳 length 个 token，空闲页不足时返回 False"""
+        needed = self.blocks_needed(seq, length)
+        if needed > self.available():
+            return False
+        for _ in range(needed):
+            block = self._allocate()
+            self.ref_counts[block] = 1
+            seq.block_table.append(block)
+        return True
+
+    def free(self, seq: Sequence):
+        """释放 seq 的引用；已登记的页保留内容等待复用，其余页归还空闲池"""
+        for block in seq.block_table:
+            self.ref_counts[block] -= 1
+            if self.ref_counts[block] > 0:
+                continue
+            if block in self.block_keys:
+                self.evictable[block] = None
+            else:
+                self.free_blocks.append(block)
+        seq.block_table = []
+        seq.cached = 0
+        seq.hashed_blocks = 0
+        seq.prefix_hash = None
+
+    def match_prefix(self, seq: Sequence, tokens: list[int]) -> int:
+        """复用与 tokens 前缀相同的已登记页，返回命中的 token 数（至少留一个 token 用于 prefill）"""
+        bs = self.block_size
+        for i in range((len(tokens) - 1) // bs):
+            key = (seq.prefix_hash, tuple(tokens[i * bs:(i + 1) * bs]))
+            block = self.prefix_blocks.get(key)
+            if block is None:
+                break
+            if self.ref_counts[block] == 0:
+                del self.evictable[block]
+            self.ref_counts[block] += 1
+            seq.block_table.append(block)
+            seq.hashed_blocks += 1
+            seq.prefix_hash = hash(key)
+        seq.cached = seq.hashed_blocks * bs
+        return seq.cached
+
+    def register(self, seq: Sequence, tokens: list[int]):
+        """登记 seq 新写满的页；相同前缀已有页时保留已有的那一页"""
+        bs = self.block_size
+        for i in range(seq.hashed_blocks, seq.cached // bs):
+            key = (seq.prefix_hash, tuple(tokens[i * bs:(i + 1) * bs]))
+            block = seq.block_table[i]
+            if key not in self.prefix_blocks and block not in self.block_keys:
+                self.prefix_blocks[key] = block
+                self.block_keys[block] = key
+            seq.hashed_blocks += 1
+            seq.prefix_hash = hash(key)
+
+    def _allocate(self) -> int:
+        if self.free_blocks:
+            return self.free_blocks.popleft()
+        block, _ = self.evictable.popitem(last=False)
+        del self.prefix_blocks[self.block_keys.pop(block)]
+        return block
+
+    def slots(self, seq: Sequence, start: int, end: int) -> list[int]:
+        bs = self.block_size
+        return [seq.block_table[i // bs] * bs + i % bs for i in range(start, end)]
+
+    def write(self, slots: list[int], kv):
+        """kv: [layers, 2, len(slots), heads, head_dim]"""
+        index = torch.tensor(slots, dtype=torch.long, device=self.data.device)
+        self.data[:, :, index] = kv.to(self.data.device, self.data.dtype)
+
+    def gather(self, seqs: list[Sequence], layer_devices: list):
+        """
+        把批内各序列的缓存拼成左侧补齐的 past_key_values，返回 (past, 最大长度)
+
+        会复制各序列的全部历史，开销与批内总上下文长度成正比；解码时只在批次成员变化后调用，
+        批次不变的解码步直接沿用上一步模型返回的 past（见 LLMEngine._decode）
+        """
+        max_len = max(seq.cached for seq in seqs)
+        slots = torch.zeros((len(seqs), max_len), dtype=torch.long)
+        for row, seq in enumerate(seqs):
+            if seq.cached:
+                slots[row, max_len - seq.cached:] = torch.tensor(self.slots(seq, 0, seq.cached))
+
+        # [layers, 2, batch, len, heads, dim] -> [layers, 2, batch, heads, len, dim]
+        kv = self.data[:, :, slots.to(self.data.device)].transpose(3, 4)
+        past = tuple(
+            (kv[layer, 0].to(device), kv[layer, 1].to(device))
+            for layer, device in enumerate(layer_devices)
+        )
+        return past, max_len
+
+    def usage(self) -> float:
+        return 1 - self.available() / (self.num_blocks - 1)
+
+
+class LLMEngine:
+    """连续批处理推理引擎，调用方线程通过 submit / generate / stream 提交请求"""
+
+    def __init__(
+        self,
+        model,
+        eos_token_ids,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_cache_tokens: int = MAX_CACHE_TOKENS,
+        block_size: int = BLOCK_SIZE,
+        draft_model=None,
+        spec_tokens: int = SPEC_TOKENS,
+    ):
+        self.model = model
+        self.draft_model = draft_model
+        self.spec_tokens = spec_tokens
+        self.vocab_size = model.get_input_embeddings().weight.shape[0]
+        self.device = model.get_input_embeddings().weight.device
+        self.eos_token_ids = set(eos_token_ids)
+        self.max_batch_size = max_batch_size
+        self.max_cache_tokens = max_cache_tokens
+        self.block_size = block_size
+        self.default_top_p = getattr(model.generation_config, "top_p", None) or 1.0  # 与 model.generate 默认一致
+
+        self.cache = None          # 首次 prefill 时按模型返回的 K/V 形状分配
+        self.layer_devices = None
+        self._decode_view = None   # (批内各序列及其 cached, 上一步模型返回的 past, 长度)，批次不变时复用
+        self.waiting = collections.deque()
+        self.running = []
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._queue_waits = collections.deque(maxlen=STATS_WINDOW)
+        self._counters = {
+            "requests": 0, "prompt_tokens": 0, "prefix_hit_tokens": 0, "generated_tokens": 0,
+            "decode_steps": 0, "batched_tokens": 0, "preemptions": 0, "busy_seconds": 0.0,
+            "spec_rounds": 0, "spec_proposed": 0, "spec_accepted": 0, "spec_pauses": 0,
+        }
+        self._spec_window = collections.deque(maxlen=SPEC_WINDOW)
+        self._spec_cooldown = 0
+        self._started_at = time.monotonic()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, input_ids: list[int], max_new_tokens: int = 512,
+               temperature: float = 0.7, top_p: float = None) -> Sequence:
+        """提交请求，立即返回 Sequence（tokens 队列用于流式读取，future 用于等待完整结果）"""
+        if top_p is None:
+            top_p = self.default_top_p
+        seq = Sequence(input_ids, max_new_tokens, temperature, top_p)
+        if self.cache is not None and len(seq.input_ids) + max_new_tokens > self.cache.num_blocks * self.block_size:
+            raise ValueError(f"请求长度超过 KV 缓存容量: {len(seq.input_ids)} + {max_new_tokens}")
+        with self._lock:
+            self.waiting.append(seq)
+        self._wakeup.set()
+        return seq
+
+    def generate(self, input_ids: list[int], **kwargs) -> list[int]:
+        """阻塞直到生成结束，返回新生成的 token id（不含结束符）"""
+        return self.submit(input_ids, **kwargs).future.result()
+
+    def stream(self, input_ids: list[int], **kwargs):
+        """逐个产出新生成的 token id；调用方提前关闭生成器时取消请求"""
+        seq = self.submit(input_ids, **kwargs)
+        try:
+            while True:
+                token = seq.tokens.get()
+                if token is None:
+                    break
+                yield token
+            seq.future.result()  # 生成出错时在这里抛出
+        finally:
+            seq.cancel()
+
+    def stats(self) -> dict:
+        """吞吐量、排队等待和缓存占用"""
+        with self._lock:
+            counters = dict(self._counters)
+            waits = sorted(self._queue_waits)
+            queue_depth, running = len(self.waiting), len(self.running)
+
+        elapsed = time.monotonic() - self._started_at
+        busy = counters["busy_seconds"]
+        return {
+            **counters,
+            "queue_depth": queue_depth,
+            "running": running,
+            "tokens_per_s": counters["generated_tokens"] / elapsed if elapsed > 0 else 0,
+            "busy_tokens_per_s": counters["generated_tokens"] / busy if busy > 0 else 0,
+            "avg_batch_size": counters["batched_tokens"] / counters["decode_steps"] if counters["decode_steps"] else 0,
+            "queue_wait_p50_ms": _percentile(waits, 50) * 1000,
+            "queue_wait_p99_ms": _percentile(waits, 99) * 1000,
+            "prefix_hit_rate": counters["prefix_hit_tokens"] / counters["prompt_tokens"] if counters["prompt_tokens"] else 0,
+            "kv_cache_usage": self.cache.usage() if self.cache is not None else 0,
+            "prefix_cached_blocks": len(self.cache.block_keys) if self.cache is not None else 0,
+            "speculative": "disabled" if self.draft_model is None else ("paused" if self._spec_cooldown else "on"),
+            "spec_acceptance_rate": counters["spec_accepted"] / counters["spec_proposed"] if counters["spec_proposed"] else 0,
+        }
+
+    def shutdown(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def _loop(self):
+        while not self._stopped:
+            if not self.running and not self.waiting:
+                self._decode_view = None
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            start = time.monotonic()
+            try:
+                with torch.no_grad():
+                    self._admit()
+                    if len(self.running) == 1 and self._speculation_active():
+                        if not self._speculate(self.running[0]):
+                            self._decode()
+                    elif self.running:
+                        self._decode()
+            except Exception as e:
+                # 出错时结束当前所有请求，引擎继续服务后续请求
+                print(f"⚠️ 推理出错: {e}")
+                self._decode_view = None
+                with self._lock:
+                    failed = self.running + [seq for seq in self.waiting if seq.started_at is not None]
+                    self.running = []
+                    self.waiting = collections.deque(seq for seq in self.waiting if seq.started_at is None)
+                for seq in failed:
+                    self._finish(seq, error=e)
+
+            with self._lock:
+                self._counters["busy_seconds"] += time.monotonic() - start
+
+    def _admit(self):
+        """在解码步之间把等待中的请求 prefill 后加入批次"""
+        budget = MAX_PREFILL_TOKENS
+        while len(self.running) < self.max_batch_size:
+            with self._lock:
+                if not self.waiting:
+                    return
+                seq = self.waiting[0]
+
+            if seq.cancelled:
+                with self._lock:
+                    self.waiting.popleft()
+                self._finish(seq)
+                continue
+
+            context = seq.context
+            if self.cache is not None and -(-(len(context) + 1) // self.block_size) >= self.cache.num_blocks:
+                with self._lock:
+                    self.waiting.popleft()
+                self._finish(seq, error=ValueError(f"请求长度超过 KV 缓存容量: {len(context)}"))
+                continue
+            # 至少 prefill 一个请求，避免超长 prompt 永远无法加入
+            if len(context) > budget and budget < MAX_PREFILL_TOKENS:
+                return
+            if self.cache is not None and self.cache.blocks_needed(seq, len(context) + 1) > self.cache.available():
+                return
+
+            with self._lock:
+                self.waiting.popleft()
+                if seq.started_at is None:
+                    seq.started_at = time.monotonic()
+                    self._queue_waits.append(seq.started_at - seq.submitted_at)
+                    self._counters["requests"] += 1
+                    self._counters["prompt_tokens"] += len(seq.input_ids)
+
+            self._prefill(seq, context)
+            budget -= len(context)
+
+    def _prefill(self, seq: Sequence, context: list[int]):
+        """prefill 请求的上下文：命中前缀缓存的部分直接复用，只计算之后的 token"""
+        cached = self.cache.match_prefix(seq, context) if self.cache is not None else 0
+        input_ids = torch.tensor([context[cached:]], dtype=torch.long, device=self.device)
+        if cached:
+            past, _ = self.cache.gather([seq], self.layer_devices)
+            out = self.model(
+                input_ids=input_ids,
+                attention_mask=torch.ones((1, len(context)), dtype=torch.long, device=self.device),
+                position_ids=torch.arange(cached, len(context), device=self.device)[None],
+                past_key_values=past,
+                use_cache=True,
+            )
+        else:
+            out = self.model(input_ids=input_ids, use_cache=True)
+        past = _legacy_cache(out.past_key_values)
+
+        if self.cache is None:
+            self._allocate_cache(past, len(context))
+        if not self.cache.reserve(seq, len(context)):
+            raise RuntimeError("KV 缓存空间不足")
+
+        # [layers, 2, heads, len, dim] -> [layers, 2, len, heads, dim]，只写回新计算的部分
+        kv = torch.stack([
+            torch.stack((k[0, :, cached:], v[0, :, cached:])).to(self.cache.data.device) for k, v in past
+        ]).transpose(2, 3)
+        self.cache.write(self.cache.slots(seq, cached, len(context)), kv)
+        seq.cached = len(context)
+        self.cache.register(seq, context)
+        with self._lock:
+            self._counters["prefix_hit_tokens"] += cached
+
+        token = _sample(out.logits[:, -1].float(), [seq.temperature], [seq.top_p])[0]
+        with self._lock:
+            self.running.append(seq)
+        self._append_token(seq, token)
+
+    def _decode(self):
+        """为批内每个请求生成一个 token"""
+        # 为新 token 预留缓存页，不足时抢占最晚加入的请求
+        for seq in list(self.running):
+            if seq not in self.running:
+                continue
+            while not self.cache.reserve(seq, seq.cached + 1):
+                victim = self.running[-1]
+                self._preempt(victim)
+                if victim is seq:
+                    break
+        batch = list(self.running)
+        if not batch:
+            return
+
+        # 批内成员和各自的缓存长度与上一步结束时相同，说明期间没有加入、退出、抢占或投机，
+        # 上一步模型返回的 past 已包含全部历史，直接复用，不再从分页缓存复制
+        members = [(seq, seq.cached) for seq in batch]
+        view = self._decode_view
+        if view is not None and len(view[0]) == len(members) and all(
+            a is b and n == m for (a, n), (b, m) in zip(view[0], members)
+        ):
+            past, max_len = view[1], view[2]
+        else:
+            past, max_len = self.cache.gather(batch, self.layer_devices)
+        input_ids = torch.tensor([[seq.output_ids[-1]] for seq in batch], dtype=torch.long, device=self.device)
+        position_ids = torch.tensor([[seq.cached] for seq in batch], dtype=torch.long, device=self.device)
+        attention_mask = torch.zeros((len(batch), max_len + 1), dtype=torch.long, device=self.device)
+        for row, seq in enumerate(batch):
+            attention_mask[row, max_len - seq.cached:] = 1
+
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+        )
+        new_past = _legacy_cache(out.past_key_values)
+
+        # 新 token 的 K/V 写回各自的缓存页: [layers, 2, batch, heads, dim]
+        kv = torch.stack([torch.stack((k[:, :, -1], v[:, :, -1])).to(self.cache.data.device) for k, v in new_past])
+        slots = [self.cache.slots(seq, seq.cached, seq.cached + 1)[0] for seq in batch]
+        self.cache.write(slots, kv)
+        for seq in batch:
+            seq.cached += 1
+            if seq.cached % self.block_size == 0:
+                self.cache.register(seq, seq.context)
+        self._decode_view = ([(seq, seq.cached) for seq in batch], new_past, max_len + 1)
+
+        tokens = _sample(
+            out.logits[:, -1].float(),
+            [seq.temperature for seq in batch],
+            [seq.top_p for seq in batch],
+        )
+        with self._lock:
+            self._counters["decode_steps"] += 1
+            self._counters["batched_tokens"] += len(batch)
+        for seq, token in zip(batch, tokens):
+            self._append_token(seq, token)
+
+    def _speculation_active(self) -> bool:
+        if self.draft_model is None:
+            return False
+        if self._spec_cooldown:
+            self._spec_cooldown -= 1
+            return False
+        return True
+
+    def _speculate(self, seq: Sequence) -> bool:
+        """
+        一轮投机解码：草稿模型提出 k 个 token，主模型一次前向验证，接受最长的一致前缀再加一个主模型 token
+
+        贪心请求逐位比较 argmax，输出与普通解码一致；采样请求使用拒绝采样，输出分布与主模型一致。
+        缓存页不足或剩余长度太短时返回 False，由调用方走普通解码
+        """
+        k = min(self.spec_tokens, seq.max_new_tokens - len(seq.output_ids) - 1)
+        if k < 1 or not self.cache.reserve(seq, seq.cached + k + 1):
+            return False
+
+        context = seq.context
+        greedy = seq.temperature <= 0
+
+        # 草稿模型：补齐缓存到 context，再自回归提出 k 个 token
+        draft_tokens, draft_probs = [], []
+        inputs = context[seq.draft_cached:]
+        for _ in range(k):
+            out = self.draft_model(
+                input_ids=torch.tensor([inputs], dtype=torch.long, device=self.device),
+                past_key_values=seq.draft_past,
+                use_cache=True,
+            )
+            seq.draft_past = _legacy_cache(out.past_key_values)
+            seq.draft_cached += len(inputs)
+            logits = out.logits[0, -1, :self.vocab_size].float()  # 只在主模型词表内提议
+            if greedy:
+                token = int(logits.argmax())
+            else:
+                probs = _probs(logits[None], seq.temperature, seq.top_p)[0]
+                token = int(torch.multinomial(probs, 1))
+                draft_probs.append(probs)
+            draft_tokens.append(token)
+            inputs = [token]
+
+        # 主模型一次验证 k+1 个位置：上一轮的最后一个 token 加 k 个草稿 token
+        past, _ = self.cache.gather([seq], self.layer_devices)
+        verify_ids = [context[-1]] + draft_tokens
+        out = self.model(
+            input_ids=torch.tensor([verify_ids], dtype=torch.long, device=self.device),
+            attention_mask=torch.ones((1, seq.cached + k + 1), dtype=torch.long, device=self.device),
+            position_ids=torch.arange(seq.cached, seq.cached + k + 1, device=self.device)[None],
+            past_key_values=past,
+            use_cache=True,
+        )
+        logits = out.logits[0].float()
+
+        if greedy:
+            target = logits.argmax(dim=-1).tolist()
+            accepted = 0
+            while accepted < k and draft_tokens[accepted] == target[accepted]:
+                accepted += 1
+            bonus = target[accepted]
+        else:
+            target_probs = _probs(logits, seq.temperature, seq.top_p)
+            accepted, bonus = 0, None
+            for i, token in enumerate(draft_tokens):
+                p, q = target_probs[i], draft_probs[i]
+                if torch.rand(()) < min(1.0, float(p[token] / q[token])):
+                    accepted += 1
+                    continue
+                # 拒绝：从 max(0, p - q) 归一化后的分布中重新采样
+                residual = (p - _resize(q, p.shape[0])).clamp_min(0)
+                bonus = int(torch.multinomial(residual / residual.sum(), 1))
+                break
+            if bonus is None:
+                bonus = int(torch.multinomial(target_probs[k], 1))
+
+        # 写回被接受位置的 K/V，草稿缓存截断到被接受的前缀
+        new_past = _legacy_cache(out.past_key_values)
+        start = seq.cached
+        kv = torch.stack([
+            torch.stack((key[0, :, start:start + accepted + 1], value[0, :, start:start + accepted + 1]))
+            .to(self.cache.data.device)
+            for key, value in new_past
+        ]).transpose(2, 3)
+        self.cache.write(self.cache.slots(seq, start, start + accepted + 1), kv)
+        seq.cached += accepted + 1
+        self.cache.register(seq, context + draft_tokens[:accepted])
+        keep = min(seq.draft_cached, len(context) + accepted)
+        seq.draft_past = tuple((key[:, :, :keep], value[:, :, :keep]) for key, value in seq.draft_past)
+        seq.draft_cached = keep
+
+        self._record_speculation(accepted, k)
+        for token in draft_tokens[:accepted] + [bonus]:
+            if seq not in self.running:
+                break
+            self._append_token(seq, token)
+        return True
+
+    def _record_speculation(self, accepted: int, proposed: int):
+        """记录接受率，最近 SPEC_WINDOW 轮的接受率过低时暂停投机"""
+        with self._lock:
+            self._counters["spec_rounds"] += 1
+            self._counters["spec_proposed"] += proposed
+            self._counters["spec_accepted"] += accepted
+        self._spec_window.append((accepted, proposed))
+        if len(self._spec_window) < SPEC_WINDOW:
+            return
+
+        rate = sum(a for a, _ in self._spec_window) / sum(p for _, p in self._spec_window)
+        if rate < SPEC_MIN_ACCEPTANCE:
+            print(f"⚠️ 投机接受率 {rate:.0%} 过低，暂停 {SPEC_COOLDOWN_STEPS} 步")
+            self._spec_window.clear()
+            self._spec_cooldown = SPEC_COOLDOWN_STEPS
+            with self._lock:
+                self._counters["spec_pauses"] += 1
+
+    def _append_token(self, seq: Sequence, token: int):
+        if seq.cancelled or token in self.eos_token_ids:
+            self._retire(seq)
+            return
+
+        seq.output_ids.append(token)
+        seq.tokens.put(token)
+        with self._lock:
+            self._counters["generated_tokens"] += 1
+        if len(seq.output_ids) >= seq.max_new_tokens:
+            self._retire(seq)
+
+    def _retire(self, seq: Sequence):
+        with self._lock:
+            self.running.remove(seq)
+        self.cache.free(seq)
+        self._finish(seq)
+
+    def _preempt(self, seq: Sequence):
+        """释放请求的缓存页并放回等待队列头部，之后用 输入+已生成 重新 prefill"""
+        with self._lock:
+            self.running.remove(seq)
+            self.waiting.appendleft(seq)
+            self._counters["preemptions"] += 1
+        self.cache.free(seq)
+
+    def _finish(self, seq: Sequence, error: Exception = None):
+        if self.cache is not None and seq.block_table:
+            self.cache.free(seq)
+        seq.draft_past = None
+        seq.tokens.put(None)
+        if seq.future.done():
+            return
+        if error is not None:
+            seq.future.set_exception(error)
+        else:
+            seq.future.set_result(seq.output_ids)
+
+    def _allocate_cache(self, past, prompt_len: int):
+        k = past[0][0]
+        if k.dim() != 4 or k.shape[2] != prompt_len:
+            raise ValueError(f"不支持的 KV 缓存布局: {tuple(k.shape)}")
+
+        num_blocks = self.max_cache_tokens // self.block_size + 1
+        self.cache = PagedKVCache(
+            num_layers=len(past),
+            num_heads=k.shape[1],
+            head_dim=k.shape[3],
+            num_blocks=num_blocks,
+            block_size=self.block_size,
+            dtype=k.dtype,
+            device=k.device,
+        )
+        self.layer_devices = [layer[0].device for layer in past]
+
+        size_gb = self.cache.data.numel() * self.cache.data.element_size() / 1024**3
+        print(f"✓ KV 缓存池: {self.max_cache_tokens} tokens, {size_gb:.2f} GB")
+
+
+def create_engine(model, tokenizer, draft_model_name: str = None, cache_dir: str = "/models", **kwargs):
+    """
+    创建引擎并用一个短请求预热，模型不兼容时返回 None（调用方回退到 model.generate）
+
+    Args:
+        model: transformers CausalLM 模型
+        tokenizer: 对应的 tokenizer
+        draft_model_name: 投机解码的草稿模型（须与主模型使用同一 tokenizer），None 时不启用
+        cache_dir: 草稿模型的缓存目录
+        **kwargs: 传给 LLMEngine 的参数
+    """
+    eos = model.generation_config.eos_token_id
+    eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+    eos_token_ids.add(tokenizer.eos_token_id)
+    eos_token_ids.discard(None)
+
+    # 草稿模型加载或预热失败时不启用投机解码，主模型照常服务
+    if draft_model_name:
+        try:
+            from transformers import AutoModelForCausalLM
+
+            print(f"🤖 加载草稿模型 {draft_model_name}...")
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_name, torch_dtype=torch.float16, device_map="auto", cache_dir=cache_dir
+            ).eval()
+            engine = LLMEngine(model, eos_token_ids, draft_model=draft_model, **kwargs)
+        except Exception as e:
+            print(f"⚠️ 草稿模型不可用，不启用投机解码: {e}")
+        else:
+            try:
+                _warmup(engine, model, tokenizer)
+                print("✓ 连续批处理引擎就绪（投机解码）")
+                return engine
+            except Exception as e:
+                engine.shutdown()
+                print(f"⚠️ 投机解码预热失败，不启用投机解码: {e}")
+
+    engine = LLMEngine(model, eos_token_ids, **kwargs)
+    try:
+        _warmup(engine, model, tokenizer)
+    except Exception as e:
+        engine.shutdown()
+        print(f"⚠️ 连续批处理不可用，回退到 model.generate: {e}")
+        return None
+
+    print("✓ 连续批处理引擎就绪")
+    return engine
+
+
+def _warmup(engine, model, tokenizer):
+    """
+    预热并校验：贪心生成结果须与 model.generate 一致，否则抛出异常
+    KV 缓存布局特殊的模型（如 trust_remote_code 的 ChatGLM）可能不报错但输出错误，靠这里识别
+    """
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    for text in WARMUP_PROMPTS:
+        prompt = tokenizer.encode(text)
+        output = engine.generate(prompt, max_new_tokens=WARMUP_TOKENS, temperature=0)
+        with torch.no_grad():
+            expected = model.generate(
+                torch.tensor([prompt], dtype=torch.long, device=engine.device),
+                attention_mask=torch.ones((1, len(prompt)), dtype=torch.long, device=engine.device),
+                max_new_tokens=WARMUP_TOKENS,
+                do_sample=False,
+                eos_token_id=sorted(engine.eos_token_ids),
+                pad_token_id=pad_token_id,
+            )[0, len(prompt):].tolist()
+        for i, token in enumerate(expected):
+            if token in engine.eos_token_ids:
+                expected = expected[:i]
+                break
+        if output != expected:
+            raise ValueError(f"预热输出与 model.generate 不一致: {output} != {expected}")
+
+
+# 回退路径的并发限制：服务类按引擎可用设置了较高的 max_inputs，回退时由这里排队
+_fallback_slots = threading.Semaphore(FALLBACK_CONCURRENCY)
+
+
+def fallback_generate(model, *args, **kwargs):
+    """引擎不可用时调用 model.generate，同时运行的调用数不超过 FALLBACK_CONCURRENCY"""
+    with _fallback_slots:
+        return model.generate(*args, **kwargs)
+
+
+def stream_chat(model, tokenizer, engine, input_ids: list[int], max_new_tokens: int,
+                temperature: float, top_p: float = None):
+    """
+    逐段产出新生成的文本
+
+    有引擎时按 token 从引擎读取；引擎不可用时用 TextIteratorStreamer 包装 model.generate
+    """
+    if engine is None:
+        from transformers import TextIteratorStreamer
+
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        kwargs = {
+            "input_ids": torch.tensor([input_ids], device=model.device),
+            "max_new_tokens": max_new_tokens,
+            "do_sample": temperature > 0,
+            "streamer": streamer,
+        }
+        if temperature > 0:
+            kwargs["temperature"] = temperature
+        if top_p is not None:
+            kwargs["top_p"] = top_p
+        threading.Thread(target=fallback_generate, args=(model,), kwargs=kwargs, daemon=True).start()
+        for text in streamer:
+            if text:
+                yield text
+        return
+
+    # 增量解码：只解码最近一行的 token，多字节字符未完整时先不输出
+    pending, printed = [], 0
+    for token in engine.stream(input_ids, max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p):
+        pending.append(token)
+        text = tokenizer.decode(pending, skip_special_tokens=True)
+        if text.endswith("\ufffd"):
+            continue
+        delta = text[printed:]
+        if text.endswith("\n"):
+            pending, printed = [], 0
+        else:
+            printed = len(text)
+        if delta:
+            yield delta
+
+
+def openai_sse(deltas, model_name: str):
+    """把文本增量包装成 OpenAI 兼容的 chat.completion.chunk SSE 事件，以 [DONE] 结束"""
+    import json
+    import uuid
+
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    def event(delta: dict, finish_reason: str = None) -> str:
+        chunk = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model_name,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+    yield event({"role": "assistant"})
+    for text in deltas:
+        yield event({"content": text})
+    yield event({}, "stop")
+    yield "data: [DONE]\n\n"
+
+
+def _legacy_cache(past):
+    """新版 transformers 返回 Cache 对象，统一转成 (key, value) 元组"""
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return past
+
+
+def _sample(logits, temperatures: list[float], top_ps: list[float]) -> list[int]:
+    """按行采样：temperature <= 0 的行取 argmax，其余做 temperature + top-p 采样"""
+    temperature = torch.tensor(temperatures, dtype=logits.dtype, device=logits.device)
+    top_p = torch.tensor(top_ps, dtype=logits.dtype, device=logits.device)
+    greedy = logits.argmax(dim=-1)
+    if bool((temperature <= 0).all()):
+        return greedy.tolist()
+
+    probs = torch.softmax(logits / temperature.clamp_min(1e-5)[:, None], dim=-1)
+    sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+    # 去掉累计概率已超过 top_p 之后的 token（至少保留概率最高的一个）
+    sorted_probs[(sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p[:, None]] = 0
+    sampled = sorted_ids.gather(1, torch.multinomial(sorted_probs, 1)).squeeze(1)
+
+    return torch.where(temperature <= 0, greedy, sampled).tolist()
+
+
+def _probs(logits, temperature: float, top_p: float):
+    """与 _sample 相同的 temperature + top-p 处理，返回每行的采样分布"""
+    probs = torch.softmax(logits / max(temperature, 1e-5), dim=-1)
+    sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+    sorted_probs[(sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p] = 0
+    filtered = torch.zeros_like(probs).scatter_(-1, sorted_ids, sorted_probs)
+    return filtered / filtered.sum(dim=-1, keepdim=True)
+
+
+def _resize(probs, size: int):
+    """草稿模型与主模型的词表大小可能因补齐而不同，截断或补零到 size"""
+    if probs.shape[0] >= size:
+        return probs[:size]
+    return torch.nn.functional.pad(probs, (0, size - probs.shape[0]))
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+if __name__ == "__main__":
+    # CPU 自检：随机小模型，各代码路径的贪心输出都应与逐个 model.generate 一致
+    from concurrent.futures import ThreadPoolExecutor
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    def tiny_model(seed: int):
+        torch.manual_seed(seed)
+        config = LlamaConfig(
+            vocab_size=256, hidden_size=64, intermediate_size=128,
+            num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+        )
+        return LlamaForCausalLM(config).eval()
+
+    def expected_output(model, prompt: list[int], max_new_tokens: int) -> list[int]:
+        eos = model.config.eos_token_id
+        expected = model.generate(
+            torch.tensor([prompt]), max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=0
+        )[0, len(prompt):].tolist()
+        return expected[:expected.index(eos)] if eos in expected else expected
+
+    model = tiny_model(0)
+    eos_token_ids = [model.config.eos_token_id]
+    torch.manual_seed(1)
+    prompts = [[int(t) for t in torch.randint(3, 256, (n,))] for n in (5, 17, 3, 30, 11, 9)]
+
+    # 1. 连续批处理 + 抢占：缓存池只有 12 页，4 个并发请求放不下，最晚加入的请求会被抢占后重新 prefill
+    engine = LLMEngine(model, eos_token_ids, max_batch_size=4, max_cache_tokens=96, block_size=8)
+    with ThreadPoolExecutor(len(prompts)) as pool:
+        outputs = list(pool.map(lambda p: engine.generate(p, max_new_tokens=24, temperature=0), prompts))
+    for prompt, output in zip(prompts, outputs):
+        assert output == expected_output(model, prompt, 24), (prompt, output)
+    assert engine.stats()["preemptions"] > 0, engine.stats()
+    print(f"✓ 并发批处理与抢占: {engine.stats()['preemptions']} 次抢占，输出与 model.generate 一致")
+
+    # 2. 前缀缓存：多轮对话的下一轮复用上一轮已写满的缓存页
+    engine = LLMEngine(model, eos_token_ids, max_cache_tokens=512, block_size=8)
+    first = prompts[3]
+    reply = engine.generate(first, max_new_tokens=8, temperature=0)
+    follow_up = first + reply + prompts[0]
+    output = engine.generate(follow_up, max_new_tokens=8, temperature=0)
+    assert output == expected_output(model, follow_up, 8), output
+    hit_tokens = engine.stats()["prefix_hit_tokens"]
+    assert hit_tokens >= len(first) // 8 * 8, engine.stats()
+    print(f"✓ 前缀缓存: 第二轮复用 {hit_tokens} 个 token，输出一致")
+
+    # 3. 投机解码：草稿与主模型相同时全部接受；草稿不同时部分拒绝，贪心输出仍与主模型一致
+    engine = LLMEngine(model, eos_token_ids, max_cache_tokens=512, block_size=8, draft_model=model)
+    output = engine.generate(prompts[1], max_new_tokens=16, temperature=0)
+    stats = engine.stats()
+    assert output == expected_output(model, prompts[1], 16), output
+    assert stats["spec_rounds"] > 0 and stats["spec_accepted"] == stats["spec_proposed"], stats
+    print(f"✓ 投机解码（相同草稿）: {stats['spec_rounds']} 轮，接受率 {stats['spec_acceptance_rate']:.0%}")
+
+    engine = LLMEngine(model, eos_token_ids, max_cache_tokens=512, block_size=8, draft_model=tiny_model(1))
+    for prompt in prompts[:3]:
+        output = engine.generate(prompt, max_new_tokens=16, temperature=0)
+        assert output == expected_output(model, prompt, 16), (prompt, output)
+    engine.generate(prompts[4], max_new_tokens=16, temperature=1.0)  # 采样请求走拒绝采样路径
+    stats = engine.stats()
+    assert stats["spec_rounds"] > 0 and stats["spec_accepted"] < stats["spec_proposed"], stats
+    print(f"✓ 投机解码（不同草稿）: {stats['spec_rounds']} 轮，接受率 {stats['spec_acceptance_rate']:.0%}，输出一致")
@@ -0,0 +1,183 @@
+"""
+模型快照：加速 LLM 服务冷启动
+供 ai-llm/*_service.py 共用
+
+首次启动按原方式从 Hub 缓存加载（8-bit 时会现场量化），随后把已量化、可直接上卡的权重
+以 safetensors 分片保存到模型 Volume，并写入 snapshot.json 清单。
+之后的冷启动直接内存映射这些分片加载，跳过量化；加载前并行预读分片，填充页缓存。
+
+快照目录: <cache_dir>/snapshots/<模型名>-<int8|fp16>/
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+SNAPSHOT_SHARD_SIZE = "2GB"     # 单个 safetensors 分片大小
+PREFETCH_WORKERS = 8            # 并行预读分片的线程数，设为 0 关闭预读
+PREFETCH_CHUNK = 64 * 1024 * 1024
+SNAPSHOT_TMP_MAX_AGE_S = 6 * 3600  # 超过该时间未更新的 <快照>.tmp-* 目录视为保存中途崩溃留下的，清理掉
+
+
+def load_model(
+    model_name: str,
+    volume,
+    cache_dir: str = "/models",
+    load_in_8bit: bool = True,
+    trust_remote_code: bool = False,
+    prefetch_workers: int = PREFETCH_WORKERS,
+):
+    """
+    加载模型和 tokenizer，优先使用 Volume 上的快照
+
+    Args:
+        model_name: Hub 模型名
+        volume: 模型所在的 modal.Volume，保存快照后 commit
+        cache_dir: Volume 挂载目录
+        load_in_8bit: 是否 8-bit 量化
+        trust_remote_code: 是否信任模型仓库中的代码
+
+    Returns:
+        (model, tokenizer, info)，info 包含加载来源和耗时，快照加载时附带首次加载的耗时作对比
+    """
+    import torch
+    import transformers
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tag = "int8" if load_in_8bit else "fp16"
+    path = os.path.join(cache_dir, "snapshots", f"{model_name.replace('/', '--')}-{tag}")
+    manifest = _read_manifest(path, transformers.__version__)
+
+    start = time.monotonic()
+    if manifest is not None:
+        print(f"📦 从快照加载: {path}")
+        if prefetch_workers:
+            _prefetch([os.path.join(path, shard) for shard in manifest["shards"]], prefetch_workers)
+        tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=trust_remote_code)
+        model = AutoModelForCausalLM.from_pretrained(
+            path,
+            torch_dtype=torch.float16,
+            device_map="auto",
+            trust_remote_code=trust_remote_code,
+        )
+        seconds = time.monotonic() - start
+        print(f"⏱️ 快照加载耗时 {seconds:.1f}s（首次从 Hub 加载 {manifest['load_seconds']:.1f}s）")
+        return model, tokenizer, {
+            "source": "snapshot",
+            "load_seconds": seconds,
+            "baseline_load_seconds": manifest["load_seconds"],
+        }
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_name, cache_dir=cache_dir, trust_remote_code=trust_remote_code
+    )
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch.float16,
+        device_map="auto",
+        cache_dir=cache_dir,
+        trust_remote_code=trust_remote_code,
+        load_in_8bit=load_in_8bit,
+    )
+    seconds = time.monotonic() - start
+    print(f"⏱️ 从 Hub 缓存加载耗时 {seconds:.1f}s")
+
+    try:
+        _save_snapshot(model, tokenizer, path, model_name, tag, seconds, transformers.__version__)
+        volume.commit()
+    except Exception as e:
+        print(f"⚠️ 保存快照失败，下次仍从 Hub 缓存加载: {e}")
+
+    return model, tokenizer, {"source": "hub", "load_seconds": seconds}
+
+
+def _read_manifest(path: str, transformers_version: str, verbose: bool = True):
+    """读取快照清单，清单缺失、分片不全或 transformers 版本不同时返回 None"""
+    try:
+        with open(os.path.join(path, "snapshot.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("transformers") != transformers_version:
+        if verbose:
+            print(f"⚠️ 快照由 transformers {manifest.get('transformers')} 生成，当前版本不同，重新生成")
+        return None
+    if not all(os.path.exists(os.path.join(path, shard)) for shard in manifest["shards"]):
+        return None
+    return manifest
+
+
+def _save_snapshot(model, tokenizer, path: str, model_name: str, tag: str, load_seconds: float,
+                   transformers_version: str):
+    """
+    先写到临时目录再改名，多个容器同时冷启动时只有一个快照生效
+    已有快照失效（版本不同、分片不全）时先移走再删除，之后重新生成
+    """
+    _remove_abandoned(path)
+    if os.path.exists(path):
+        if _read_manifest(path, transformers_version, verbose=False) is not None:
+            return  # 其他容器刚保存了有效快照
+        stale_path = f"{path}.stale-{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(path, stale_path)
+        except OSError:
+            return  # 其他容器已经移走了
+        shutil.rmtree(stale_path, ignore_errors=True)
+        print(f"🗑️ 已删除失效快照: {path}")
+
+    print(f"💾 保存快照: {path}")
+    start = time.monotonic()
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    model.save_pretrained(tmp_path, safe_serialization=True, max_shard_size=SNAPSHOT_SHARD_SIZE)
+    tokenizer.save_pretrained(tmp_path)
+
+    shards = sorted(name for name in os.listdir(tmp_path) if name.endswith(".safetensors"))
+    manifest = {
+        "model": model_name,
+        "quantization": tag,
+        "transformers": transformers_version,
+        "shards": shards,
+        "size_bytes": sum(os.path.getsize(os.path.join(tmp_path, name)) for name in shards),
+        "load_seconds": load_seconds,
+        "created_at": time.time(),
+    }
+    with open(os.path.join(tmp_path, "snapshot.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    print(f"✓ 快照已保存: {len(shards)} 个分片, {manifest['size_bytes'] / 1024**3:.1f} GB, 耗时 {time.monotonic() - start:.1f}s")
+
+
+def _remove_abandoned(path: str):
+    """清理保存或删除中途崩溃留下的 <path>.tmp-* / <path>.stale-* 目录；正在保存的临时目录仍在更新，不会被删"""
+    parent, name = os.path.split(path)
+    if not os.path.isdir(parent):
+        return
+    now = time.time()
+    for entry in os.listdir(parent):
+        full = os.path.join(parent, entry)
+        if entry.startswith(f"{name}.stale-"):
+            shutil.rmtree(full, ignore_errors=True)
+        elif entry.startswith(f"{name}.tmp-") and now - os.path.getmtime(full) > SNAPSHOT_TMP_MAX_AGE_S:
+            shutil.rmtree(full, ignore_errors=True)
+            print(f"🗑️ 清理中断的快照临时目录: {entry}")
+
+
+def _prefetch(files: list[str], workers: int):
+    """并行顺序读取分片，让随后的内存映射加载命中页缓存"""
+    def read(file):
+        with open(file, "rb", buffering=0) as f:
+            while f.read(PREFETCH_CHUNK):
+                pass
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(read, files))
+    print(f"✓ 预读 {len(files)} 个分片，耗时 {time.monotonic() - start:.1f}s")
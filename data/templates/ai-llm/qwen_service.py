@@ -24,6 +24,10 @@ image = (
 
 model_volume = modal.Volume.from_name("qwen-models", create_if_missing=True)
 
+# 投机解码为可选模式，默认关闭；设为 True 时加载草稿模型（与主模型共用 tokenizer）
+SPECULATIVE_DECODING = False
+DRAFT_MODEL = "Qwen/Qwen2-0.5B-Instruct"
+
 
 @app.cls(
     image=image,
@@ -31,34 +35,36 @@ model_volume = modal.Volume.from_name("qwen-models", create_if_missing=True)
     volumes={"/models": model_volume},
     timeout=600,
     container_idle_timeout=300,
+    mounts=[modal.Mount.from_local_python_packages("llm_engine", "model_snapshot")],
 )
+@modal.concurrent(max_inputs=64)  # 并发请求由连续批处理引擎合并解码；引擎不可用时回退路径串行执行
 class QwenChat:
     @modal.enter()
     def load_model(self):
-        from transformers import AutoModelForCausalLM, AutoTokenizer
-        import torch
+        from model_snapshot import load_model
         
         print("🤖 加载 Qwen 模型...")
         
         # Qwen2-7B-Instruct 或 Qwen1.5-14B-Chat
         model_name = "Qwen/Qwen2-7B-Instruct"
         
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            model_name,
-            cache_dir="/models",
-            trust_remote_code=True
-        )
-        
-        self.model = AutoModelForCausalLM.from_pretrained(
+        # 首次加载后把 8-bit 权重保存为快照，之后冷启动直接加载量化好的分片
+        self.model, self.tokenizer, self.load_info = load_model(
             model_name,
-            torch_dtype=torch.float16,
-            device_map="auto",
+            model_volume,
             cache_dir="/models",
-            trust_remote_code=True,
             load_in_8bit=True,
+            trust_remote_code=True,
         )
         
         print("✓ Qwen 模型加载完成")
+
+        # 连续批处理引擎，模型不兼容时回退到 model.generate
+        from llm_engine import create_engine
+        self.engine = create_engine(
+            self.model, self.tokenizer, draft_model_name=DRAFT_MODEL if SPECULATIVE_DECODING else None
+        )
+
     
     @modal.method()
     def chat(
@@ -76,24 +82,65 @@ class QwenChat:
         
         inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
         
-        outputs = self.model.generate(
-            **inputs,
-            max_new_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            do_sample=True,
-        )
+        if self.engine is not None:
+            generated_ids = self.engine.generate(
+                inputs.input_ids[0].tolist(),
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+            )
+        else:
+            from llm_engine import fallback_generate
+            outputs = fallback_generate(self.model, 
+                **inputs,
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                do_sample=True,
+            )
+            generated_ids = outputs[0][len(inputs.input_ids[0]):]
         
-        generated_ids = outputs[0][len(inputs.input_ids[0]):]
         response = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
         
         return response.strip()
 
+    @modal.method()
+    def chat_stream(self, messages: list[dict], max_tokens: int = 1024, temperature: float = 0.7, top_p: float = 0.9):
+        """流式对话：逐段产出 OpenAI 兼容的 SSE 事件（chat.completion.chunk）"""
+        from llm_engine import openai_sse, stream_chat
+        
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        input_ids = self.tokenizer(text).input_ids
+        deltas = stream_chat(self.model, self.tokenizer, self.engine, input_ids, max_tokens, temperature, top_p)
+        yield from openai_sse(deltas, "qwen2-7b")
+
+    @modal.method()
+    def stats(self) -> dict:
+        """连续批处理引擎指标（tokens/s、排队等待、批大小、KV 缓存占用、投机接受率）和冷启动耗时"""
+        if self.engine is None:
+            return {"engine": "disabled", "cold_start": self.load_info}
+        return {**self.engine.stats(), "cold_start": self.load_info}
+
 
 @app.function(image=image)
 @modal.web_endpoint(method="POST")
 def chat_api(data: dict):
+    """
+    OpenAI 兼容的对话接口，"stream": true 时以 SSE 逐段返回
+    """
     qwen = QwenChat()
+    if data.get("stream"):
+        from fastapi.responses import StreamingResponse
+        
+        return StreamingResponse(
+            qwen.chat_stream.remote_gen(
+                messages=data.get("messages", []),
+                max_tokens=data.get("max_tokens", 1024),
+                temperature=data.get("temperature", 0.7),
+            ),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
     response = qwen.chat.remote(
         messages=data.get("messages", []),
         max_tokens=data.get("max_tokens", 1024),
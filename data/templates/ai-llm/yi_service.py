@@ -24,6 +24,9 @@ image = (
 
 model_volume = modal.Volume.from_name("yi-models", create_if_missing=True)
 
+# 投机解码的草稿模型（须与主模型共用 tokenizer），Yi 没有足够小的同系列模型，默认关闭
+DRAFT_MODEL = None
+
 
 @app.cls(
     image=image,
@@ -31,7 +34,9 @@ model_volume = modal.Volume.from_name("yi-models", create_if_missing=True)
     volumes={"/models": model_volume},
     timeout=600,
     container_idle_timeout=300,
+    mounts=[modal.Mount.from_local_python_packages("llm_engine")],
 )
+@modal.concurrent(max_inputs=64)  # 并发请求由连续批处理引擎合并解码；引擎不可用时回退路径串行执行
 class YiChat:
     @modal.enter()
     def load_model(self):
@@ -46,6 +51,11 @@ class YiChat:
             model_name, torch_dtype=torch.float16, device_map="auto", cache_dir="/models", trust_remote_code=True, load_in_8bit=True
         )
         print("✓ Yi 模型加载完成")
+
+        # 连续批处理引擎，模型不兼容时回退到 model.generate
+        from llm_engine import create_engine
+        self.engine = create_engine(self.model, self.tokenizer, draft_model_name=DRAFT_MODEL)
+
     
     @modal.method()
     def chat(self, messages: list[dict], max_tokens: int = 1024, temperature: float = 0.7) -> str:
@@ -53,16 +63,54 @@ class YiChat:
             messages, tokenize=True, add_generation_prompt=True, return_tensors="pt"
         ).to(self.model.device)
         
-        outputs = self.model.generate(
-            input_ids, max_new_tokens=max_tokens, temperature=temperature, do_sample=True, eos_token_id=self.tokenizer.eos_token_id
-        )
-        return self.tokenizer.decode(outputs[0][input_ids.shape[1]:], skip_special_tokens=True).strip()
+        if self.engine is not None:
+            generated_ids = self.engine.generate(
+                input_ids[0].tolist(), max_new_tokens=max_tokens, temperature=temperature
+            )
+        else:
+            from llm_engine import fallback_generate
+            outputs = fallback_generate(self.model, 
+                input_ids, max_new_tokens=max_tokens, temperature=temperature, do_sample=True, eos_token_id=self.tokenizer.eos_token_id
+            )
+            generated_ids = outputs[0][input_ids.shape[1]:]
+        return self.tokenizer.decode(generated_ids, skip_special_tokens=True).strip()
+
+    @modal.method()
+    def chat_stream(self, messages: list[dict], max_tokens: int = 1024, temperature: float = 0.7):
+        """流式对话：逐段产出 OpenAI 兼容的 SSE 事件（chat.completion.chunk）"""
+        from llm_engine import openai_sse, stream_chat
+        
+        input_ids = self.tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)
+        deltas = stream_chat(self.model, self.tokenizer, self.engine, input_ids, max_tokens, temperature)
+        yield from openai_sse(deltas, "yi-1.5-9b")
+
+    @modal.method()
+    def stats(self) -> dict:
+        """连续批处理引擎指标：tokens/s、排队等待、批大小、KV 缓存占用和投机接受率"""
+        if self.engine is None:
+            return {"engine": "disabled"}
+        return self.engine.stats()
 
 
 @app.function(image=image)
 @modal.web_endpoint(method="POST")
 def chat_api(data: dict):
+    """
+    OpenAI 兼容的对话接口，"stream": true 时以 SSE 逐段返回
+    """
     yi = YiChat()
+    if data.get("stream"):
+        from fastapi.responses import StreamingResponse
+        
+        return StreamingResponse(
+            yi.chat_stream.remote_gen(
+                messages=data.get("messages", []),
+                max_tokens=data.get("max_tokens", 1024),
+                temperature=data.get("temperature", 0.7),
+            ),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
     response = yi.chat.remote(messages=data.get("messages", []), max_tokens=data.get("max_tokens", 1024))
     return {"choices": [{"message": {"role": "assistant", "content": response}}], "model": "yi-1.5-9b"}
 
@@ -42,6 +42,39 @@ app = modal.App("comfyui-node-manager", image=image)
 # Custom Nodes 存储路径
 CUSTOM_NODES_PATH = "/cache/custom_nodes"
 
+# 链接清单 - comfyui_app.py 启动时据此增量链接节点
+LINK_MANIFEST_PATH = Path("/cache/.link_manifest.json")
+
+
+def _refresh_link_manifest():
+    """
+    刷新链接清单中 custom_nodes 目录的条目
+    comfyui_app.py 启动时只需读取清单，无需遍历整个 Volume
+    """
+    try:
+        manifest = json.loads(LINK_MANIFEST_PATH.read_text())
+        if manifest.get("version") != 1:
+            raise ValueError("unsupported manifest version")
+    except (OSError, ValueError):
+        manifest = {"version": 1, "dirs": {}, "entries": {}}
+    
+    nodes_dir = Path(CUSTOM_NODES_PATH)
+    entries = {
+        k: v for k, v in manifest["entries"].items()
+        if not k.startswith("custom_nodes/")
+    }
+    for node_dir in nodes_dir.iterdir():
+        if node_dir.is_dir() and not node_dir.name.startswith('.'):
+            st = node_dir.stat()
+            entries[f"custom_nodes/{node_dir.name}"] = [st.st_size, int(st.st_mtime)]
+    
+    manifest["entries"] = entries
+    manifest["dirs"]["custom_nodes"] = nodes_dir.stat().st_mtime_ns
+    
+    tmp_path = LINK_MANIFEST_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, separators=(",", ":")))
+    os.replace(tmp_path, LINK_MANIFEST_PATH)
+
 
 @app.function(
     volumes={"/cache": vol},
@@ -128,6 +161,7 @@ def install_node(repo_url: str, branch: str = "main"):
         with open(info_file, 'w') as f:
             json.dump(install_info, f, indent=2)
         
+        _refresh_link_manifest()
         vol.commit()
         print("✓ 已保存到 Volume\n")
         
@@ -213,6 +247,7 @@ def remove_node(node_name: str):
     
     try:
         shutil.rmtree(node_path)
+        _refresh_link_manifest()
         vol.commit()
         print(f"✅ 节点已删除: {node_name}")
         print(f"\n📌 请重启 ComfyUI 服务使更改生效")
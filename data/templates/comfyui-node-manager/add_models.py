@@ -51,6 +51,9 @@ app = modal.App("comfyui-model-manager", image=image)
 # 模型存储路径
 MODELS_PATH = "/cache/models"
 
+# 链接清单 - comfyui_app.py 启动时据此增量链接模型
+LINK_MANIFEST_PATH = Path("/cache/.link_manifest.json")
+
 # 支持的模型类型
 VALID_MODEL_TYPES = [
     "checkpoints", "loras", "vae", "clip", 
@@ -58,6 +61,38 @@ VALID_MODEL_TYPES = [
 ]
 
 
+def _refresh_link_manifest(model_type: str):
+    """
+    刷新链接清单中指定模型类型目录的条目
+    comfyui_app.py 启动时只需读取清单，无需遍历整个 Volume
+    """
+    try:
+        manifest = json.loads(LINK_MANIFEST_PATH.read_text())
+        if manifest.get("version") != 1:
+            raise ValueError("unsupported manifest version")
+    except (OSError, ValueError):
+        manifest = {"version": 1, "dirs": {}, "entries": {}}
+    
+    rel_dir = f"models/{model_type}"
+    target_dir = Path(MODELS_PATH) / model_type
+    entries = {
+        k: v for k, v in manifest["entries"].items()
+        if not k.startswith(f"{rel_dir}/")
+    }
+    for model_file in target_dir.iterdir():
+        if model_file.name.startswith('.'):
+            continue
+        st = model_file.stat() if model_file.exists() else model_file.lstat()
+        entries[f"{rel_dir}/{model_file.name}"] = [st.st_size, int(st.st_mtime)]
+    
+    manifest["entries"] = entries
+    manifest["dirs"][rel_dir] = target_dir.stat().st_mtime_ns
+    
+    tmp_path = LINK_MANIFEST_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, separators=(",", ":")))
+    os.replace(tmp_path, LINK_MANIFEST_PATH)
+
+
 @app.function(
     volumes={"/cache": vol},
     timeout=1800  # 30分钟超时，大模型可能需要较长时间
@@ -126,6 +161,7 @@ def download_from_huggingface(repo_id: str, filename: str, model_type: str):
         with open(info_file, 'w') as f:
             json.dump(info, f, indent=2)
         
+        _refresh_link_manifest(model_type)
         vol.commit()
         print(f"✓ 已保存到 Volume\n")
         
@@ -225,6 +261,7 @@ def download_from_url(url: str, filename: str, model_type: str):
         with open(info_file, 'w') as f:
             json.dump(info, f, indent=2)
         
+        _refresh_link_manifest(model_type)
         vol.commit()
         print(f"✓ 已保存到 Volume\n")
         
@@ -337,6 +374,7 @@ def remove_model(model_type: str, filename: str):
         if info_file.exists():
             info_file.unlink()
         
+        _refresh_link_manifest(model_type)
         vol.commit()
         print(f"✅ 模型已删除: {filename}")
         print(f"\n📌 请重启 ComfyUI 服务使更改生效")
@@ -12,10 +12,20 @@ S6: API 服务 - 提供 REST API 接口
 部署命令: modal deploy comfyui_app.py
 =============================================================================
 """
+import base64
+import hashlib
 import json
 import os
+import queue
+import shutil
 import subprocess
+import sys
+import sysconfig
+import threading
+import time
 import uuid
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict
 
@@ -32,6 +42,7 @@ image = (
     .pip_install("fastapi[standard]==0.115.4")
     .pip_install("comfy-cli==1.5.1")
     .pip_install("requests==2.32.3")
+    .pip_install("websocket-client==1.8.0")
     .pip_install("huggingface_hub[hf_transfer]==0.34.4")
     # S1.2: 安装 ComfyUI
     .run_commands("comfy --skip-prompt install --fast-deps --nvidia --version 0.3.59")
@@ -67,125 +78,214 @@ except modal.exception.NotFoundError:
     hf_secret = None
 
 
+# S3.2: 模型清单 - 每一项描述一个需要下载的文件
+# - repo_id / filename: HuggingFace 仓库和仓库内路径
+# - model_type: ComfyUI models 下的子目录 (checkpoints, clip, vae, loras ...)
+# - local_name: 链接到 ComfyUI 时使用的文件名
+# - sha256: 可选，期望的文件哈希；留空时使用 HuggingFace 返回的 LFS 哈希
+MODEL_MANIFEST = [
+    # Flux 基础模型
+    {
+        "repo_id": "Comfy-Org/flux1-dev",
+        "filename": "flux1-dev-fp8.safetensors",
+        "model_type": "checkpoints",
+        "local_name": "flux1-dev-fp8.safetensors",
+    },
+    # Clip 模型
+    {
+        "repo_id": "stabilityai/stable-diffusion-3-medium",
+        "filename": "text_encoders/clip_g.safetensors",
+        "model_type": "clip",
+        "local_name": "clip_g.safetensors",
+    },
+    {
+        "repo_id": "stabilityai/stable-diffusion-3-medium",
+        "filename": "text_encoders/clip_l.safetensors",
+        "model_type": "clip",
+        "local_name": "clip_l.safetensors",
+    },
+    {
+        "repo_id": "stabilityai/stable-diffusion-3-medium",
+        "filename": "text_encoders/t5xxl_fp8_e4m3fn.safetensors",
+        "model_type": "clip",
+        "local_name": "t5xxl_fp8_e4m3fn.safetensors",
+    },
+    # VAE 模型
+    {
+        "repo_id": "black-forest-labs/FLUX.1-dev",
+        "filename": "ae.safetensors",
+        "model_type": "vae",
+        "local_name": "ae.safetensors",
+    },
+    # LoRA 模型
+    {
+        "repo_id": "UmeAiRT/FLUX.1-dev-LoRA-Ume_Sky",
+        "filename": "ume_sky_v2.safetensors",
+        "model_type": "loras",
+        "local_name": "ume_sky_v2.safetensors",
+    },
+    {
+        "repo_id": "Shakker-Labs/FLUX.1-dev-LoRA-Dark-Fantasy",
+        "filename": "FLUX.1-dev-lora-Dark-Fantasy.safetensors",
+        "model_type": "loras",
+        "local_name": "FLUX.1-dev-lora-Dark-Fantasy.safetensors",
+    },
+]
+
+# S3.3: 下载引擎参数
+DOWNLOAD_WORKERS = 4              # 并发下载的文件数
+DOWNLOAD_RETRIES = 3              # 单个文件的最大重试次数（每次从断点续传）
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+CACHE_ROOT = Path("/cache")
+CACHE_MODELS_DIR = "/cache/models"
+LINK_MANIFEST_PATH = CACHE_ROOT / ".link_manifest.json"
+NODE_DEPS_DIR = CACHE_ROOT / "node_deps"
+NODE_DEPS_LAYER_TTL_S = 7 * 24 * 3600  # 依赖层超过该时间未被任何容器使用时删除（含构建中断留下的临时目录）
+COMFY_MODELS_DIR = "/root/comfy/ComfyUI/models"
+
+
 def download_models():
     """
-    S3: 下载所需的 AI 模型文件
-    - 从 HuggingFace 下载基础模型
-    - 从 URL 下载额外模型
+    S3: 按 MODEL_MANIFEST 并发下载所需的 AI 模型文件
+    - 有界线程池并发下载，单个文件失败不影响其他文件
+    - 下载中断后从 .part 文件断点续传 (HTTP Range)
+    - 下载过程中流式计算 sha256 并校验
+    - 进程内创建符号链接，不再调用 ln -s
+    - 输出每个文件的吞吐量，便于定位慢速来源
     """
-    from huggingface_hub import hf_hub_download
-    
     hf_token = os.getenv("HF_TOKEN")
     print(f"🔑 S3.0: HuggingFace Token 状态: {'已配置' if hf_token else '未配置'}")
-    
-    # S3.1: 下载 Flux 基础模型
-    print("📥 S3.1: 下载 Flux 基础模型...")
-    try:
-        flux_model = hf_hub_download(
-            repo_id="Comfy-Org/flux1-dev",
-            filename="flux1-dev-fp8.safetensors",
-            cache_dir="/cache",
-        )
-        subprocess.run(
-            f"ln -s {flux_model} /root/comfy/ComfyUI/models/checkpoints/flux1-dev-fp8.safetensors",
-            shell=True,
-            check=True,
-        )
-        print("✅ Flux 模型下载成功")
-    except Exception as e:
-        print(f"⚠️ Flux 模型下载失败: {e}")
-    
-    # S3.2: 下载 Clip 模型
-    print("📥 S3.2: 下载 Clip 模型...")
-    clip_models = [
-        {
-            "repo_id": "stabilityai/stable-diffusion-3-medium",
-            "filename": "text_encoders/clip_g.safetensors",
-            "local_name": "clip_g.safetensors"
-        },
-        {
-            "repo_id": "stabilityai/stable-diffusion-3-medium",
-            "filename": "text_encoders/clip_l.safetensors",
-            "local_name": "clip_l.safetensors"
-        },
-        {
-            "repo_id": "stabilityai/stable-diffusion-3-medium",
-            "filename": "text_encoders/t5xxl_fp8_e4m3fn.safetensors",
-            "local_name": "t5xxl_fp8_e4m3fn.safetensors"
+    print(f"📥 S3.1: 并发下载 {len(MODEL_MANIFEST)} 个模型 (workers={DOWNLOAD_WORKERS})...")
+
+    reports = []
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        futures = {
+            pool.submit(_download_manifest_entry, entry, hf_token): entry
+            for entry in MODEL_MANIFEST
         }
-    ]
-    
-    clip_dir = "/root/comfy/ComfyUI/models/clip"
-    os.makedirs(clip_dir, exist_ok=True)
-    
-    for clip_model in clip_models:
-        try:
-            print(f"  📦 下载: {clip_model['filename']}")
-            clip_path = hf_hub_download(
-                repo_id=clip_model["repo_id"],
-                filename=clip_model["filename"],
-                cache_dir="/cache",
-                token=hf_token
-            )
-            subprocess.run(
-                f"ln -s {clip_path} {clip_dir}/{clip_model['local_name']}",
-                shell=True,
-                check=True
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                report = future.result()
+            except Exception as e:
+                report = {"name": entry["local_name"], "status": "failed", "error": str(e)}
+                print(f"  ⚠️ 下载失败: {entry['repo_id']}/{entry['filename']}: {e}")
+            reports.append(report)
+
+    # 吞吐量汇总
+    print("📊 S3.4: 下载汇总:")
+    for r in sorted(reports, key=lambda r: r.get("mb_per_s", 0)):
+        if r["status"] == "failed":
+            print(f"   ❌ {r['name']}: {r['error']}")
+        elif r["status"] == "cached":
+            print(f"   ♻️ {r['name']}: 已存在，跳过")
+        else:
+            print(
+                f"   ✅ {r['name']}: {r['bytes'] / (1024 * 1024):.1f} MB, "
+                f"{r['seconds']:.1f}s, {r['mb_per_s']:.1f} MB/s"
             )
-        except Exception as e:
-            print(f"  ⚠️ 下载失败: {e}")
     
-    # S3.3: 下载 VAE 模型
-    print("📥 S3.3: 下载 VAE 模型...")
-    try:
-        vae_model = hf_hub_download(
-            repo_id="black-forest-labs/FLUX.1-dev",
-            filename="ae.safetensors",
-            cache_dir="/cache",
-            token=hf_token
-        )
-        subprocess.run(
-            f"ln -s {vae_model} /root/comfy/ComfyUI/models/vae/ae.safetensors",
-            shell=True,
-            check=True,
-        )
-        print("✅ VAE 模型下载成功")
-    except Exception as e:
-        print(f"⚠️ VAE 模型下载失败: {e}")
-    
-    # S3.4: 下载 LoRA 模型
-    print("📥 S3.4: 下载 LoRA 模型...")
-    lora_models = [
-        {
-            "repo_id": "UmeAiRT/FLUX.1-dev-LoRA-Ume_Sky",
-            "filename": "ume_sky_v2.safetensors",
-            "local_name": "ume_sky_v2.safetensors"
-        },
-        {
-            "repo_id": "Shakker-Labs/FLUX.1-dev-LoRA-Dark-Fantasy",
-            "filename": "FLUX.1-dev-lora-Dark-Fantasy.safetensors",
-            "local_name": "FLUX.1-dev-lora-Dark-Fantasy.safetensors"
-        },
-    ]
-    
-    lora_dir = "/root/comfy/ComfyUI/models/loras"
-    os.makedirs(lora_dir, exist_ok=True)
-    
-    for lora in lora_models:
+    # 刷新 Volume 上的链接清单，容器启动时据此增量链接
+    manifest = _load_link_manifest()
+    if _sync_link_manifest(manifest):
+        _save_link_manifest(manifest)
+    return reports
+
+
+def _download_manifest_entry(entry: Dict, hf_token: str = None) -> Dict:
+    """下载清单中的单个文件并链接到 ComfyUI 目录，返回吞吐量报告"""
+    import requests
+    from huggingface_hub import get_hf_file_metadata, hf_hub_url
+
+    name = entry["local_name"]
+    target_dir = Path(CACHE_MODELS_DIR) / entry["model_type"]
+    target_dir.mkdir(parents=True, exist_ok=True)
+    target = target_dir / name
+    part = target_dir / f".{name}.part"
+
+    url = hf_hub_url(repo_id=entry["repo_id"], filename=entry["filename"])
+    meta = get_hf_file_metadata(url, token=hf_token)
+    total = meta.size or 0
+    expected_sha = entry.get("sha256") or _lfs_sha256(meta.etag)
+
+    # 已完整下载：直接链接
+    if target.exists() and (not total or target.stat().st_size == total):
+        _symlink_force(target, Path(COMFY_MODELS_DIR) / entry["model_type"] / name)
+        return {"name": name, "status": "cached"}
+
+    headers = {"Authorization": f"Bearer {hf_token}"} if hf_token else {}
+    start = time.monotonic()
+    fetched = 0
+
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        # 先对已有的 .part 内容做一次流式哈希，再从断点继续
+        sha = hashlib.sha256()
+        offset = 0
+        if part.exists():
+            with part.open("rb") as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    sha.update(chunk)
+                    offset += len(chunk)
+
+        if total and offset >= total:
+            break
+
+        range_headers = dict(headers)
+        if offset:
+            range_headers["Range"] = f"bytes={offset}-"
+            print(f"  🔁 续传 {name}: 从 {offset / (1024 * 1024):.1f} MB 处继续 (第 {attempt} 次)")
+        else:
+            print(f"  📦 下载: {entry['repo_id']}/{entry['filename']}")
+
         try:
-            print(f"  📦 下载 LoRA: {lora['repo_id']}")
-            lora_path = hf_hub_download(
-                repo_id=lora["repo_id"],
-                filename=lora["filename"],
-                cache_dir="/cache",
-            )
-            subprocess.run(
-                f"ln -s {lora_path} {lora_dir}/{lora['local_name']}",
-                shell=True,
-                check=True
-            )
-        except Exception as e:
-            print(f"  ⚠️ LoRA 下载失败: {e}")
+            with requests.get(url, headers=range_headers, stream=True, timeout=60) as resp:
+                resp.raise_for_status()
+                # 服务器不支持 Range 时从头开始
+                mode = "ab" if offset and resp.status_code == 206 else "wb"
+                if mode == "wb" and offset:
+                    sha = hashlib.sha256()
+                with part.open(mode) as f:
+                    for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        sha.update(chunk)
+                        fetched += len(chunk)
+            break
+        except requests.RequestException as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            print(f"  ⚠️ {name} 下载中断: {e}，准备续传...")
+
+    if expected_sha and sha.hexdigest() != expected_sha:
+        part.unlink()
+        raise Exception(f"sha256 校验失败: 期望 {expected_sha}, 实际 {sha.hexdigest()}")
+
+    os.replace(part, target)
+    _symlink_force(target, Path(COMFY_MODELS_DIR) / entry["model_type"] / name)
+
+    seconds = max(time.monotonic() - start, 1e-6)
+    return {
+        "name": name,
+        "status": "downloaded",
+        "bytes": fetched,
+        "seconds": seconds,
+        "mb_per_s": fetched / (1024 * 1024) / seconds,
+        "sha256": sha.hexdigest(),
+    }
+
+
+def _lfs_sha256(etag: str):
+    """HuggingFace 对 LFS 文件返回的 ETag 即为 sha256，非 LFS 文件返回 None"""
+    if etag and len(etag) == 64 and all(c in "0123456789abcdef" for c in etag):
+        return etag
+    return None
+
+
+def _symlink_force(src: Path, dst: Path):
+    """在进程内创建符号链接，已存在的链接会被替换"""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.is_symlink() or dst.exists():
+        dst.unlink()
+    os.symlink(src, dst)
 
 
 # =============================================================================
@@ -197,6 +297,9 @@ print("🔧 S4: 配置 Modal 服务...")
 # S4.1: 创建持久化存储卷
 vol = modal.Volume.from_name("comfyui-cache", create_if_missing=True)
 
+# S4.1: 取消标记 - 流式任务可能运行在任意容器中，通过共享 Dict 通知取消
+cancel_flags = modal.Dict.from_name("comfyui-cancel-flags", create_if_missing=True)
+
 # S4.2: 完成镜像构建，执行模型下载
 image = (
     image
@@ -246,12 +349,36 @@ def ui():
 # S6: API 服务阶段
 # =============================================================================
 
+# S6.0: 推理参数
+COMFY_OUTPUT_DIR = "/root/comfy/ComfyUI/output"
+COMFY_PROMPT_TIMEOUT = 1200  # 单个 prompt 的最长执行时间（秒），超时后中断该 prompt
+PROMPT_POLL_INTERVAL_S = 5.0  # 等待 prompt 时 websocket 单次读取的超时，也是检查总超时的间隔
+DEFAULT_WORKFLOW_PATH = "/root/workflow_api.json"
+WORKFLOW_DIRS = ["/root/workflows", "/cache/workflows"]  # 命名工作流目录，文件名即工作流名称
+LATENT_NODE_TYPES = ("EmptyLatentImage", "EmptySD3LatentImage")
+
+# S6.0: 准入与合并提交参数
+# 合并提交（prompt coalescing）：兼容请求合并进同一个 ComfyUI prompt，各请求是图中独立的采样分支，
+# ComfyUI 仍逐个执行这些分支，不是 GPU 上的 latent 批处理，单张图像的生成时间不变；
+# 节省的只是每个请求单独提交、排队和等待 /ws 事件的往返（模型加载等共享节点 ComfyUI 本身就会缓存）
+MAX_BATCH_SIZE = 4        # 合并到一个 ComfyUI prompt 中的最大请求数
+BATCH_WINDOW_S = 0.05     # 等待兼容请求加入同一组的最长时间
+MAX_INFLIGHT_BATCHES = 2  # 同时提交给 ComfyUI 的 prompt 数，前一个执行时下一个已在队列中，GPU 不空闲
+MAX_QUEUE_DEPTH = 16      # 单容器排队请求上限，超过时返回 429
+# Modal 分配给单容器的并发输入上限，必须大于 MAX_QUEUE_DEPTH：
+# 超出准入上限的请求要能到达容器才会被快速拒绝，否则只会在 Modal 侧排队
+MAX_CONTAINER_INPUTS = MAX_QUEUE_DEPTH * 2
+
+# S6.0: 流式输出参数
+STREAM_POLL_INTERVAL_S = 1.0  # 流式任务检查取消标记的间隔
+
+
 @app.cls(
     scaledown_window=300,
     gpu="L40S",
     volumes={"/cache": vol}
 )
-@modal.concurrent(max_inputs=5)
+@modal.concurrent(max_inputs=MAX_CONTAINER_INPUTS, target_inputs=MAX_BATCH_SIZE * MAX_INFLIGHT_BATCHES)
 class ComfyUI:
     """
     S6: ComfyUI API 服务类
@@ -267,61 +394,160 @@ class ComfyUI:
         # 链接 Volume 中的所有资源（模型和节点）
         _link_resources_from_volume()
         
-        cmd = f"comfy launch --background -- --port {self.port}"
+        cmd = f"comfy launch --background -- --port {self.port} --preview-method auto"
         subprocess.run(cmd, shell=True, check=True)
+        
+        # 加载并索引所有工作流，后续请求不再读取磁盘
+        print("📄 加载工作流...")
+        self._workflows = _load_workflow_registry()
+        
+        # 启动合并提交调度线程
+        self._jobs = queue.Queue()
+        self._admission_lock = threading.Lock()
+        self._inflight = threading.Semaphore(MAX_INFLIGHT_BATCHES)
+        self._queue_depth = 0
+        self._stats = {"admitted": 0, "rejected": 0, "failed": 0, "batches": 0, "batched_requests": 0}
+        self._executor = ThreadPoolExecutor(max_workers=MAX_INFLIGHT_BATCHES)
+        threading.Thread(target=self._dispatch_batches, daemon=True).start()
     
     @modal.method()
-    def infer(self, workflow_path: str = "/root/workflow_api.json"):
-        """S6.2: 执行图像生成推理"""
+    def infer(self, workflow_path: str = DEFAULT_WORKFLOW_PATH, workflow: Dict = None):
+        """
+        S6.2: 执行图像生成推理
+        - 通过 HTTP /prompt 把工作流提交给已运行的 ComfyUI
+        - 通过 /ws 等待该 prompt 执行完成
+        - 通过 /history 按 prompt_id 取回结果，读取后删除输出文件
+        """
         print("🎨 S6.2: 开始执行图像生成推理...")
         
         # 检查服务健康状态
         self.poll_server_health()
         
-        # 执行工作流
-        cmd = f"comfy run --workflow {workflow_path} --wait --timeout 1200 --verbose"
-        subprocess.run(cmd, shell=True, check=True)
+        if workflow is None:
+            workflow = json.loads(Path(workflow_path).read_text())
         
-        # 获取生成的图像
-        output_dir = "/root/comfy/ComfyUI/output"
-        workflow = json.loads(Path(workflow_path).read_text())
-        file_prefix = [
-            node.get("inputs")
-            for node in workflow.values()
-            if node.get("class_type") == "SaveImage"
-        ][0]["filename_prefix"]
-        
-        for f in Path(output_dir).iterdir():
-            if f.name.startswith(file_prefix):
-                return f.read_bytes()
+        images = self._run_workflow(workflow)
+        if images:
+            return images[0]
     
     @modal.fastapi_endpoint(method="POST")
     def api(self, item: Dict):
-        """S6.3: FastAPI 端点 - 处理图像生成请求"""
+        """
+        S6.3: FastAPI 端点 - 处理图像生成请求
+        - 排队请求超过 MAX_QUEUE_DEPTH 时返回 429，由客户端稍后重试
+        - 工作流、分辨率和步数相同的请求合并提交为一个 ComfyUI prompt（逐个分支执行，
+          不是 GPU 批处理），每个请求使用自己的提示词和种子
+        - 参数错误返回 400；等待超过 COMFY_PROMPT_TIMEOUT（含排队时间）返回 504，
+          尚未提交的请求会被取消，已提交的 prompt 在同组请求全部放弃后中断
+        
+        请求参数: prompt, negative_prompt, seed, width, height, steps,
+        workflow (工作流名称，默认 default)
+        """
         from fastapi import Response
+        from fastapi.responses import JSONResponse
         
         print("📡 S6.3: 处理 API 请求...")
         
-        # 加载工作流模板（需要先上传 workflow_api.json）
-        workflow_path = Path("/root/workflow_api.json")
-        if not workflow_path.exists():
-            return {"error": "workflow_api.json 不存在，请先上传工作流文件"}
+        workflow_name, params, error = self._parse_request(item)
+        if error:
+            return JSONResponse({"error": error}, status_code=400)
         
-        workflow_data = json.loads(workflow_path.read_text())
+        # 准入控制
+        if not self._admit():
+            return JSONResponse(
+                {"error": "服务繁忙，请稍后重试", "queue_depth": self._queue_depth},
+                status_code=429,
+                headers={"Retry-After": "5"},
+            )
         
-        # 设置用户提示词
-        workflow_data["6"]["inputs"]["text"] = item.get("prompt", "a beautiful landscape")
+        try:
+            job = {
+                "workflow": workflow_name,
+                "params": params,
+                "key": (workflow_name, params["width"], params["height"], params["steps"]),
+                "future": Future(),
+                "abandoned": False,
+            }
+            self._jobs.put(job)
+            img_bytes = job["future"].result(timeout=COMFY_PROMPT_TIMEOUT)
+        except TimeoutError:
+            # 仍在排队的请求直接取消，调度时跳过；已在执行的由 _run_batch 判断是否中断
+            job["abandoned"] = True
+            job["future"].cancel()
+            print(f"⏰ 请求等待超时（{COMFY_PROMPT_TIMEOUT} 秒），已放弃")
+            return JSONResponse(
+                {"error": f"生成超时（{COMFY_PROMPT_TIMEOUT} 秒，含排队时间）"},
+                status_code=504,
+            )
+        finally:
+            self._release()
         
-        # 生成唯一 ID
-        client_id = uuid.uuid4().hex
-        workflow_data["9"]["inputs"]["filename_prefix"] = client_id
+        return Response(img_bytes, media_type="image/jpeg")
+    
+    @modal.fastapi_endpoint(method="GET")
+    def stats(self):
+        """S6.5: 当前容器的队列深度、拒绝次数和合并提交指标（batches 为提交的 prompt 数）"""
+        with self._admission_lock:
+            stats = dict(self._stats)
+            stats["queue_depth"] = self._queue_depth
+        stats["avg_batch_size"] = (
+            stats["batched_requests"] / stats["batches"] if stats["batches"] else 0
+        )
+        return stats
+    
+    @modal.fastapi_endpoint(method="POST")
+    def stream(self, item: Dict):
+        """
+        S6.6: 流式生成端点 (Server-Sent Events)
+        请求参数与 api 相同，依次返回以下事件:
+        - queued: 已提交，data 中的 prompt_id 可用于取消
+        - progress: 每个采样步骤的进度
+        - preview: 采样过程中的预览图 (base64)
+        - image: 最终图像 (base64)
+        - done / cancelled / error: 结束事件
+        客户端断开连接或调用 cancel 端点时，会从 ComfyUI 中中断该任务
+        """
+        from fastapi.responses import JSONResponse, StreamingResponse
         
-        # 保存并执行
-        new_workflow_file = f"{client_id}.json"
-        json.dump(workflow_data, Path(new_workflow_file).open("w"))
+        print("📡 S6.6: 处理流式请求...")
         
-        img_bytes = self.infer.local(new_workflow_file)
-        return Response(img_bytes, media_type="image/jpeg")
+        workflow_name, params, error = self._parse_request(item)
+        if error:
+            return JSONResponse({"error": error}, status_code=400)
+        
+        if not self._admit():
+            return JSONResponse(
+                {"error": "服务繁忙，请稍后重试", "queue_depth": self._queue_depth},
+                status_code=429,
+                headers={"Retry-After": "5"},
+            )
+        
+        # 名额只释放一次：生成器结束时释放；响应在生成器启动前被丢弃（如客户端提前断开）时，
+        # 生成器的 finally 不会执行，由生成器对象回收时的 finalize 释放
+        release = self._release_once()
+        try:
+            params = dict(params, filename_prefix=uuid.uuid4().hex)
+            workflow = _render_workflow(self._workflows[workflow_name], params)
+            events = self._stream_events(workflow, release)
+            weakref.finalize(events, release)
+        except Exception:
+            release()
+            raise
+        return StreamingResponse(
+            events,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+    
+    @modal.fastapi_endpoint(method="POST")
+    def cancel(self, item: Dict):
+        """S6.7: 取消进行中的流式任务（任务所在容器会在下一次轮询时中断它）"""
+        prompt_id = item.get("prompt_id")
+        if not prompt_id:
+            return {"success": False, "error": "缺少 prompt_id"}
+        
+        cancel_flags[prompt_id] = True
+        return {"success": True, "prompt_id": prompt_id}
     
     def poll_server_health(self) -> Dict:
         """S6.4: 健康检查"""
@@ -336,6 +562,295 @@ class ComfyUI:
         except (socket.timeout, urllib.error.URLError) as e:
             print(f"❌ ComfyUI 服务健康检查失败: {e}")
             raise Exception("ComfyUI server is not healthy")
+    
+    def _parse_request(self, item: Dict):
+        """解析请求参数，返回 (工作流名称, 参数, 错误信息)"""
+        # 检查工作流模板（需要先上传 workflow_api.json 或命名工作流）
+        workflow_name = item.get("workflow", "default")
+        if workflow_name not in self._workflows:
+            if not self._workflows:
+                return workflow_name, None, "workflow_api.json 不存在，请先上传工作流文件"
+            return workflow_name, None, f"工作流不存在: {workflow_name}，可用: {', '.join(self._workflows)}"
+        
+        params = {
+            "prompt": item.get("prompt", "a beautiful landscape"),
+            "negative_prompt": item.get("negative_prompt"),
+            "seed": item.get("seed"),
+            "width": item.get("width"),
+            "height": item.get("height"),
+            "steps": item.get("steps"),
+        }
+        return workflow_name, params, None
+    
+    def _admit(self) -> bool:
+        """准入控制：排队请求未超过上限时占用一个名额"""
+        with self._admission_lock:
+            if self._queue_depth >= MAX_QUEUE_DEPTH:
+                self._stats["rejected"] += 1
+                return False
+            self._queue_depth += 1
+            self._stats["admitted"] += 1
+            return True
+    
+    def _release(self):
+        """释放准入名额"""
+        with self._admission_lock:
+            self._queue_depth -= 1
+    
+    def _release_once(self):
+        """返回只生效一次的释放函数，供可能从多个路径释放的流式请求使用"""
+        lock = threading.Lock()
+        state = {"released": False}
+        
+        def release():
+            with lock:
+                if state["released"]:
+                    return
+                state["released"] = True
+            self._release()
+        return release
+    
+    def _dispatch_batches(self):
+        """调度线程：有空闲提交槽位时，从队列中收集兼容请求合并成一个 prompt 提交"""
+        pending = []
+        while True:
+            self._inflight.acquire()
+            first = pending.pop(0) if pending else self._jobs.get()
+            batch = [first]
+            
+            # 先取之前因不兼容而暂存的请求
+            for job in list(pending):
+                if len(batch) >= MAX_BATCH_SIZE:
+                    break
+                if job["key"] == first["key"]:
+                    batch.append(job)
+                    pending.remove(job)
+            
+            # 在时间窗口内继续收集兼容请求
+            deadline = time.monotonic() + BATCH_WINDOW_S
+            while len(batch) < MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self._jobs.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if job["key"] == first["key"]:
+                    batch.append(job)
+                else:
+                    pending.append(job)
+            
+            self._executor.submit(self._run_batch, batch)
+    
+    def _run_batch(self, batch):
+        """把一组兼容请求合并为一个 ComfyUI prompt 执行，并把结果分发给各请求"""
+        try:
+            # 跳过排队期间已超时取消的请求
+            batch = [job for job in batch if job["future"].set_running_or_notify_cancel()]
+            if not batch:
+                return
+            workflow = self._build_coalesced_workflow(batch)
+            images = self._run_workflow(
+                workflow, should_abort=lambda: all(job["abandoned"] for job in batch)
+            )
+            with self._admission_lock:
+                self._stats["batches"] += 1
+                self._stats["batched_requests"] += len(batch)
+            print(f"📦 合并提交完成: {len(batch)} 个请求, {len(images)} 张图像")
+            
+            # 输出按文件名排序，各请求的图像按槽位顺序连续排列
+            per_slot = len(images) // len(batch)
+            for i, job in enumerate(batch):
+                if per_slot:
+                    job["future"].set_result(images[i * per_slot])
+                else:
+                    job["future"].set_exception(Exception("ComfyUI 未返回足够的输出图像"))
+        except Exception as e:
+            with self._admission_lock:
+                self._stats["failed"] += len(batch)
+            for job in batch:
+                if not job["future"].done():
+                    job["future"].set_exception(e)
+        finally:
+            self._inflight.release()
+    
+    def _build_coalesced_workflow(self, batch) -> Dict:
+        """根据同组各请求的参数，从注册表中的工作流生成合并后的工作流"""
+        prefix = uuid.uuid4().hex
+        slots = [dict(job["params"], filename_prefix=f"{prefix}_{i:02d}") for i, job in enumerate(batch)]
+        return _render_coalesced_workflow(self._workflows[batch[0]["workflow"]], slots)
+    
+    def _run_workflow(self, workflow: Dict, should_abort=None):
+        """提交工作流并等待完成，返回所有输出图像的字节；should_abort() 为真时中断 prompt"""
+        # 先建立 websocket 再提交，避免错过执行事件
+        client_id = uuid.uuid4().hex
+        ws = self._connect_ws(client_id)
+        try:
+            prompt_id = self._queue_prompt(workflow, client_id)
+            self._wait_for_prompt(ws, prompt_id, should_abort)
+        finally:
+            ws.close()
+        
+        return self._collect_outputs(prompt_id)
+    
+    def _comfy_request(self, path: str, payload: Dict = None) -> Dict:
+        """向本地 ComfyUI 发送 HTTP 请求，payload 不为空时使用 POST"""
+        import urllib.error
+        import urllib.request
+        
+        data = json.dumps(payload).encode() if payload is not None else None
+        req = urllib.request.Request(
+            f"http://127.0.0.1:{self.port}{path}",
+            data=data,
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                body = resp.read()
+        except urllib.error.HTTPError as e:
+            raise Exception(f"ComfyUI 请求失败 {path}: {e.code} {e.read()[:500]!r}")
+        return json.loads(body) if body else {}
+    
+    def _connect_ws(self, client_id: str, timeout: float = PROMPT_POLL_INTERVAL_S):
+        """连接 ComfyUI 的 /ws 进度流"""
+        import websocket
+        
+        return websocket.create_connection(
+            f"ws://127.0.0.1:{self.port}/ws?clientId={client_id}",
+            timeout=timeout,
+        )
+    
+    def _queue_prompt(self, workflow: Dict, client_id: str) -> str:
+        """提交工作流到 /prompt，返回 prompt_id"""
+        result = self._comfy_request("/prompt", {"prompt": workflow, "client_id": client_id})
+        if result.get("node_errors"):
+            raise Exception(f"工作流校验失败: {result['node_errors']}")
+        return result["prompt_id"]
+    
+    def _wait_for_prompt(self, ws, prompt_id: str, should_abort=None):
+        """
+        读取 websocket 事件直到指定 prompt 执行完成
+        超过 COMFY_PROMPT_TIMEOUT 或 should_abort() 为真时中断它并抛出异常
+        """
+        deadline = time.monotonic() + COMFY_PROMPT_TIMEOUT
+        for _ in self._iter_prompt_events(ws, prompt_id):
+            if time.monotonic() > deadline:
+                self._cancel_prompt(prompt_id)
+                raise Exception(f"ComfyUI 执行超时（{COMFY_PROMPT_TIMEOUT} 秒）: {prompt_id}")
+            if should_abort and should_abort():
+                self._cancel_prompt(prompt_id)
+                raise Exception(f"请求已全部放弃，中断 prompt: {prompt_id}")
+    
+    def _iter_prompt_events(self, ws, prompt_id: str):
+        """
+        逐个产出指定 prompt 的执行事件，执行完成时结束
+        - ("progress", data): 采样进度
+        - ("preview", bytes): 预览图
+        - ("idle", None): websocket 读取超时，供调用方检查取消/超时
+        """
+        import websocket
+        
+        while True:
+            try:
+                message = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                yield "idle", None
+                continue
+            
+            if not isinstance(message, str):
+                # 二进制消息: 4 字节事件类型 (1 = 预览图) + 4 字节图像格式 + 图像数据
+                if len(message) > 8 and int.from_bytes(message[:4], "big") == 1:
+                    yield "preview", message[8:]
+                continue
+            
+            event = json.loads(message)
+            data = event.get("data", {})
+            if data.get("prompt_id") != prompt_id:
+                continue
+            if event["type"] == "execution_error":
+                raise Exception(f"ComfyUI 执行失败: {data.get('exception_message')}")
+            if event["type"] == "executing" and data.get("node") is None:
+                return
+            if event["type"] == "progress":
+                yield "progress", data
+    
+    def _stream_events(self, workflow: Dict, release):
+        """执行工作流并以 SSE 格式逐条产出进度、预览和最终图像，结束时调用 release 释放准入名额"""
+        client_id = uuid.uuid4().hex
+        ws = None
+        prompt_id = None
+        finished = False
+        try:
+            ws = self._connect_ws(client_id, timeout=STREAM_POLL_INTERVAL_S)
+            prompt_id = self._queue_prompt(workflow, client_id)
+            yield _sse("queued", {"prompt_id": prompt_id})
+            
+            deadline = time.monotonic() + COMFY_PROMPT_TIMEOUT
+            next_check = time.monotonic() + STREAM_POLL_INTERVAL_S
+            for kind, data in self._iter_prompt_events(ws, prompt_id):
+                if kind == "progress":
+                    yield _sse("progress", {"step": data["value"], "total": data["max"], "node": data.get("node")})
+                elif kind == "preview":
+                    yield _sse("preview", {"image": base64.b64encode(data).decode()})
+                
+                if time.monotonic() >= next_check:
+                    next_check = time.monotonic() + STREAM_POLL_INTERVAL_S
+                    if cancel_flags.get(prompt_id, False):
+                        yield _sse("cancelled", {"prompt_id": prompt_id})
+                        return
+                    if time.monotonic() > deadline:
+                        raise Exception("ComfyUI 执行超时")
+            
+            for image in self._collect_outputs(prompt_id):
+                yield _sse("image", {"image": base64.b64encode(image).decode()})
+            finished = True
+            yield _sse("done", {"prompt_id": prompt_id})
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+        finally:
+            # 客户端断开连接时生成器被关闭，同样会走到这里
+            if ws is not None:
+                ws.close()
+            if prompt_id:
+                if not finished:
+                    self._cancel_prompt(prompt_id)
+                # 任务结束后清除取消标记；结束后才到达的取消请求由 Dict 的过期机制清理
+                try:
+                    cancel_flags.pop(prompt_id, None)
+                except Exception as e:
+                    print(f"⚠️ 清除取消标记失败: {e}")
+            release()
+    
+    def _cancel_prompt(self, prompt_id: str):
+        """从 ComfyUI 队列中删除指定 prompt，正在执行时中断它"""
+        try:
+            self._comfy_request("/queue", {"delete": [prompt_id]})
+            running = self._comfy_request("/queue").get("queue_running", [])
+            if any(entry[1] == prompt_id for entry in running):
+                self._comfy_request("/interrupt", {"prompt_id": prompt_id})
+            self._comfy_request("/history", {"delete": [prompt_id]})
+            print(f"🛑 已取消任务: {prompt_id}")
+        except Exception as e:
+            print(f"⚠️ 取消任务失败: {e}")
+    
+    def _collect_outputs(self, prompt_id: str):
+        """通过 /history 获取 prompt 的输出图像，读取后删除文件和历史记录"""
+        history = self._comfy_request(f"/history/{prompt_id}").get(prompt_id, {})
+        
+        images = []
+        for node_output in history.get("outputs", {}).values():
+            for image in node_output.get("images", []):
+                if image.get("type") != "output":
+                    continue
+                image_file = Path(COMFY_OUTPUT_DIR) / image.get("subfolder", "") / image["filename"]
+                if image_file.exists():
+                    images.append((image["filename"], image_file.read_bytes()))
+                    image_file.unlink()
+        
+        # 同时清理 ComfyUI 内存中的历史记录
+        self._comfy_request("/history", {"delete": [prompt_id]})
+        return [data for _, data in sorted(images, key=lambda item: item[0])]
 
 
 # =============================================================================
@@ -345,50 +860,129 @@ class ComfyUI:
 def _link_resources_from_volume():
     """
     链接 Volume 中所有持久化资源到 ComfyUI 目录
+    - 读取 Volume 上的链接清单，仅重新扫描 mtime 变化的目录
     - 链接模型文件
     - 链接自定义节点
     - 安装节点依赖
     """
     print("🔗 开始链接 Volume 中的持久化资源...")
     
+    # 0. 增量刷新链接清单
+    manifest = _load_link_manifest()
+    if _sync_link_manifest(manifest):
+        _save_link_manifest(manifest)
+        try:
+            vol.commit()
+        except Exception as e:
+            print(f"   ⚠️ 链接清单持久化失败: {e}")
+    
     # 1. 链接模型
-    _link_models_from_volume()
+    _link_models_from_volume(manifest)
     
     # 2. 链接自定义节点并安装依赖
-    _link_custom_nodes_from_volume()
+    _link_custom_nodes_from_volume(manifest)
     
     print("✅ 资源链接完成")
 
 
-def _link_models_from_volume():
-    """链接 Volume 中的模型文件"""
+def _load_link_manifest() -> Dict:
+    """
+    读取 Volume 上的链接清单
+    格式: {"version": 1, "dirs": {相对目录: mtime_ns}, "entries": {相对路径: [size, mtime]}}
+    """
+    try:
+        manifest = json.loads(LINK_MANIFEST_PATH.read_text())
+        if manifest.get("version") == 1:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"version": 1, "dirs": {}, "entries": {}}
+
+
+def _save_link_manifest(manifest: Dict):
+    """原子写入紧凑格式的链接清单"""
+    tmp_path = LINK_MANIFEST_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, separators=(",", ":")))
+    os.replace(tmp_path, LINK_MANIFEST_PATH)
+
+
+def _sync_link_manifest(manifest: Dict) -> bool:
+    """
+    按目录 mtime 增量刷新链接清单，只重新扫描发生变化的目录
+    返回清单是否有变化
+    """
+    dirs = manifest["dirs"]
+    entries = manifest["entries"]
+    changed = False
+    
+    # models 根目录变化说明新增/删除了模型类型目录
+    models_root = CACHE_ROOT / "models"
+    if models_root.is_dir():
+        root_mtime = models_root.stat().st_mtime_ns
+        if dirs.get("models") != root_mtime:
+            dirs["models"] = root_mtime
+            changed = True
+            for type_dir in models_root.iterdir():
+                if type_dir.is_dir() and not type_dir.name.startswith("."):
+                    dirs.setdefault(f"models/{type_dir.name}", None)
+    
+    scan_dirs = ["custom_nodes"] + [d for d in dirs if d.startswith("models/")]
+    for rel_dir in scan_dirs:
+        path = CACHE_ROOT / rel_dir
+        prefix = f"{rel_dir}/"
+        
+        if not path.is_dir():
+            if rel_dir in dirs:
+                del dirs[rel_dir]
+                for key in [k for k in entries if k.startswith(prefix)]:
+                    del entries[key]
+                changed = True
+            continue
+        
+        mtime = path.stat().st_mtime_ns
+        if dirs.get(rel_dir) == mtime:
+            continue
+        
+        dirs[rel_dir] = mtime
+        for key in [k for k in entries if k.startswith(prefix)]:
+            del entries[key]
+        for child in path.iterdir():
+            if child.name.startswith("."):
+                continue
+            if rel_dir == "custom_nodes" and not child.is_dir():
+                continue
+            st = child.stat() if child.exists() else child.lstat()
+            entries[prefix + child.name] = [st.st_size, int(st.st_mtime)]
+        changed = True
+    
+    return changed
+
+
+def _link_models_from_volume(manifest: Dict):
+    """按链接清单链接 Volume 中的模型文件"""
     print("📦 链接持久化的模型...")
     
-    cache_models = Path("/cache/models")
-    comfy_models = Path("/root/comfy/ComfyUI/models")
+    comfy_models = Path(COMFY_MODELS_DIR)
+    model_keys = [k for k in manifest["entries"] if k.startswith("models/")]
     
-    if not cache_models.exists():
+    if not model_keys:
         print("   ℹ️ 无持久化模型")
         return
     
     linked_count = 0
-    for model_type_dir in cache_models.iterdir():
-        if not model_type_dir.is_dir():
+    created_dirs = set()
+    for key in model_keys:
+        _, model_type, model_name = key.split("/", 2)
+        link_path = comfy_models / model_type / model_name
+        if link_path.exists() or link_path.is_symlink():
             continue
         
-        target_dir = comfy_models / model_type_dir.name
-        target_dir.mkdir(parents=True, exist_ok=True)
-        
-        for model_file in model_type_dir.iterdir():
-            link_path = target_dir / model_file.name
-            if not link_path.exists() and not link_path.is_symlink():
-                subprocess.run(
-                    f"ln -s {model_file} {link_path}",
-                    shell=True,
-                    check=False
-                )
-                linked_count += 1
-                print(f"   ✅ 已链接模型: {model_type_dir.name}/{model_file.name}")
+        if model_type not in created_dirs:
+            link_path.parent.mkdir(parents=True, exist_ok=True)
+            created_dirs.add(model_type)
+        os.symlink(CACHE_ROOT / key, link_path)
+        linked_count += 1
+        print(f"   ✅ 已链接模型: {model_type}/{model_name}")
     
     if linked_count == 0:
         print("   ℹ️ 无新模型需要链接")
@@ -396,51 +990,342 @@ def _link_models_from_volume():
         print(f"   📊 共链接 {linked_count} 个模型")
 
 
-def _link_custom_nodes_from_volume():
-    """链接 Volume 中持久化的自定义节点并安装依赖"""
+def _link_custom_nodes_from_volume(manifest: Dict):
+    """按链接清单链接 Volume 中持久化的自定义节点并安装依赖"""
     print("🧩 链接持久化的自定义节点...")
     
-    cache_custom_nodes = Path("/cache/custom_nodes")
     comfy_custom_nodes = Path("/root/comfy/ComfyUI/custom_nodes")
+    node_keys = [k for k in manifest["entries"] if k.startswith("custom_nodes/")]
     
-    if not cache_custom_nodes.exists():
+    if not node_keys:
         print("   ℹ️ 无持久化节点")
         return
     
     linked_count = 0
-    for node_dir in cache_custom_nodes.iterdir():
-        if not node_dir.is_dir():
-            continue
-        
+    for key in node_keys:
+        node_dir = CACHE_ROOT / key
         link_path = comfy_custom_nodes / node_dir.name
         
         # 1. 创建符号链接
         if not link_path.exists() and not link_path.is_symlink():
-            subprocess.run(
-                f"ln -s {node_dir} {link_path}",
-                shell=True,
-                check=False
-            )
+            os.symlink(node_dir, link_path)
             linked_count += 1
             print(f"   ✅ 已链接节点: {node_dir.name}")
-        
-        # 2. 安装节点依赖（关键修复！）
-        req_file = node_dir / "requirements.txt"
-        if req_file.exists():
-            print(f"   📦 安装依赖: {node_dir.name}/requirements.txt")
-            result = subprocess.run(
-                f"pip install -r {req_file} --quiet",
-                shell=True,
-                capture_output=True,
-                text=True
-            )
-            if result.returncode != 0:
-                print(f"   ⚠️ 依赖安装警告: {result.stderr[:200]}")
     
     if linked_count == 0:
         print("   ℹ️ 无新节点需要链接")
     else:
         print(f"   📊 共链接 {linked_count} 个节点")
+    
+    # 2. 安装节点依赖（按 requirements 哈希缓存）
+    _install_custom_node_deps([CACHE_ROOT / key for key in node_keys])
+
+
+def _install_custom_node_deps(node_dirs):
+    """
+    按内容哈希缓存安装自定义节点依赖
+    - 对每个节点的 requirements.txt 计算哈希，合并成一个总哈希
+    - 总哈希未变化时直接复用 Volume 上已构建的依赖层，不运行 pip
+    - 变化时统一解析所有节点的依赖生成锁文件，并安装到新的依赖层
+    - 总哈希包含镜像中已安装包的版本：锁文件只安装镜像缺少的包（--no-deps），镜像升级后需要重新解析
+    - 每次使用时刷新依赖层的使用时间，长期未使用的旧依赖层被清理
+    """
+    req_files = sorted(
+        (node_dir.name, node_dir / "requirements.txt")
+        for node_dir in node_dirs
+        if (node_dir / "requirements.txt").exists()
+    )
+    if not req_files:
+        print("   ℹ️ 无节点依赖需要安装")
+        return
+    
+    digest = hashlib.sha256(f"py{sys.version_info.major}.{sys.version_info.minor}\n".encode())
+    digest.update(_image_packages_fingerprint().encode())
+    for node_name, req_file in req_files:
+        file_hash = hashlib.sha256(req_file.read_bytes()).hexdigest()
+        digest.update(f"{node_name}:{file_hash}\n".encode())
+    layer = NODE_DEPS_DIR / digest.hexdigest()[:16]
+    
+    if (layer / ".complete").exists():
+        print(f"   ♻️ 依赖未变化，复用依赖层: {layer.name}")
+    else:
+        print(f"   📦 依赖有变化，构建依赖层: {layer.name} ({len(req_files)} 个节点)")
+        if not _build_node_deps_layer(layer, [req_file for _, req_file in req_files]):
+            return
+    
+    os.utime(layer / ".complete")
+    _remove_stale_node_deps_layers(keep=layer)
+    try:
+        vol.commit()
+    except Exception as e:
+        print(f"   ⚠️ 依赖层持久化失败: {e}")
+    
+    # 通过 .pth 把依赖层放到 sys.path 最前面，对 comfy launch 启动的进程同样生效
+    pth_file = Path(sysconfig.get_paths()["purelib"]) / "comfyui_node_deps.pth"
+    pth_file.write_text(f"import sys; sys.path.insert(0, {str(layer / 'site-packages')!r})\n")
+
+
+def _image_packages_fingerprint() -> str:
+    """镜像中已安装的包及版本（只看镜像自身的 site-packages，不含依赖层）"""
+    from importlib import metadata
+    
+    paths = sysconfig.get_paths()
+    dists = metadata.distributions(path=sorted({paths["purelib"], paths["platlib"]}))
+    return "".join(sorted(f"{dist.metadata['Name']}=={dist.version}\n" for dist in dists))
+
+
+def _remove_stale_node_deps_layers(keep: Path):
+    """删除超过 NODE_DEPS_LAYER_TTL_S 未被使用的依赖层；其他容器可能仍在使用较新的依赖层，不能只保留当前这一层"""
+    now = time.time()
+    for layer in NODE_DEPS_DIR.iterdir():
+        if layer == keep or not layer.is_dir():
+            continue
+        marker = layer / ".complete"
+        last_used = marker.stat().st_mtime if marker.exists() else layer.stat().st_mtime
+        if now - last_used > NODE_DEPS_LAYER_TTL_S:
+            shutil.rmtree(layer, ignore_errors=True)
+            print(f"   🗑️ 清理未使用的依赖层: {layer.name}")
+
+
+def _build_node_deps_layer(layer: Path, req_files) -> bool:
+    """统一解析所有节点依赖并安装到 layer/site-packages，成功返回 True"""
+    tmp_layer = layer.with_name(f"{layer.name}.tmp-{uuid.uuid4().hex[:8]}")
+    site_dir = tmp_layer / "site-packages"
+    site_dir.mkdir(parents=True)
+    report_file = tmp_layer / "report.json"
+    lock_file = tmp_layer / "requirements.lock"
+    req_args = [arg for req_file in req_files for arg in ("-r", str(req_file))]
+    
+    # 1. 一次性解析所有节点的依赖，只保留镜像中尚未满足的包
+    result = subprocess.run(
+        [sys.executable, "-m", "pip", "install", "--dry-run", "--quiet",
+         "--report", str(report_file), *req_args],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(f"   ⚠️ 依赖解析失败: {result.stderr[:200]}")
+        shutil.rmtree(tmp_layer, ignore_errors=True)
+        return False
+    
+    report = json.loads(report_file.read_text())
+    lock = sorted(_lock_line(item) for item in report.get("install", []))
+    lock_file.write_text("".join(f"{line}\n" for line in lock))
+    print(f"   🔒 锁定 {len(lock)} 个待安装的包")
+    
+    # 2. 按锁文件安装到依赖层（依赖关系已在上一步解析完成）
+    if lock:
+        result = subprocess.run(
+            [sys.executable, "-m", "pip", "install", "--quiet", "--no-deps",
+             "--target", str(site_dir), "-r", str(lock_file)],
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0:
+            print(f"   ⚠️ 依赖安装失败: {result.stderr[:200]}")
+            shutil.rmtree(tmp_layer, ignore_errors=True)
+            return False
+    
+    (tmp_layer / ".complete").touch()
+    try:
+        os.rename(tmp_layer, layer)
+    except OSError:
+        # 其他容器已经构建好同一依赖层
+        shutil.rmtree(tmp_layer, ignore_errors=True)
+    return True
+
+
+def _lock_line(item: Dict) -> str:
+    """把 pip --report 中的一项转换为锁文件中的一行"""
+    name = item["metadata"]["name"]
+    download_info = item.get("download_info", {})
+    if not item.get("is_direct"):
+        return f"{name}=={item['metadata']['version']}"
+    
+    # URL / VCS 依赖保留原始地址，VCS 固定到解析出的 commit
+    url = download_info["url"]
+    vcs_info = download_info.get("vcs_info")
+    if vcs_info:
+        url = f"{vcs_info['vcs']}+{url}@{vcs_info['commit_id']}"
+    return f"{name} @ {url}"
+
+
+def _sse(event: str, data: Dict) -> str:
+    """格式化一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# =============================================================================
+# 工作流注册表
+# =============================================================================
+
+
+def _load_workflow_registry() -> Dict:
+    """
+    加载所有可用工作流，每个容器只解析一次
+    - 默认工作流: /root/workflow_api.json (名称 default)
+    - 命名工作流: WORKFLOW_DIRS 中的 *.json (名称为文件名)
+    返回 {名称: {"workflow": 工作流, "inputs": 可注入参数索引}}
+    """
+    paths = {}
+    if Path(DEFAULT_WORKFLOW_PATH).exists():
+        paths["default"] = Path(DEFAULT_WORKFLOW_PATH)
+    for workflow_dir in WORKFLOW_DIRS:
+        if Path(workflow_dir).is_dir():
+            for workflow_file in sorted(Path(workflow_dir).glob("*.json")):
+                paths.setdefault(workflow_file.stem, workflow_file)
+    
+    registry = {}
+    for name, path in paths.items():
+        try:
+            workflow = json.loads(path.read_text())
+        except (OSError, ValueError) as e:
+            print(f"   ⚠️ 工作流加载失败: {path}: {e}")
+            continue
+        inputs = _index_workflow(workflow)
+        registry[name] = {
+            "workflow": workflow,
+            "inputs": inputs,
+            "slot_nodes": _slot_nodes(workflow, inputs),
+        }
+        print(f"   📄 已加载工作流: {name} ({', '.join(registry[name]['inputs'])})")
+    return registry
+
+
+def _index_workflow(workflow: Dict) -> Dict:
+    """
+    预先计算工作流中可注入参数的位置
+    返回 {参数名: [(节点 ID, 输入名), ...]}
+    - prompt / negative_prompt: 沿采样器的 positive / negative 连线找到 CLIPTextEncode
+    - seed: 采样器的 seed / noise_seed
+    - steps: 采样器 / 调度器的 steps
+    - width / height / batch_size: 空 latent 节点
+    - filename_prefix: SaveImage 节点
+    """
+    index = {}
+    
+    def add(param, node_id, input_name):
+        index.setdefault(param, []).append((node_id, input_name))
+    
+    for node_id, node in workflow.items():
+        class_type = node.get("class_type")
+        inputs = node.get("inputs", {})
+        
+        if class_type == "SaveImage":
+            add("filename_prefix", node_id, "filename_prefix")
+        elif class_type in LATENT_NODE_TYPES:
+            for input_name in ("width", "height", "batch_size"):
+                add(input_name, node_id, input_name)
+        
+        for seed_input in ("seed", "noise_seed"):
+            if isinstance(inputs.get(seed_input), int):
+                add("seed", node_id, seed_input)
+        if isinstance(inputs.get("steps"), int):
+            add("steps", node_id, "steps")
+        
+        for link_input, param in (("positive", "prompt"), ("negative", "negative_prompt")):
+            text_node_id = _trace_text_node(workflow, inputs.get(link_input))
+            if text_node_id and (text_node_id, "text") not in index.get(param, []):
+                add(param, text_node_id, "text")
+    
+    # 没有采样器连线时，退回到第一个文本编码节点
+    if "prompt" not in index:
+        for node_id, node in workflow.items():
+            if node.get("class_type") == "CLIPTextEncode":
+                add("prompt", node_id, "text")
+                break
+    return index
+
+
+def _trace_text_node(workflow: Dict, link):
+    """沿 conditioning 连线向上查找 CLIPTextEncode 节点 ID"""
+    for _ in range(len(workflow)):
+        if not isinstance(link, list) or not link:
+            return None
+        node_id = str(link[0])
+        node = workflow.get(node_id, {})
+        if node.get("class_type") == "CLIPTextEncode":
+            return node_id
+        # 例如 FluxGuidance 等透传 conditioning 的节点
+        link = node.get("inputs", {}).get("conditioning")
+    return None
+
+
+def _slot_nodes(workflow: Dict, index: Dict) -> list:
+    """
+    找出需要按请求复制的节点：注入提示词、种子或输出文件名的节点，以及它们的全部下游节点
+    其余节点（模型加载、空 latent 等）在合并后的 prompt 中共享，只执行一次
+    """
+    slot = {node_id for param in ("prompt", "negative_prompt", "seed", "filename_prefix")
+            for node_id, _ in index.get(param, [])}
+    changed = True
+    while changed:
+        changed = False
+        for node_id, node in workflow.items():
+            if node_id in slot:
+                continue
+            if any(_is_link(value) and str(value[0]) in slot for value in node.get("inputs", {}).values()):
+                slot.add(node_id)
+                changed = True
+    return [node_id for node_id in workflow if node_id in slot]
+
+
+def _is_link(value) -> bool:
+    """API 格式中节点输入的连线形如 [上游节点 ID, 输出序号]"""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def _render_coalesced_workflow(entry: Dict, slots: list) -> Dict:
+    """
+    把多个请求合并为一个 ComfyUI prompt（合并提交，ComfyUI 逐个执行各分支，不做 latent 批处理）
+    - 共享节点只出现一次，同组请求的分辨率和步数相同，共享参数取第一个请求的值
+    - 每个请求复制一份 slot_nodes 分支（节点 ID 加槽位后缀），注入自己的提示词、种子和文件名，
+      单个请求的结果与单独提交时一致，按种子可复现
+    """
+    template = entry["workflow"]
+    slot_nodes = entry["slot_nodes"]
+    workflow = _render_workflow(
+        {"workflow": {k: v for k, v in template.items() if k not in slot_nodes}, "inputs": entry["inputs"]},
+        slots[0],
+        skip_missing=True,
+    )
+    
+    for slot, params in enumerate(slots):
+        ids = {node_id: f"{node_id}_{slot}" for node_id in slot_nodes}
+        for node_id in slot_nodes:
+            node = template[node_id]
+            inputs = {
+                name: [ids[str(value[0])], value[1]] if _is_link(value) and str(value[0]) in ids else value
+                for name, value in node.get("inputs", {}).items()
+            }
+            workflow[ids[node_id]] = {**node, "inputs": inputs}
+        
+        for param, value in params.items():
+            if value is None:
+                continue
+            for node_id, input_name in entry["inputs"].get(param, []):
+                if node_id in ids:
+                    workflow[ids[node_id]]["inputs"][input_name] = value
+    return workflow
+
+
+def _render_workflow(entry: Dict, params: Dict, skip_missing: bool = False) -> Dict:
+    """
+    基于注册表中的工作流生成一次请求的工作流
+    只复制被修改的节点，其余节点与模板共享
+    """
+    workflow = dict(entry["workflow"])
+    for param, value in params.items():
+        if value is None:
+            continue
+        for node_id, input_name in entry["inputs"].get(param, []):
+            if skip_missing and node_id not in workflow:
+                continue
+            node = workflow[node_id]
+            if node is entry["workflow"][node_id]:
+                node = workflow[node_id] = {**node, "inputs": dict(node["inputs"])}
+            node["inputs"][input_name] = value
+    return workflow
 
 
 # =============================================================================
@@ -632,5 +1517,7 @@ def main():
     print("\n部署后访问:")
     print("  - Web UI: https://[your-workspace]--comfyui-app-ui.modal.run")
     print("  - API: https://[your-workspace]--comfyui-app-comfyui-api.modal.run")
+    print("  - 队列指标: https://[your-workspace]--comfyui-app-comfyui-stats.modal.run")
+    print("  - 流式生成: https://[your-workspace]--comfyui-app-comfyui-stream.modal.run")
 
 
@@ -0,0 +1,111 @@
+"""
+两级嵌入缓存：容器内 LRU + 跨容器共享的 modal.Dict
+供 embedding-service/*.py 共用
+
+键为 (命名空间, 规范化文本的哈希)，命名空间包含模型 ID 和归一化方式，
+因此各嵌入应用可以共用同一个共享 Dict 而不会取到不兼容的向量。
+"""
+import collections
+import hashlib
+import threading
+import time
+
+# 嵌入缓存参数
+CACHE_MAX_ENTRIES = 100000      # 容器内 LRU 最多缓存的嵌入条数，超出后淘汰最久未用的
+CACHE_TTL_S = 7 * 24 * 3600     # 缓存条目有效期（两级缓存都会检查）
+CACHE_SHARED_MAX_LOOKUP = 64    # 单次请求最多查询/写入共享缓存的条数，更大的批次直接上 GPU 编码且不写回
+CACHE_SHARED_MAX_ENTRIES = 1000000  # 共享缓存条数上限，达到后停止写入，等待旧条目过期（modal.Dict 条目 7 天无访问自动过期）
+CACHE_SHARED_SIZE_CHECK_S = 300     # 检查共享缓存条数的最短间隔
+
+
+class EmbeddingCache:
+    """两级嵌入缓存：容器内 LRU + 共享的 modal.Dict，键为 (模型 ID, 规范化文本的哈希)"""
+    
+    def __init__(self, namespace: str, shared=None):
+        self.namespace = namespace
+        self.shared = shared
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0}
+        self._shared_full = False
+        self._shared_checked_at = 0.0
+    
+    def key(self, text: str) -> str:
+        normalized = " ".join(text.split())
+        return f"{self.namespace}:{hashlib.sha1(normalized.encode('utf-8')).hexdigest()}"
+    
+    def get_or_encode(self, texts: list[str], encode_fn):
+        """返回 texts 的嵌入矩阵，只把两级缓存都未命中的文本交给 encode_fn"""
+        import numpy as np
+        
+        keys = [self.key(t) for t in texts]
+        texts_by_key = dict(zip(keys, texts))
+        found = {}
+        now = time.time()
+        
+        with self._lock:
+            for key in texts_by_key:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if now - entry[0] > CACHE_TTL_S:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+            self.counters["hits"] += len(found)
+        
+        missing = [key for key in texts_by_key if key not in found]
+        fresh = {}
+        if self.shared is not None and 0 < len(missing) <= CACHE_SHARED_MAX_LOOKUP:
+            for key in missing:
+                try:
+                    entry = self.shared.get(key)
+                except Exception as e:
+                    print(f"⚠️ 共享嵌入缓存读取失败: {e}")
+                    break
+                if entry is not None and now - entry[0] <= CACHE_TTL_S:
+                    fresh[key] = (entry[0], np.frombuffer(entry[1], dtype=np.float32))
+            missing = [key for key in missing if key not in fresh]
+        shared_hits = len(fresh)
+        
+        if missing:
+            vectors = np.asarray(encode_fn([texts_by_key[key] for key in missing]), dtype=np.float32)
+            encoded = {key: (now, vector) for key, vector in zip(missing, vectors)}
+            fresh.update(encoded)
+            if self.shared is not None and len(encoded) <= CACHE_SHARED_MAX_LOOKUP and self._shared_writable(now):
+                try:
+                    self.shared.update({key: (ts, vector.tobytes()) for key, (ts, vector) in encoded.items()})
+                except Exception as e:
+                    print(f"⚠️ 共享嵌入缓存写入失败: {e}")
+        
+        with self._lock:
+            for key, entry in fresh.items():
+                self._entries[key] = entry
+                found[key] = entry[1]
+            evicted = max(0, len(self._entries) - CACHE_MAX_ENTRIES)
+            for _ in range(evicted):
+                self._entries.popitem(last=False)
+            self.counters["shared_hits"] += shared_hits
+            self.counters["misses"] += len(missing)
+            self.counters["evictions"] += evicted
+        
+        return np.stack([found[key] for key in keys])
+    
+    def _shared_writable(self, now: float) -> bool:
+        """共享缓存未达到条数上限时才写入；条数每隔 CACHE_SHARED_SIZE_CHECK_S 才查询一次"""
+        if now - self._shared_checked_at >= CACHE_SHARED_SIZE_CHECK_S:
+            self._shared_checked_at = now
+            try:
+                self._shared_full = self.shared.len() >= CACHE_SHARED_MAX_ENTRIES
+            except Exception as e:
+                print(f"⚠️ 共享嵌入缓存条数查询失败: {e}")
+        return not self._shared_full
+    
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            counters["entries"] = len(self._entries)
+        lookups = counters["hits"] + counters["shared_hits"] + counters["misses"]
+        counters["hit_rate"] = (counters["hits"] + counters["shared_hits"]) / lookups if lookups else 0
+        return counters
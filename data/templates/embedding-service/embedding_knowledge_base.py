@@ -12,9 +12,12 @@
 - 语义搜索（理解问题含义）
 - 相关文档推荐
 - 支持增量更新文档库
+- 大规模文档库使用持久化的 HNSW 近似索引，小规模时精确检索
+- 追加写入的分段存储，启动时内存映射，增量导入只写新文档
 """
 import modal
 import json
+import os
 from datetime import datetime
 
 app = modal.App("embedding-knowledge-base")
@@ -25,13 +28,263 @@ image = (
         "sentence-transformers",
         "torch==2.1.0",
         "numpy",
-        "scikit-learn",
+        "hnswlib",
     )
 )
 
 model_volume = modal.Volume.from_name("embedding-models", create_if_missing=True)
 kb_volume = modal.Volume.from_name("knowledge-base", create_if_missing=True)
 
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+
+# 跨容器共享的嵌入缓存（键已包含模型和归一化方式，各嵌入应用可共用）
+shared_embedding_cache = modal.Dict.from_name("embedding-cache", create_if_missing=True)
+
+
+# 向量索引参数
+ANN_BACKEND = "hnsw"            # 近似索引后端，见 ANN_BACKENDS；设为 None 时始终精确检索
+BRUTE_FORCE_THRESHOLD = 20000   # 候选文档少于此数时使用精确暴力检索
+HNSW_M = 32                     # 每个节点的连接数，越大召回越高、内存越大
+HNSW_EF_CONSTRUCTION = 200      # 构建索引时的搜索宽度
+HNSW_EF_SEARCH = 64             # 默认查询搜索宽度，越大召回越高、延迟越大
+HNSW_SAVE_EVERY = 10000         # 累计新增多少文档后保存一次索引（启动时会补齐未保存的部分）
+
+# 分段存储参数
+MAX_SEGMENTS = 64               # 段数超过此值时自动合并
+
+
+class HNSWIndex:
+    """基于 hnswlib 的 HNSW 近似最近邻索引，标签即文档行号，持久化到 Volume"""
+    
+    path = "/kb/hnsw.bin"
+    
+    def __init__(self, dim: int):
+        import hnswlib
+        
+        self.index = hnswlib.Index(space="cosine", dim=dim)
+    
+    def load(self, max_count: int) -> int:
+        """加载已持久化的索引，返回其中的文档数（不存在或不可用时返回 0）"""
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            self.index.load_index(self.path, max_elements=max_count)
+        except RuntimeError:
+            return 0
+        count = self.index.get_current_count()
+        return count if count <= max_count else 0
+    
+    def init(self, capacity: int):
+        """初始化空索引"""
+        self.index.init_index(
+            max_elements=max(capacity, 1024),
+            ef_construction=HNSW_EF_CONSTRUCTION,
+            M=HNSW_M,
+        )
+    
+    def add(self, vectors, start_row: int):
+        """增量添加向量，行号从 start_row 开始"""
+        import numpy as np
+        
+        end_row = start_row + len(vectors)
+        if end_row > self.index.get_max_elements():
+            self.index.resize_index(max(end_row, 2 * self.index.get_max_elements()))
+        self.index.add_items(vectors, np.arange(start_row, end_row))
+    
+    def search(self, query, k: int, ef: int = None, allowed=None):
+        """
+        返回 (行号数组, 相似度数组)
+        allowed 为布尔掩码时，只在掩码为 True 的文档中搜索（检索时过滤）
+        """
+        self.index.set_ef(max(ef or HNSW_EF_SEARCH, k))
+        filter_fn = (lambda row: bool(allowed[row])) if allowed is not None else None
+        rows, distances = self.index.knn_query(query, k=k, filter=filter_fn)
+        return rows[0], 1 - distances[0]
+    
+    def save(self):
+        self.index.save_index(self.path)
+
+
+# 可插拔的近似索引后端
+ANN_BACKENDS = {"hnsw": HNSWIndex}
+
+
+class SegmentStore:
+    """
+    追加写入的分段存储，每个段包含:
+    - emb_XXXXX.f32: 归一化的 float32 嵌入向量，启动时以 np.memmap 映射
+    - docs_XXXXX.jsonl: 文档内容，每行一个 JSON
+    - offsets_XXXXX.npy: 每个文档在 jsonl 中的字节偏移
+    - meta_XXXXX.json: 文档 ID 和分类，用于 ID 索引和分类过滤
+    manifest.json 记录所有段，写入新段后原子替换
+    """
+    
+    root = "/kb/segments"
+    
+    def __init__(self):
+        import numpy as np
+        
+        self.dim = None
+        self.segments = []           # [{"name", "start", "count", "vectors", "offsets", "docs_path"}]
+        self.id_to_row = {}
+        self.categories = np.array([], dtype=object)
+        self.next_segment = 0
+    
+    def __len__(self):
+        return len(self.id_to_row)
+    
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, "manifest.json")
+    
+    def load(self):
+        """映射所有段文件，只读取 ID 和分类等元数据"""
+        import numpy as np
+        
+        if not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        
+        self.dim = manifest["dim"]
+        self.next_segment = manifest["next_segment"]
+        categories = []
+        for name in manifest["segments"]:
+            categories.extend(self._map_segment(name))
+        self.categories = np.array(categories, dtype=object)
+    
+    def append(self, documents: list[dict], vectors):
+        """把新文档写成一个新段，成本只与新文档数量有关"""
+        import numpy as np
+        
+        os.makedirs(self.root, exist_ok=True)
+        self.dim = vectors.shape[1]
+        name = f"{self.next_segment:05d}"
+        self.next_segment += 1
+        self._write_segment(name, documents, vectors)
+        
+        categories = self._map_segment(name)
+        self.categories = np.concatenate([self.categories, np.array(categories, dtype=object)])
+        self._save_manifest()
+    
+    def compact(self):
+        """把所有段合并为一个段，并删除旧段文件"""
+        import numpy as np
+        
+        if len(self.segments) <= 1:
+            return
+        
+        old_names = [seg["name"] for seg in self.segments]
+        documents = [self.get(row) for row in range(len(self))]
+        vectors = np.concatenate([seg["vectors"] for seg in self.segments])
+        
+        name = f"{self.next_segment:05d}"
+        self.next_segment += 1
+        self._write_segment(name, documents, vectors)
+        
+        self.segments = []
+        self.id_to_row = {}
+        self._map_segment(name)
+        self._save_manifest()
+        
+        for old_name in old_names:
+            for prefix, ext in (("emb", "f32"), ("docs", "jsonl"), ("offsets", "npy"), ("meta", "json")):
+                os.remove(os.path.join(self.root, f"{prefix}_{old_name}.{ext}"))
+    
+    def get(self, row: int) -> dict:
+        """按行号读取一个文档"""
+        seg = self._segment_of(row)
+        local = row - seg["start"]
+        with open(seg["docs_path"], "rb") as f:
+            f.seek(int(seg["offsets"][local]))
+            return json.loads(f.readline())
+    
+    def vector(self, row: int):
+        seg = self._segment_of(row)
+        return seg["vectors"][row - seg["start"]]
+    
+    def iter_vectors(self):
+        """逐段产出 (起始行号, 向量矩阵)"""
+        for seg in self.segments:
+            yield seg["start"], seg["vectors"]
+    
+    def scores(self, query, rows=None):
+        """计算查询向量与指定行（默认全部）的相似度，逐段计算避免整体加载"""
+        import numpy as np
+        
+        if rows is None:
+            return np.concatenate([seg["vectors"] @ query for seg in self.segments])
+        
+        scores = np.empty(len(rows), dtype=np.float32)
+        starts = np.array([seg["start"] for seg in self.segments])
+        seg_index = np.searchsorted(starts, rows, side="right") - 1
+        for i, seg in enumerate(self.segments):
+            mask = seg_index == i
+            if mask.any():
+                scores[mask] = seg["vectors"][rows[mask] - seg["start"]] @ query
+        return scores
+    
+    def _write_segment(self, name: str, documents: list[dict], vectors):
+        import numpy as np
+        
+        np.ascontiguousarray(vectors, dtype=np.float32).tofile(os.path.join(self.root, f"emb_{name}.f32"))
+        
+        offsets = []
+        with open(os.path.join(self.root, f"docs_{name}.jsonl"), "wb") as f:
+            for doc in documents:
+                offsets.append(f.tell())
+                f.write(json.dumps(doc, ensure_ascii=False).encode("utf-8") + b"\n")
+        np.save(os.path.join(self.root, f"offsets_{name}.npy"), np.array(offsets, dtype=np.int64))
+        
+        meta = {
+            "ids": [doc["id"] for doc in documents],
+            "categories": [doc.get("category", "") for doc in documents],
+        }
+        with open(os.path.join(self.root, f"meta_{name}.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, separators=(",", ":"))
+    
+    def _map_segment(self, name: str) -> list:
+        """映射一个段并登记其文档 ID，返回该段的分类列表"""
+        import numpy as np
+        
+        with open(os.path.join(self.root, f"meta_{name}.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        
+        start = len(self.id_to_row)
+        count = len(meta["ids"])
+        self.segments.append({
+            "name": name,
+            "start": start,
+            "count": count,
+            "vectors": np.memmap(
+                os.path.join(self.root, f"emb_{name}.f32"),
+                dtype=np.float32, mode="r", shape=(count, self.dim)
+            ),
+            "offsets": np.load(os.path.join(self.root, f"offsets_{name}.npy"), mmap_mode="r"),
+            "docs_path": os.path.join(self.root, f"docs_{name}.jsonl"),
+        })
+        for i, doc_id in enumerate(meta["ids"]):
+            self.id_to_row[doc_id] = start + i
+        return meta["categories"]
+    
+    def _segment_of(self, row: int) -> dict:
+        for seg in reversed(self.segments):
+            if row >= seg["start"]:
+                return seg
+        raise IndexError(row)
+    
+    def _save_manifest(self):
+        manifest = {
+            "version": 1,
+            "dim": self.dim,
+            "next_segment": self.next_segment,
+            "segments": [seg["name"] for seg in self.segments],
+        }
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
 
 # 示例知识库文档（实际场景从数据库/文件系统加载）
 SAMPLE_DOCUMENTS = [
@@ -91,91 +344,105 @@ SAMPLE_DOCUMENTS = [
     gpu="T4",
     volumes={"/models": model_volume, "/kb": kb_volume},
     timeout=600,
+    mounts=[modal.Mount.from_local_python_packages("embedding_cache")],
 )
 class KnowledgeBase:
     @modal.enter()
     def load_model(self):
         from sentence_transformers import SentenceTransformer
-        import numpy as np
-        import os
+        from embedding_cache import EmbeddingCache
         
         print("🔤 加载嵌入模型...")
-        self.model = SentenceTransformer(
-            "sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
-            cache_folder="/models"
-        )
+        self.model = SentenceTransformer(MODEL_NAME, cache_folder="/models")
         
-        # 尝试加载已有的文档索引
-        self.documents = []
-        self.embeddings = None
+        # 查询嵌入缓存（向量已归一化）
+        self.cache = EmbeddingCache(f"{MODEL_NAME}:normalized", shared=shared_embedding_cache)
         
-        index_path = "/kb/index.json"
-        embeddings_path = "/kb/embeddings.npy"
+        # 映射已有的分段存储（不整体读取文件）
+        self.store = SegmentStore()
+        self.store.load()
+        if not len(self.store):
+            self._migrate_legacy_index()
         
-        if os.path.exists(index_path) and os.path.exists(embeddings_path):
-            print("📚 加载已有知识库索引...")
-            with open(index_path, "r", encoding="utf-8") as f:
-                self.documents = json.load(f)
-            self.embeddings = np.load(embeddings_path)
-            print(f"✓ 已加载 {len(self.documents)} 个文档")
+        if len(self.store):
+            print(f"✓ 已映射 {len(self.store)} 个文档 ({len(self.store.segments)} 个段)")
         else:
             print("📝 知识库为空，需要先导入文档")
         
+        self.ann_index = None
+        self._ann_unsaved = 0
+        if len(self.store) >= BRUTE_FORCE_THRESHOLD:
+            self._ensure_ann_index()
+        
         print("✓ 初始化完成")
     
     @modal.method()
     def index_documents(self, documents: list[dict]) -> dict:
         """
-        索引文档到知识库
+        索引文档到知识库（只写入新文档，成本与已有文档数无关）
         
         Args:
             documents: 文档列表 [{"id": "...", "title": "...", "content": "...", "category": "..."}]
         """
-        import numpy as np
-        
         print(f"📚 索引 {len(documents)} 个文档...")
         
-        # 合并现有文档
-        existing_ids = {doc["id"] for doc in self.documents}
-        new_docs = [d for d in documents if d["id"] not in existing_ids]
+        # 过滤已有文档
+        new_docs = {}
+        for d in documents:
+            if d["id"] not in self.store.id_to_row:
+                new_docs.setdefault(d["id"], d)
+        new_docs = list(new_docs.values())
         
         if not new_docs:
-            return {"status": "no_new_documents", "total": len(self.documents)}
+            return {"status": "no_new_documents", "total": len(self.store)}
         
-        # 生成新文档的嵌入
+        # 生成新文档的归一化嵌入
         texts = [f"{d['title']}. {d['content']}" for d in new_docs]
-        new_embeddings = self.model.encode(texts, convert_to_numpy=True)
+        new_embeddings = self.model.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
         
-        # 合并
-        self.documents.extend(new_docs)
+        # 追加为新段
+        start_row = len(self.store)
+        self.store.append(new_docs, new_embeddings)
         
-        if self.embeddings is not None:
-            self.embeddings = np.vstack([self.embeddings, new_embeddings])
-        else:
-            self.embeddings = new_embeddings
+        # 更新近似索引：已有索引增量添加，文档数首次超过阈值时整体构建
+        if self.ann_index is not None:
+            self.ann_index.add(new_embeddings, start_row)
+            self._ann_unsaved += len(new_docs)
+            if self._ann_unsaved >= HNSW_SAVE_EVERY:
+                self.ann_index.save()
+                self._ann_unsaved = 0
+        elif len(self.store) >= BRUTE_FORCE_THRESHOLD:
+            self._ensure_ann_index()
         
-        # 保存到 Volume
-        with open("/kb/index.json", "w", encoding="utf-8") as f:
-            json.dump(self.documents, f, ensure_ascii=False, indent=2)
-        np.save("/kb/embeddings.npy", self.embeddings)
+        # 段数过多时合并
+        if len(self.store.segments) > MAX_SEGMENTS:
+            self._compact()
         
         kb_volume.commit()
         
-        print(f"✓ 新增 {len(new_docs)} 个文档，总计 {len(self.documents)} 个")
+        print(f"✓ 新增 {len(new_docs)} 个文档，总计 {len(self.store)} 个")
         
         return {
             "status": "success",
             "new_documents": len(new_docs),
-            "total_documents": len(self.documents)
+            "total_documents": len(self.store)
         }
     
+    @modal.method()
+    def compact(self) -> dict:
+        """合并所有段并保存近似索引"""
+        self._compact()
+        kb_volume.commit()
+        return {"status": "success", "segments": len(self.store.segments), "total_documents": len(self.store)}
+    
     @modal.method()
     def search(
         self,
         query: str,
         top_k: int = 5,
         category: str = None,
-        min_score: float = 0.3
+        min_score: float = 0.3,
+        ef: int = None
     ) -> list[dict]:
         """
         语义搜索知识库
@@ -183,39 +450,29 @@ class KnowledgeBase:
         Args:
             query: 搜索问题
             top_k: 返回前 k 个结果
-            category: 限定分类（可选）
+            category: 限定分类（可选，在检索时过滤）
             min_score: 最小相似度阈值
+            ef: HNSW 搜索宽度（可选），越大召回越高、延迟越大
         """
-        from sklearn.metrics.pairwise import cosine_similarity
-        import numpy as np
-        
-        if not self.documents or self.embeddings is None:
+        if not len(self.store):
             return []
         
         print(f"🔍 搜索: {query}")
         
-        # 生成查询嵌入
-        query_embedding = self.model.encode([query])[0]
+        # 生成查询嵌入（重复查询命中缓存）
+        query_embedding = self.cache.get_or_encode([query], self._encode_normalized)[0]
         
-        # 计算相似度
-        similarities = cosine_similarity(
-            query_embedding.reshape(1, -1),
-            self.embeddings
-        )[0]
+        # 分类预过滤
+        allowed = (self.store.categories == category) if category else None
+        rows, scores = self._search_vectors(query_embedding, top_k, allowed=allowed, ef=ef)
         
-        # 筛选和排序
         results = []
-        for i, score in enumerate(similarities):
-            doc = self.documents[i]
-            
-            # 分类过滤
-            if category and doc.get("category") != category:
-                continue
-            
+        for row, score in zip(rows, scores):
             # 分数过滤
             if score < min_score:
                 continue
             
+            doc = self.store.get(int(row))
             results.append({
                 "id": doc["id"],
                 "title": doc["title"],
@@ -224,48 +481,111 @@ class KnowledgeBase:
                 "score": float(score)
             })
         
-        # 排序并返回 top_k
-        results.sort(key=lambda x: x["score"], reverse=True)
-        
-        return results[:top_k]
+        return results
+    
+    @modal.method()
+    def cache_stats(self) -> dict:
+        """查询嵌入缓存的命中、未命中和淘汰计数"""
+        return self.cache.stats()
     
     @modal.method()
     def get_related_documents(self, doc_id: str, top_k: int = 3) -> list[dict]:
         """
         获取相关文档推荐
         """
-        from sklearn.metrics.pairwise import cosine_similarity
-        
-        # 找到目标文档
-        target_idx = None
-        for i, doc in enumerate(self.documents):
-            if doc["id"] == doc_id:
-                target_idx = i
-                break
-        
+        # 通过 ID 索引找到目标文档
+        target_idx = self.store.id_to_row.get(doc_id)
         if target_idx is None:
             return []
         
-        # 计算与其他文档的相似度
-        similarities = cosine_similarity(
-            self.embeddings[target_idx].reshape(1, -1),
-            self.embeddings
-        )[0]
+        # 多取一个结果，排除自身
+        rows, scores = self._search_vectors(self.store.vector(target_idx), top_k + 1)
         
-        # 排序（排除自身）
         results = []
-        for i, score in enumerate(similarities):
-            if i == target_idx:
+        for row, score in zip(rows, scores):
+            if row == target_idx:
                 continue
+            doc = self.store.get(int(row))
             results.append({
-                "id": self.documents[i]["id"],
-                "title": self.documents[i]["title"],
-                "category": self.documents[i].get("category", ""),
+                "id": doc["id"],
+                "title": doc["title"],
+                "category": doc.get("category", ""),
                 "score": float(score)
             })
         
-        results.sort(key=lambda x: x["score"], reverse=True)
         return results[:top_k]
+    
+    def _encode_normalized(self, texts: list[str]):
+        return self.model.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+    
+    def _migrate_legacy_index(self):
+        """把旧格式的 index.json + embeddings.npy 转换为分段存储"""
+        import numpy as np
+        
+        index_path = "/kb/index.json"
+        embeddings_path = "/kb/embeddings.npy"
+        if not (os.path.exists(index_path) and os.path.exists(embeddings_path)):
+            return
+        
+        print("📦 转换旧格式知识库索引...")
+        with open(index_path, "r", encoding="utf-8") as f:
+            documents = json.load(f)
+        embeddings = np.load(embeddings_path)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.store.append(documents, embeddings / np.maximum(norms, 1e-12))
+        kb_volume.commit()
+    
+    def _compact(self):
+        print(f"🗜️ 合并 {len(self.store.segments)} 个段...")
+        self.store.compact()
+        if self.ann_index is not None:
+            self.ann_index.save()
+            self._ann_unsaved = 0
+    
+    def _ensure_ann_index(self):
+        """加载或构建近似索引，并补齐上次保存之后追加的文档"""
+        if ANN_BACKEND is None:
+            return
+        
+        self.ann_index = ANN_BACKENDS[ANN_BACKEND](self.store.dim)
+        indexed = self.ann_index.load(len(self.store))
+        if indexed:
+            print(f"✓ 已加载 {ANN_BACKEND} 索引 ({indexed} 个文档)")
+        else:
+            print(f"🏗️ 构建 {ANN_BACKEND} 索引 ({len(self.store)} 个文档)...")
+            self.ann_index = ANN_BACKENDS[ANN_BACKEND](self.store.dim)
+            self.ann_index.init(len(self.store))
+        
+        for start, vectors in self.store.iter_vectors():
+            if start + len(vectors) > indexed:
+                offset = max(indexed - start, 0)
+                self.ann_index.add(vectors[offset:], start + offset)
+        
+        if len(self.store) > indexed:
+            self.ann_index.save()
+            kb_volume.commit()
+    
+    def _search_vectors(self, query, k: int, allowed=None, ef: int = None):
+        """
+        返回相似度最高的 (行号数组, 相似度数组)
+        候选文档数低于 BRUTE_FORCE_THRESHOLD 或没有近似索引时使用精确检索
+        """
+        import numpy as np
+        
+        candidate_count = int(allowed.sum()) if allowed is not None else len(self.store)
+        k = min(k, candidate_count)
+        if k <= 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        
+        if self.ann_index is not None and candidate_count >= BRUTE_FORCE_THRESHOLD:
+            return self.ann_index.search(query, k, ef=ef, allowed=allowed)
+        
+        # 精确检索：只对候选行做矩阵-向量乘法
+        rows = np.flatnonzero(allowed) if allowed is not None else np.arange(len(self.store))
+        scores = self.store.scores(query, rows if allowed is not None else None)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return rows[top], scores[top]
 
 
 @app.function(image=image)
@@ -278,7 +598,8 @@ def kb_search_api(data: dict):
     {
         "query": "如何申请年假？",
         "top_k": 5,
-        "category": "人事制度"  // 可选
+        "category": "人事制度",  // 可选
+        "ef": 128               // 可选，HNSW 搜索宽度
     }
     """
     kb = KnowledgeBase()
@@ -286,7 +607,8 @@ def kb_search_api(data: dict):
     results = kb.search.remote(
         query=data.get("query", ""),
         top_k=data.get("top_k", 5),
-        category=data.get("category")
+        category=data.get("category"),
+        ef=data.get("ef")
     )
     
     return {
@@ -355,5 +677,6 @@ def main():
     print("\n💡 提示:")
     print("1. 实际使用时从数据库/文件系统加载文档")
     print("2. 支持增量更新，无需全量重建索引")
+    print(f"   文档数超过 {BRUTE_FORCE_THRESHOLD} 时自动启用持久化的 HNSW 索引")
     print("3. 可配合 LLM 实现问答式知识库")
 
@@ -3,6 +3,15 @@
 使用 Sentence Transformers 生成文本向量
 用于语义搜索、相似度计算等
 """
+import collections
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
+
 import modal
 
 app = modal.App("embedding-service")
@@ -19,33 +28,63 @@ image = (
 # 模型缓存
 model_volume = modal.Volume.from_name("embedding-models", create_if_missing=True)
 
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+
+# 命名文档集合：嵌入预先计算，以 fp16 归一化矩阵保存在模型 Volume 上
+COLLECTIONS_DIR = "/models/collections"
+COLLECTION_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+REGISTER_CHUNK_TEXTS = 4096   # 注册集合时每次提交编码的文本数，避免长时间独占微批处理线程
+
+# 微批处理参数
+MAX_BATCH_TEXTS = 256    # 合并后单次 model.encode 的最大文本数
+MAX_WAIT_MS = 10         # 等待更多请求加入批次的最长时间
+ENCODE_BATCH_SIZE = 64   # model.encode 内部按长度排序分桶后的 GPU 批大小
+LATENCY_WINDOW = 1000    # 统计延迟分位数时保留的最近请求数
+
+# 跨容器共享的嵌入缓存（键已包含模型和归一化方式，各嵌入应用可共用）
+shared_embedding_cache = modal.Dict.from_name("embedding-cache", create_if_missing=True)
+
 
 @app.cls(
     image=image,
     gpu="T4",
     volumes={"/models": model_volume},
     timeout=600,
+    mounts=[modal.Mount.from_local_python_packages("embedding_cache")],
 )
+@modal.concurrent(max_inputs=64)
 class EmbeddingService:
     @modal.enter()
     def load_model(self):
         """加载嵌入模型"""
         from sentence_transformers import SentenceTransformer
+        from embedding_cache import EmbeddingCache
         
         print("🔤 加载嵌入模型...")
         
         # 使用多语言模型
-        self.model = SentenceTransformer(
-            "sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
-            cache_folder="/models"
-        )
+        self.model = SentenceTransformer(MODEL_NAME, cache_folder="/models")
         
         print("✓ 模型加载完成")
+        
+        # 启动微批处理线程：并发请求排队后合并为一次 model.encode
+        self._requests = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._counters = {"requests": 0, "texts": 0, "batches": 0, "encode_seconds": 0.0}
+        self._started_at = time.monotonic()
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        
+        # 嵌入缓存：重复的查询和文档不再重新编码（encode 返回未归一化的向量）
+        self.cache = EmbeddingCache(f"{MODEL_NAME}:raw", shared=shared_embedding_cache)
+        
+        # 已加载到 GPU 的命名集合 {name: {"embeddings": fp16 tensor, "documents": [...]}}
+        self.collections = {}
     
     @modal.method()
     def encode(self, texts: list[str]) -> list[list[float]]:
         """
-        生成文本嵌入向量
+        生成文本嵌入向量（与并发请求合并批处理）
         
         Args:
             texts: 文本列表
@@ -55,15 +94,115 @@ class EmbeddingService:
         """
         print(f"🔤 生成 {len(texts)} 个文本的嵌入向量...")
         
-        embeddings = self.model.encode(
-            texts,
-            convert_to_numpy=True,
-            show_progress_bar=False
-        )
+        embeddings = self._encode(texts)
         
         print("✓ 嵌入向量生成完成")
         return embeddings.tolist()
     
+    @modal.web_endpoint(method="POST")
+    def embed_texts(self, data: dict):
+        """
+        Web API: 生成嵌入向量
+        直接在模型容器中处理，并发的 HTTP 请求会被合并批处理
+        URL 为 EmbeddingService 类端点；原有的 embed_texts 函数端点仍然保留
+        
+        POST /embed_texts
+        {
+            "texts": ["text1", "text2", ...]
+        }
+        """
+        return {"embeddings": self._encode(data["texts"]).tolist()}
+    
+    @modal.method()
+    def stats(self) -> dict:
+        """
+        微批处理和嵌入缓存指标
+        
+        Returns:
+            请求数、批次数、吞吐量 (texts/s)、最近请求的 p50/p99 延迟 (ms) 和缓存命中情况
+        """
+        import numpy as np
+        
+        with self._stats_lock:
+            counters = dict(self._counters)
+            latencies = np.array(self._latencies)
+        
+        elapsed = time.monotonic() - self._started_at
+        return {
+            **counters,
+            "avg_batch_texts": counters["texts"] / counters["batches"] if counters["batches"] else 0,
+            "throughput_texts_per_s": counters["texts"] / elapsed if elapsed > 0 else 0,
+            "p50_ms": float(np.percentile(latencies, 50) * 1000) if len(latencies) else 0,
+            "p99_ms": float(np.percentile(latencies, 99) * 1000) if len(latencies) else 0,
+            "cache": self.cache.stats(),
+        }
+    
+    def _encode(self, texts: list[str]):
+        """返回 numpy 嵌入矩阵，缓存未命中的文本提交给微批处理线程"""
+        import numpy as np
+        
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        
+        return self.cache.get_or_encode(texts, self._submit)
+    
+    def _submit(self, texts: list[str]):
+        """把文本提交给微批处理线程，等待编码结果"""
+        future = Future()
+        self._requests.put((texts, future, time.monotonic()))
+        return future.result()
+    
+    def _batch_loop(self):
+        """微批处理线程：收集请求直到达到 MAX_BATCH_TEXTS 或等待超过 MAX_WAIT_MS"""
+        while True:
+            batch = [self._requests.get()]
+            total = len(batch[0][0])
+            deadline = time.monotonic() + MAX_WAIT_MS / 1000
+            
+            while total < MAX_BATCH_TEXTS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                total += len(request[0])
+            
+            self._encode_batch(batch)
+    
+    def _encode_batch(self, batch):
+        """对合并后的文本执行一次 model.encode，并把结果切分回各请求"""
+        texts = [text for request_texts, _, _ in batch for text in request_texts]
+        
+        start = time.monotonic()
+        try:
+            # encode 内部按文本长度排序后分桶，同一桶内 padding 最少
+            embeddings = self.model.encode(
+                texts,
+                batch_size=ENCODE_BATCH_SIZE,
+                convert_to_numpy=True,
+                show_progress_bar=False
+            )
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        
+        done = time.monotonic()
+        offset = 0
+        for request_texts, future, enqueued_at in batch:
+            future.set_result(embeddings[offset:offset + len(request_texts)])
+            offset += len(request_texts)
+        
+        with self._stats_lock:
+            self._counters["requests"] += len(batch)
+            self._counters["texts"] += len(texts)
+            self._counters["batches"] += 1
+            self._counters["encode_seconds"] += done - start
+            self._latencies.extend(done - enqueued_at for _, _, enqueued_at in batch)
+    
     @modal.method()
     def similarity(self, text1: str, text2: str) -> float:
         """
@@ -79,7 +218,7 @@ class EmbeddingService:
         from sklearn.metrics.pairwise import cosine_similarity
         import numpy as np
         
-        embeddings = self.model.encode([text1, text2])
+        embeddings = self._encode([text1, text2])
         similarity = cosine_similarity(
             embeddings[0].reshape(1, -1),
             embeddings[1].reshape(1, -1)
@@ -87,32 +226,77 @@ class EmbeddingService:
         
         return float(similarity)
     
+    @modal.method()
+    def register_collection(self, name: str, documents: list[str]) -> dict:
+        """
+        注册命名文档集合：一次性编码并持久化，之后搜索只需编码查询
+        
+        Args:
+            name: 集合名称（字母、数字、下划线和连字符），同名集合会被覆盖
+            documents: 文档列表
+        
+        Returns:
+            集合信息
+        """
+        import numpy as np
+        
+        path = self._collection_path(name)
+        print(f"📚 注册集合 {name}: {len(documents)} 个文档...")
+        
+        # 分块提交给微批处理线程，在线请求可以穿插执行；大规模语料不写入嵌入缓存
+        chunks = []
+        for start in range(0, len(documents), REGISTER_CHUNK_TEXTS):
+            chunks.append(self._submit(documents[start:start + REGISTER_CHUNK_TEXTS]))
+        dim = self.model.get_sentence_embedding_dimension()
+        embeddings = np.concatenate(chunks) if chunks else np.zeros((0, dim), dtype=np.float32)
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        
+        # 先写临时文件再替换，避免并发加载读到不完整的集合
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "embeddings.tmp.npy"), embeddings.astype(np.float16))
+        with open(os.path.join(path, "documents.tmp.json"), "w", encoding="utf-8") as f:
+            json.dump(documents, f, ensure_ascii=False)
+        os.replace(os.path.join(path, "embeddings.tmp.npy"), os.path.join(path, "embeddings.npy"))
+        os.replace(os.path.join(path, "documents.tmp.json"), os.path.join(path, "documents.json"))
+        model_volume.commit()
+        
+        self.collections.pop(name, None)
+        self._load_collection(name)
+        
+        print(f"✓ 集合 {name} 已保存")
+        return {"name": name, "documents": len(documents), "dim": dim, "dtype": "float16"}
+    
     @modal.method()
     def search(
         self,
         query: str,
-        documents: list[str],
-        top_k: int = 5
+        documents: list[str] = None,
+        top_k: int = 5,
+        collection: str = None
     ) -> list[dict]:
         """
         语义搜索
         
         Args:
             query: 查询文本
-            documents: 文档列表
+            documents: 文档列表（与 collection 二选一）
             top_k: 返回前 k 个结果
+            collection: 已注册的集合名称，只编码查询并做一次矩阵-向量乘
         
         Returns:
             相似文档列表
         """
+        if collection is not None:
+            return self._search_collection(query, collection, top_k)
+        
         from sklearn.metrics.pairwise import cosine_similarity
         import numpy as np
         
         print(f"🔍 在 {len(documents)} 个文档中搜索...")
         
-        # 生成嵌入
-        query_embedding = self.model.encode([query])[0]
-        doc_embeddings = self.model.encode(documents)
+        # 生成嵌入（重复的文档列表直接命中缓存）
+        query_embedding = self._encode([query])[0]
+        doc_embeddings = self._encode(documents)
         
         # 计算相似度
         similarities = cosine_similarity(
@@ -134,13 +318,59 @@ class EmbeddingService:
         
         print(f"✓ 找到 {len(results)} 个相关文档")
         return results
+    
+    def _search_collection(self, query: str, name: str, top_k: int) -> list[dict]:
+        """在命名集合中搜索：一次查询编码 + 一次 GPU 上的 fp16 矩阵-向量乘"""
+        import torch
+        
+        entry = self.collections.get(name) or self._load_collection(name)
+        embeddings = entry["embeddings"]
+        
+        query_embedding = torch.from_numpy(self._encode([query])[0]).to(embeddings.device)
+        query_embedding = (query_embedding / query_embedding.norm().clamp_min(1e-12)).to(embeddings.dtype)
+        
+        scores = embeddings @ query_embedding
+        top = torch.topk(scores.float(), min(top_k, scores.shape[0]))
+        
+        return [
+            {"index": idx, "text": entry["documents"][idx], "score": score}
+            for idx, score in zip(top.indices.tolist(), top.values.tolist())
+        ]
+    
+    def _collection_path(self, name: str) -> str:
+        if not COLLECTION_NAME_PATTERN.match(name):
+            raise ValueError(f"集合名称无效: {name!r}")
+        return os.path.join(COLLECTIONS_DIR, name)
+    
+    def _load_collection(self, name: str) -> dict:
+        """从 Volume 加载集合到 GPU；本容器没有时先 reload，以看到其他容器注册的集合"""
+        import numpy as np
+        import torch
+        
+        path = self._collection_path(name)
+        if not os.path.exists(os.path.join(path, "embeddings.npy")):
+            model_volume.reload()
+            if not os.path.exists(os.path.join(path, "embeddings.npy")):
+                raise KeyError(f"集合不存在: {name}")
+        
+        embeddings = np.load(os.path.join(path, "embeddings.npy"))
+        with open(os.path.join(path, "documents.json"), encoding="utf-8") as f:
+            documents = json.load(f)
+        
+        entry = {
+            "embeddings": torch.from_numpy(embeddings).to(self.model.device),
+            "documents": documents,
+        }
+        self.collections[name] = entry
+        print(f"✓ 已加载集合 {name}: {len(documents)} 个文档")
+        return entry
 
 
 @app.function(image=image)
 @modal.web_endpoint(method="POST")
 def embed_texts(data: dict):
     """
-    Web API: 生成嵌入向量
+    Web API: 生成嵌入向量（保留原有 URL，转发到 EmbeddingService.encode）
     
     POST /embed_texts
     {
@@ -164,12 +394,20 @@ def semantic_search(data: dict):
         "documents": ["doc1", "doc2", ...],
         "top_k": 5
     }
+    
+    或在已注册的集合中搜索:
+    {
+        "query": "search query",
+        "collection": "catalog",
+        "top_k": 5
+    }
     """
     service = EmbeddingService()
     results = service.search.remote(
         query=data["query"],
-        documents=data["documents"],
-        top_k=data.get("top_k", 5)
+        documents=data.get("documents"),
+        top_k=data.get("top_k", 5),
+        collection=data.get("collection")
     )
     return {"results": results}
 
@@ -196,3 +434,11 @@ def main():
     print("搜索结果:")
     for i, result in enumerate(results, 1):
         print(f"{i}. [{result['score']:.3f}] {result['text']}")
+    
+    # 注册为命名集合后，搜索只需编码查询
+    service.register_collection.remote("demo", documents)
+    results = service.search.remote(query, top_k=3, collection="demo")
+    
+    print("\n集合搜索结果:")
+    for i, result in enumerate(results, 1):
+        print(f"{i}. [{result['score']:.3f}] {result['text']}")
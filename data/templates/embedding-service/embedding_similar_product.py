@@ -24,12 +24,17 @@ image = (
         "sentence-transformers",
         "torch==2.1.0",
         "numpy",
-        "scikit-learn",
     )
 )
 
 model_volume = modal.Volume.from_name("embedding-models", create_if_missing=True)
 
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+
+# 跨容器共享的嵌入缓存（键已包含模型和归一化方式，各嵌入应用可共用）
+shared_embedding_cache = modal.Dict.from_name("embedding-cache", create_if_missing=True)
+
+
 # 示例商品库
 SAMPLE_PRODUCTS = [
     {"id": "P001", "name": "羽绒服男款加厚", "desc": "冬季保暖羽绒服，90%白鹅绒填充，防风防水面料", "price": 599, "category": "男装"},
@@ -48,23 +53,35 @@ SAMPLE_PRODUCTS = [
     gpu="T4",
     volumes={"/models": model_volume},
     timeout=600,
+    mounts=[modal.Mount.from_local_python_packages("embedding_cache")],
 )
 class ProductRecommender:
     @modal.enter()
     def load_model(self):
         from sentence_transformers import SentenceTransformer
+        from embedding_cache import EmbeddingCache
         import numpy as np
         
         print("🔤 加载嵌入模型...")
-        self.model = SentenceTransformer(
-            "sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
-            cache_folder="/models"
-        )
+        self.model = SentenceTransformer(MODEL_NAME, cache_folder="/models")
+        
+        # 查询嵌入缓存：重复的查询不再重新编码
+        self.cache = EmbeddingCache(f"{MODEL_NAME}:normalized", shared=shared_embedding_cache)
         
-        # 预计算商品嵌入
+        # 预计算归一化的商品嵌入（点积即余弦相似度）
+        # 商品目录直接编码，不经过缓存：整个目录写入共享缓存代价很大，还会把查询条目挤出 LRU
         self.products = SAMPLE_PRODUCTS
         texts = [f"{p['name']} {p['desc']}" for p in self.products]
-        self.embeddings = self.model.encode(texts, convert_to_numpy=True)
+        self.embeddings = self._encode_normalized(texts)
+        
+        # 列式商品元数据：分类编码和价格数组用于向量化过滤，ID 哈希索引用于定位行号
+        self.category_codes = {}
+        self.categories = np.array(
+            [self.category_codes.setdefault(p["category"], len(self.category_codes)) for p in self.products],
+            dtype=np.int32
+        )
+        self.prices = np.array([p["price"] for p in self.products], dtype=np.float64)
+        self.id_to_row = {p["id"]: i for i, p in enumerate(self.products)}
         
         print(f"✓ 已索引 {len(self.products)} 个商品")
     
@@ -79,70 +96,82 @@ class ProductRecommender:
         """
         根据用户描述搜索商品
         """
-        from sklearn.metrics.pairwise import cosine_similarity
+        import numpy as np
+        
+        query_embedding = self.cache.get_or_encode([query], self._encode_normalized)[0]
+        
+        # 用布尔掩码完成分类和价格过滤
+        mask = None
+        if category:
+            if category not in self.category_codes:
+                return []
+            mask = self.categories == self.category_codes[category]
+        if max_price:
+            price_mask = self.prices <= max_price
+            mask = price_mask if mask is None else mask & price_mask
         
-        query_embedding = self.model.encode([query])[0]
-        similarities = cosine_similarity(
-            query_embedding.reshape(1, -1),
-            self.embeddings
-        )[0]
+        rows = np.flatnonzero(mask) if mask is not None else None
+        candidates = self.embeddings if rows is None else self.embeddings[rows]
+        top = self._top_k(candidates @ query_embedding, top_k)
         
         results = []
-        for i, score in enumerate(similarities):
-            p = self.products[i]
-            
-            if category and p["category"] != category:
-                continue
-            if max_price and p["price"] > max_price:
-                continue
-            
+        for i, score in top:
+            p = self.products[i if rows is None else rows[i]]
             results.append({
                 "id": p["id"],
                 "name": p["name"],
                 "description": p["desc"],
                 "price": p["price"],
                 "category": p["category"],
-                "score": float(score)
+                "score": score
             })
         
-        results.sort(key=lambda x: x["score"], reverse=True)
-        return results[:top_k]
+        return results
     
     @modal.method()
     def find_similar(self, product_id: str, top_k: int = 3) -> list[dict]:
         """
         找到相似商品
         """
-        from sklearn.metrics.pairwise import cosine_similarity
-        
-        idx = None
-        for i, p in enumerate(self.products):
-            if p["id"] == product_id:
-                idx = i
-                break
+        import numpy as np
         
+        idx = self.id_to_row.get(product_id)
         if idx is None:
             return []
         
-        similarities = cosine_similarity(
-            self.embeddings[idx].reshape(1, -1),
-            self.embeddings
-        )[0]
+        similarities = self.embeddings @ self.embeddings[idx]
+        similarities[idx] = -np.inf  # 排除自身
         
         results = []
-        for i, score in enumerate(similarities):
-            if i == idx:
-                continue
+        for i, score in self._top_k(similarities, min(top_k, len(self.products) - 1)):
             p = self.products[i]
             results.append({
                 "id": p["id"],
                 "name": p["name"],
                 "price": p["price"],
-                "score": float(score)
+                "score": score
             })
         
-        results.sort(key=lambda x: x["score"], reverse=True)
-        return results[:top_k]
+        return results
+    
+    @modal.method()
+    def cache_stats(self) -> dict:
+        """嵌入缓存的命中、未命中和淘汰计数"""
+        return self.cache.stats()
+    
+    def _encode_normalized(self, texts: list[str]):
+        return self.model.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+    
+    def _top_k(self, scores, k: int) -> list[tuple[int, float]]:
+        """用 argpartition 选出分数最高的 k 个，只对这 k 个排序"""
+        import numpy as np
+        
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
 
 
 @app.function(image=image)
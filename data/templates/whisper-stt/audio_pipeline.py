@@ -0,0 +1,490 @@
+"""
+Whisper 转录流水线：模型后端、长音频切块并行
+供 whisper-stt/*.py 共用
+
+一次 model.transcribe 只能按 30 秒窗口顺序解码，两小时的会议会占住一张 T4 大半个小时。
+这里按静音处（能量 VAD）把音频切成带重叠的块，块分发到多个容器并行转录，
+再按块在原音频中的位置修正时间戳，拼接时只保留中点落在块核心区间内的分段，并去掉重叠区的重复文本。
+
+音频经 ffmpeg 管道增量解码为 PCM 块（stream_pcm），来源可以是 Volume 上的文件、完整字节或分块上传的请求体；
+切块、分发与解码同时进行，内存中只保留当前缓冲的几分钟音频，峰值内存与文件长度无关。
+
+实时场景（RealtimeSession）：持续接收 PCM 帧，对滚动缓冲区反复转录，输出临时结果和时间戳固定的定稿分段。
+
+两种推理后端（各服务类按场景选择，输出的分段结构一致）：
+- openai-whisper: 原版实现，逐个 30 秒窗口解码
+- faster-whisper: CTranslate2 实现，VAD 切出语音段后批量编码/解码多个窗口，支持 float16 / int8 权重，吞吐更高
+"""
+import itertools
+import os
+import re
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SAMPLE_RATE = 16000             # Whisper 输入采样率
+BLOCK_SECONDS = 4               # ffmpeg 管道每次读出的 PCM 时长
+CHUNK_SECONDS = 240             # 目标块长，不足一块的音频不切分
+OVERLAP_SECONDS = 5             # 块两侧各多带的上下文
+SILENCE_SEARCH_SECONDS = 20     # 在目标切点前多长范围内找最安静的位置
+FRAME_SECONDS = 0.03            # VAD 帧长
+SILENCE_SMOOTH_FRAMES = 10      # 能量平滑窗口（帧），避免切在词间的短暂停顿
+BATCH_SIZE = 16                 # faster-whisper 每批解码的窗口数
+
+REALTIME_STEP_SECONDS = 1.0         # 实时转录：每收到这么多新音频转录一次
+REALTIME_STABLE_SECONDS = 1.5       # 结束于缓冲末尾这么久之前、且连续两次一致的分段才定稿
+REALTIME_WINDOW_SECONDS = 20        # 缓冲超过该时长时，除最后一段外强制定稿
+REALTIME_MAX_BUFFER_SECONDS = 28    # 不超过 Whisper 的 30 秒窗口，超过时全部定稿
+REALTIME_SILENCE_RMS = 0.01         # 缓冲区均方根低于该值视为静音（约 -40 dBFS）
+
+UPLOADS_DIR = "/uploads"            # whisper-uploads Volume 的挂载点
+
+
+def load_model(
+    model_size: str = "medium",
+    backend: str = "openai-whisper",
+    compute_type: str = "float16",
+    download_root: str = "/models",
+    device: str = "cuda",
+):
+    """
+    按后端加载 Whisper 模型
+
+    Args:
+        model_size: tiny, base, small, medium, large-v3 等
+        backend: "openai-whisper" 或 "faster-whisper"
+        compute_type: faster-whisper 的权重精度，float16 / int8_float16 / int8
+        download_root: 模型缓存目录
+        device: "cuda" 或 "cpu"
+    """
+    if backend == "faster-whisper":
+        return BatchedWhisper(model_size, compute_type, download_root, device)
+    if backend != "openai-whisper":
+        raise ValueError(f"不支持的后端: {backend}")
+
+    import whisper
+
+    return whisper.load_model(model_size, download_root=download_root, device=device)
+
+
+class BatchedWhisper:
+    """faster-whisper 批量解码后端，transcribe / detect_language 与 openai-whisper 路径返回相同结构"""
+
+    def __init__(self, model_size: str, compute_type: str, download_root: str, device: str = "cuda",
+                 batch_size: int = BATCH_SIZE):
+        from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+        self.model = WhisperModel(
+            model_size, device=device, compute_type=compute_type, download_root=download_root
+        )
+        self.pipeline = BatchedInferencePipeline(model=self.model)
+        self.batch_size = batch_size
+
+    def transcribe(self, audio: np.ndarray, language: str = None, task: str = "transcribe") -> dict:
+        # 保留时间戳 token，分段粒度与 openai-whisper 接近，而不是整个 VAD 语音段一条
+        segments, info = self.pipeline.transcribe(
+            audio,
+            language=language,
+            task=task,
+            batch_size=self.batch_size,
+            without_timestamps=False,
+        )
+        segments = [{"start": seg.start, "end": seg.end, "text": seg.text} for seg in segments]
+        return {
+            "text": "".join(seg["text"] for seg in segments),
+            "language": info.language,
+            "segments": segments
+        }
+
+    def detect_language(self, audio: np.ndarray) -> str:
+        language, _, _ = self.model.detect_language(audio[: 30 * SAMPLE_RATE])
+        return language
+
+
+def audio_source(audio_data: bytes = None, audio_path: str = None, volume=None):
+    """
+    音频来源：Volume 上的文件路径优先，否则为请求中的字节
+
+    audio_path 为相对 UPLOADS_DIR 的路径；解析符号链接和 ".." 后必须仍位于 UPLOADS_DIR 内，否则抛出 ValueError。
+    给出 volume 时先 reload，以读到其他容器刚上传的文件。
+    """
+    if not audio_path:
+        return audio_data
+
+    root = os.path.realpath(UPLOADS_DIR)
+    path = os.path.realpath(os.path.join(root, audio_path.lstrip("/")))
+    if not path.startswith(root + os.sep):
+        raise ValueError(f"audio_path 必须位于 {UPLOADS_DIR} 内: {audio_path}")
+    if volume is not None:
+        volume.reload()
+    return path
+
+
+def stream_pcm(source, block_seconds: float = BLOCK_SECONDS):
+    """
+    用 ffmpeg 管道把音频增量解码为 16 kHz 单声道 float32 块
+
+    Args:
+        source: 文件路径（如 Volume 上的上传文件）、完整字节，或字节块的可迭代对象（如分块上传的 HTTP 请求体）
+        block_seconds: 每次产出的 PCM 时长
+
+    边读边解码，内存中只保留当前块，与文件总长无关。
+    """
+    temp_path = None
+    blocks = None
+    if not isinstance(source, str):
+        blocks = iter([source]) if isinstance(source, (bytes, bytearray, memoryview)) else iter(source)
+        head = next(blocks, b"")
+        blocks = itertools.chain([head], blocks)
+        # MP4/M4A/MOV 的索引（moov）常在文件末尾，管道不能回读，先落盘再按文件解码
+        if bytes(head[4:8]) == b"ftyp":
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as f:
+                for data in blocks:
+                    f.write(data)
+            source = temp_path = f.name
+            blocks = None
+
+    proc = subprocess.Popen(
+        ["ffmpeg", "-loglevel", "error", "-threads", "0",
+         "-i", "pipe:0" if blocks is not None else source,
+         "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"],
+        stdin=subprocess.PIPE if blocks is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    feeder = None
+    if blocks is not None:
+        def feed():
+            try:
+                for data in blocks:
+                    proc.stdin.write(data)
+            except (BrokenPipeError, ValueError):
+                # ffmpeg 已退出：继续消费上游，避免上传方阻塞在有界队列上
+                for _ in blocks:
+                    pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+    block_bytes = int(block_seconds * SAMPLE_RATE) * 2
+    try:
+        while data := proc.stdout.read(block_bytes):
+            yield np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg 解码失败: {proc.stderr.read().decode(errors='ignore').strip()}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if feeder is not None:
+            feeder.join()
+        if temp_path is not None:
+            os.unlink(temp_path)
+
+
+def transcribe_array(model, audio: np.ndarray, language: str = None, task: str = "transcribe") -> dict:
+    """单次转录一段 PCM 音频，返回 {"text", "language", "segments"}"""
+    if isinstance(model, BatchedWhisper):
+        return model.transcribe(audio, language, task)
+
+    result = model.transcribe(
+        audio,
+        language=language,
+        task=task,
+        fp16=model.device.type == "cuda"
+    )
+    return {
+        "text": result["text"],
+        "language": result.get("language"),
+        "segments": [
+            {
+                "start": seg["start"],
+                "end": seg["end"],
+                "text": seg["text"]
+            }
+            for seg in result.get("segments", [])
+        ]
+    }
+
+
+def transcribe_stream(model, blocks, chunk_fn=None, language: str = None, task: str = "transcribe") -> dict:
+    """
+    边解码边转录
+
+    Args:
+        model: 当前容器已加载的模型（load_model 返回值），用于检测语言和转录第一块
+        blocks: stream_pcm 返回的 PCM 块生成器
+        chunk_fn: 转录单块的 Modal 方法（签名同 transcribe_array 去掉 model）。
+            给出时其余块一解码出来就通过 .map 分发到其他容器；为 None 时在本容器逐块转录
+        language: 语言代码，None 时用第一块检测一次，所有块使用同一语言
+        task: "transcribe" 或 "translate"
+
+    Returns:
+        与 transcribe_array 相同结构的结果
+    """
+    chunks = iter_chunks(blocks)
+    try:
+        first = next(chunks, None)
+        if first is None:
+            return {"text": "", "language": language, "segments": []}
+
+        if language is None:
+            language = detect_language(model, first[1])
+            print(f"🌐 检测到语言: {language}")
+
+        metas = [first[0]]
+
+        def rest():
+            for meta, pcm in chunks:
+                metas.append(meta)
+                yield pcm
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            if chunk_fn is not None:
+                # 其余块边解码边分发到其他容器，当前容器同时转录第一块，GPU 不闲置
+                pending = pool.submit(
+                    lambda: list(chunk_fn.map(rest(), kwargs={"language": language, "task": task}))
+                )
+                results = [transcribe_array(model, first[1], language, task)] + pending.result()
+            else:
+                # 本容器逐块转录，同时在后台解码下一块
+                pieces, pcm, results = rest(), first[1], []
+                while pcm is not None:
+                    upcoming = pool.submit(next, pieces, None)
+                    results.append(transcribe_array(model, pcm, language, task))
+                    pcm = upcoming.result()
+    finally:
+        # 出错提前退出时也关闭解码流，结束 ffmpeg 进程
+        blocks.close()
+
+    if len(metas) > 1:
+        print(f"✂️ {metas[-1]['end'] / SAMPLE_RATE / 60:.1f} 分钟音频按静音切为 {len(metas)} 块转录")
+    segments = stitch_segments(metas, [result["segments"] for result in results])
+    return {
+        "text": "".join(seg["text"] for seg in segments),
+        "language": language,
+        "segments": segments
+    }
+
+
+def detect_language(model, audio: np.ndarray) -> str:
+    """用开头 30 秒检测语言"""
+    if isinstance(model, BatchedWhisper):
+        return model.detect_language(audio)
+
+    import whisper
+
+    clip = whisper.pad_or_trim(audio[: 30 * SAMPLE_RATE])
+    mel = whisper.log_mel_spectrogram(clip, model.dims.n_mels).to(model.device)
+    _, probs = model.detect_language(mel)
+    return max(probs, key=probs.get)
+
+
+class RealtimeSession:
+    """
+    实时转录会话：滚动缓冲，边收边转录
+
+    每收到 REALTIME_STEP_SECONDS 新音频就对整个缓冲区转录一次。
+    连续两次结果一致、且在缓冲末尾 REALTIME_STABLE_SECONDS 之前结束的分段定稿，缓冲区推进到定稿处，
+    之后的分段作为临时结果，可能在下次转录时被修正。定稿分段的时间戳是相对会话开始的绝对时间，不再变化。
+    """
+
+    def __init__(self, model, language: str = None, task: str = "transcribe"):
+        self.model = model
+        self.language = language
+        self.task = task
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.offset = 0.0           # buffer[0] 相对会话开始的秒数
+        self.pending = []           # 尚未并入缓冲区的帧
+        self.remainder = b""        # 帧边界切开的半个采样
+        self.received = 0           # 累计收到的采样数
+        self.transcribed = 0        # 上次转录时已收到的采样数
+        self.previous = []          # 上次转录的未定稿分段
+        self.lock = threading.Lock()  # 收帧与转录在不同线程
+
+    def feed(self, data: bytes):
+        """追加 16 kHz 单声道 s16le PCM 帧"""
+        data = self.remainder + data
+        usable = len(data) // 2 * 2
+        self.remainder = data[usable:]
+        if usable:
+            pcm = np.frombuffer(data[:usable], np.int16).astype(np.float32) / 32768.0
+            with self.lock:
+                self.pending.append(pcm)
+                self.received += len(pcm)
+
+    def ready(self) -> bool:
+        return self.received - self.transcribed >= REALTIME_STEP_SECONDS * SAMPLE_RATE
+
+    def step(self, final: bool = False) -> list[dict]:
+        """
+        转录当前缓冲区，返回事件列表
+        {"type": "final" | "interim", "start", "end", "text"}；final=True 时把剩余分段全部定稿
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.transcribed = self.received
+        self.buffer = np.concatenate([self.buffer, *pending])
+        buffer_end = self.offset + len(self.buffer) / SAMPLE_RATE
+
+        # 整个缓冲区都是静音时不转录，避免 Whisper 在静音上编造文本
+        if not len(self.buffer) or np.sqrt(np.mean(self.buffer ** 2)) < REALTIME_SILENCE_RMS:
+            if len(self.buffer) > REALTIME_WINDOW_SECONDS * SAMPLE_RATE:
+                self._advance(buffer_end - REALTIME_STABLE_SECONDS)
+            self.previous = []
+            return []
+
+        result = transcribe_array(self.model, self.buffer, self.language, self.task)
+        self.language = self.language or result["language"]
+        segments = [
+            {"start": round(self.offset + seg["start"], 2), "end": round(self.offset + seg["end"], 2),
+             "text": seg["text"]}
+            for seg in result["segments"]
+            if _normalize(seg["text"])
+        ]
+
+        overflow = len(self.buffer) > REALTIME_MAX_BUFFER_SECONDS * SAMPLE_RATE
+        if final or overflow:
+            done = segments
+        else:
+            done = []
+            for seg, prev in zip(segments, self.previous):
+                if seg["end"] > buffer_end - REALTIME_STABLE_SECONDS or _normalize(seg["text"]) != _normalize(prev["text"]):
+                    break
+                done.append(seg)
+            # 缓冲区超过窗口时，除最后一段外强制定稿，控制每次转录的耗时
+            if len(self.buffer) > REALTIME_WINDOW_SECONDS * SAMPLE_RATE:
+                done = segments[:max(len(done), len(segments) - 1)]
+
+        events = [{"type": "final", **seg} for seg in done]
+        if done:
+            self._advance(done[-1]["end"])
+        elif final or overflow:
+            self._advance(buffer_end)
+
+        self.previous = segments[len(done):]
+        if self.previous:
+            events.append({
+                "type": "interim",
+                "start": self.previous[0]["start"],
+                "end": self.previous[-1]["end"],
+                "text": "".join(seg["text"] for seg in self.previous),
+            })
+        return events
+
+    def _advance(self, seconds: float):
+        """丢弃 seconds（会话绝对时间）之前的缓冲"""
+        cut = min(len(self.buffer), max(0, int(round((seconds - self.offset) * SAMPLE_RATE))))
+        self.buffer = self.buffer[cut:]
+        self.offset += cut / SAMPLE_RATE
+
+
+def iter_chunks(
+    blocks,
+    chunk_seconds: float = CHUNK_SECONDS,
+    overlap_seconds: float = OVERLAP_SECONDS,
+    search_seconds: float = SILENCE_SEARCH_SECONDS,
+):
+    """
+    从 PCM 块流中按静音切出转录块，产出 (块信息, 块音频)
+
+    缓冲够 chunk_seconds + search_seconds 就切一次，切点取目标位置前 search_seconds 内平滑能量最低的帧，
+    之后只保留切点前 overlap_seconds 以后的音频，缓冲区大小与总时长无关。
+    块信息以采样点计：start/end 是带重叠的转录范围，core_start/core_end 是该块负责输出的区间，
+    相邻块的核心区间首尾相接。
+    """
+    chunk = int(chunk_seconds * SAMPLE_RATE)
+    search = int(search_seconds * SAMPLE_RATE)
+    overlap = int(overlap_seconds * SAMPLE_RATE)
+
+    pending, pending_samples = [], 0
+    buffer = np.zeros(0, dtype=np.float32)
+    buffer_start = 0        # buffer[0] 在整段音频中的位置
+    core_start = 0
+
+    for block in blocks:
+        pending.append(block)
+        pending_samples += len(block)
+        if buffer_start + len(buffer) + pending_samples - core_start <= chunk + search:
+            continue
+
+        buffer = np.concatenate([buffer, *pending])
+        pending, pending_samples = [], 0
+        while buffer_start + len(buffer) - core_start > chunk + search:
+            lo = core_start + chunk - search - buffer_start
+            cut = buffer_start + lo + _quietest(buffer[lo:lo + search])
+            start = max(0, core_start - overlap)
+            yield (
+                {"start": start, "end": cut + overlap, "core_start": core_start, "core_end": cut},
+                buffer[start - buffer_start:cut + overlap - buffer_start].copy(),
+            )
+            core_start = cut
+            keep = core_start - overlap - buffer_start
+            buffer, buffer_start = buffer[keep:], buffer_start + keep
+
+    buffer = np.concatenate([buffer, *pending])
+    end = buffer_start + len(buffer)
+    if end > core_start:
+        start = max(0, core_start - overlap)
+        yield (
+            {"start": start, "end": end, "core_start": core_start, "core_end": end},
+            buffer[start - buffer_start:],
+        )
+
+
+def _quietest(audio: np.ndarray) -> int:
+    """返回平滑帧能量最低处的采样点偏移"""
+    frame = int(SAMPLE_RATE * FRAME_SECONDS)
+    n_frames = len(audio) // frame
+    frames = audio[: n_frames * frame].reshape(n_frames, frame)
+    energy = np.einsum("ij,ij->i", frames, frames) / frame
+    kernel = np.ones(SILENCE_SMOOTH_FRAMES) / SILENCE_SMOOTH_FRAMES
+    energy = np.convolve(energy, kernel, mode="same")
+    return int(np.argmin(energy)) * frame + frame // 2
+
+
+def stitch_segments(chunks: list[dict], chunk_segments: list[list[dict]]) -> list[dict]:
+    """
+    拼接各块的分段
+
+    分段时间加上块的起点偏移；只保留中点落在块核心区间内的分段，
+    与上一分段时间重叠且文本互相包含的视为重叠区的重复识别，保留较长的一个。
+    """
+    segments = []
+    for i, (chunk, items) in enumerate(zip(chunks, chunk_segments)):
+        offset = chunk["start"] / SAMPLE_RATE
+        core_start = chunk["core_start"] / SAMPLE_RATE
+        core_end = chunk["core_end"] / SAMPLE_RATE if i < len(chunks) - 1 else float("inf")
+
+        for seg in items:
+            start, end = seg["start"] + offset, seg["end"] + offset
+            if not core_start <= (start + end) / 2 < core_end:
+                continue
+
+            if segments and start < segments[-1]["end"]:
+                prev = segments[-1]
+                text, prev_text = _normalize(seg["text"]), _normalize(prev["text"])
+                if text in prev_text:
+                    continue
+                if prev_text in text:
+                    segments.pop()
+                    start = min(start, prev["start"])
+                else:
+                    start = prev["end"]
+            segments.append({"start": round(start, 2), "end": round(max(start, end), 2), "text": seg["text"]})
+
+    return segments
+
+
+def _normalize(text: str) -> str:
+    """比较重复文本时忽略空白和标点"""
+    return re.sub(r"[\W_]+", "", text).lower()
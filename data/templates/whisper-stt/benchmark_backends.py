@@ -0,0 +1,95 @@
+"""
+Whisper 推理后端基准测试（本地 CPU）
+对比 openai-whisper 与 faster-whisper（批量解码，int8 / float32）的实时率
+
+实时率 RTF = 转录耗时 / 音频时长，越小越快；RTF < 1 表示比实时快。
+
+使用方法:
+    pip install openai-whisper faster-whisper
+    python benchmark_backends.py --audio-file=meeting.mp3
+    python benchmark_backends.py --audio-file=clip.wav --min-seconds=600 --batch-size=8
+"""
+import argparse
+import time
+
+import numpy as np
+
+from audio_pipeline import SAMPLE_RATE, BatchedWhisper, load_model, transcribe_array
+
+# (后端, 权重精度)；CPU 上 openai-whisper 只能用 float32
+BACKENDS = [
+    ("openai-whisper", "float32"),
+    ("faster-whisper", "float32"),
+    ("faster-whisper", "int8"),
+]
+
+
+def load_audio(path: str, min_seconds: float) -> np.ndarray:
+    """解码音频；不足 min_seconds 时循环拼接，批量解码在长音频上才能体现差异"""
+    from faster_whisper import decode_audio
+
+    audio = decode_audio(path, sampling_rate=SAMPLE_RATE)
+    repeats = max(1, int(np.ceil(min_seconds * SAMPLE_RATE / len(audio))))
+    return np.tile(audio, repeats)
+
+
+def benchmark(audio: np.ndarray, model_size: str, language: str, batch_size: int) -> list[dict]:
+    duration = len(audio) / SAMPLE_RATE
+    rows = []
+    for backend, compute_type in BACKENDS:
+        print(f"⏳ {backend} ({compute_type})...")
+        start = time.monotonic()
+        model = load_model(model_size, backend=backend, compute_type=compute_type, download_root=None, device="cpu")
+        load_seconds = time.monotonic() - start
+        if isinstance(model, BatchedWhisper):
+            model.batch_size = batch_size
+
+        # 先跑几秒预热，避免首次调用的初始化计入耗时
+        transcribe_array(model, audio[: 5 * SAMPLE_RATE], language)
+
+        start = time.monotonic()
+        result = transcribe_array(model, audio, language)
+        seconds = time.monotonic() - start
+
+        rows.append({
+            "backend": backend,
+            "compute_type": compute_type,
+            "load_seconds": load_seconds,
+            "seconds": seconds,
+            "rtf": seconds / duration,
+            "segments": len(result["segments"]),
+            "text": result["text"].strip(),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Whisper 推理后端 CPU 基准测试")
+    parser.add_argument("--audio-file", required=True, help="测试音频（任意 ffmpeg 支持的格式）")
+    parser.add_argument("--model-size", default="tiny")
+    parser.add_argument("--language", default=None, help="语言代码，默认自动检测")
+    parser.add_argument("--min-seconds", type=float, default=300, help="音频不足该时长时循环拼接")
+    parser.add_argument("--batch-size", type=int, default=8, help="faster-whisper 每批解码的窗口数")
+    args = parser.parse_args()
+
+    audio = load_audio(args.audio_file, args.min_seconds)
+    duration = len(audio) / SAMPLE_RATE
+    print(f"🎧 音频时长 {duration:.1f}s，模型 {args.model_size}，CPU")
+
+    rows = benchmark(audio, args.model_size, args.language, args.batch_size)
+    baseline = rows[0]["seconds"]
+
+    print(f"\n{'后端':<16}{'精度':<10}{'加载(s)':>9}{'转录(s)':>10}{'RTF':>8}{'加速':>8}{'分段':>6}")
+    for row in rows:
+        print(
+            f"{row['backend']:<16}{row['compute_type']:<10}{row['load_seconds']:>9.1f}"
+            f"{row['seconds']:>10.1f}{row['rtf']:>8.3f}{baseline / row['seconds']:>7.1f}x{row['segments']:>6}"
+        )
+
+    print("\n📝 转录开头（核对各后端输出一致）:")
+    for row in rows:
+        print(f"  [{row['backend']} {row['compute_type']}] {row['text'][:80]}")
+
+
+if __name__ == "__main__":
+    main()
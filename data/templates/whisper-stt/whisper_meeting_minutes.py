@@ -26,34 +26,49 @@ image = (
     .pip_install(
         "openai-whisper",
         "torch==2.1.0",
+        # faster-whisper 后端；ctranslate2 4.4 与 torch 2.1 自带的 CUDA 12 / cuDNN 8 兼容
+        "faster-whisper==1.1.1",
+        "ctranslate2==4.4.0",
     )
+    .env({"LD_LIBRARY_PATH": "/usr/local/lib/python3.11/site-packages/nvidia/cublas/lib:"
+                             "/usr/local/lib/python3.11/site-packages/nvidia/cudnn/lib"})
 )
 
 model_volume = modal.Volume.from_name("whisper-models", create_if_missing=True)
 output_volume = modal.Volume.from_name("meeting-minutes", create_if_missing=True)
+# 大文件先上传到该 Volume（modal volume put whisper-uploads meeting.mp3），再按路径转录
+upload_volume = modal.Volume.from_name("whisper-uploads", create_if_missing=True)
+
+# 推理后端：会议录音较长，用 faster-whisper 批量解码提高吞吐；改为 "openai-whisper" 用原版实现
+WHISPER_BACKEND = "faster-whisper"
+COMPUTE_TYPE = "float16"  # faster-whisper 权重精度：float16 / int8_float16（显存减半）
 
 
 @app.cls(
     image=image,
     gpu="T4",
-    volumes={"/models": model_volume, "/output": output_volume},
+    volumes={"/models": model_volume, "/output": output_volume, "/uploads": upload_volume},
     timeout=1800,  # 会议录音可能较长
+    mounts=[modal.Mount.from_local_python_packages("audio_pipeline")],
 )
 class MeetingTranscriber:
     @modal.enter()
     def load_model(self):
-        import whisper
+        from audio_pipeline import load_model
         
-        print("🎤 加载 Whisper 模型...")
-        self.model = whisper.load_model("medium", download_root="/models")
+        print(f"🎤 加载 Whisper 模型（{WHISPER_BACKEND}）...")
+        self.model = load_model(
+            "medium", backend=WHISPER_BACKEND, compute_type=COMPUTE_TYPE, download_root="/models"
+        )
         print("✓ 模型加载完成")
     
     @modal.method()
     def transcribe_meeting(
         self,
-        audio_data: bytes,
+        audio_data: bytes = None,
         language: str = "zh",
-        meeting_info: dict = None
+        meeting_info: dict = None,
+        audio_path: str = None
     ) -> dict:
         """
         转录会议录音
@@ -62,48 +77,46 @@ class MeetingTranscriber:
             audio_data: 音频数据
             language: 语言代码
             meeting_info: 会议信息 {"title": "...", "date": "...", "participants": [...]}
+            audio_path: whisper-uploads Volume 中的文件路径，给出时代替 audio_data，适合长录音
         """
-        import tempfile
-        import os
+        from audio_pipeline import audio_source, stream_pcm, transcribe_stream
         
         if meeting_info is None:
             meeting_info = {}
         
-        # 保存临时文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as f:
-            f.write(audio_data)
-            temp_path = f.name
+        source = audio_source(audio_data, audio_path, upload_volume)
         
-        try:
-            print("🎤 开始转录会议录音...")
-            
-            result = self.model.transcribe(
-                temp_path,
-                language=language,
-                task="transcribe",
-                fp16=True
-            )
-            
-            print("✓ 转录完成")
-            
-            # 构建转录结果
-            transcript = {
-                "full_text": result["text"],
-                "segments": [
-                    {
-                        "start": seg["start"],
-                        "end": seg["end"],
-                        "text": seg["text"].strip()
-                    }
-                    for seg in result.get("segments", [])
-                ],
-                "duration_minutes": result.get("segments", [{}])[-1].get("end", 0) / 60 if result.get("segments") else 0
-            }
-            
-            return transcript
-            
-        finally:
-            os.unlink(temp_path)
+        print("🎤 开始转录会议录音...")
+        
+        # 边解码边转录；长会议按静音切块，分发到多个容器并行转录
+        result = transcribe_stream(
+            self.model, stream_pcm(source), MeetingTranscriber().transcribe_chunk, language
+        )
+        
+        print("✓ 转录完成")
+        
+        # 构建转录结果
+        transcript = {
+            "full_text": result["text"],
+            "segments": [
+                {
+                    "start": seg["start"],
+                    "end": seg["end"],
+                    "text": seg["text"].strip()
+                }
+                for seg in result["segments"]
+            ],
+            "duration_minutes": result["segments"][-1]["end"] / 60 if result["segments"] else 0
+        }
+        
+        return transcript
+    
+    @modal.method()
+    def transcribe_chunk(self, audio, language: str = None, task: str = "transcribe") -> dict:
+        """转录会议录音中的一块（16 kHz PCM），时间戳相对块起点"""
+        from audio_pipeline import transcribe_array
+        
+        return transcribe_array(self.model, audio, language, task)
     
     @modal.method()
     def extract_key_points(self, transcript_text: str) -> dict:
@@ -156,9 +169,10 @@ class MeetingTranscriber:
     timeout=3600
 )
 def generate_meeting_minutes(
-    audio_data: bytes,
+    audio_data: bytes = None,
     meeting_info: dict = None,
-    language: str = "zh"
+    language: str = "zh",
+    audio_path: str = None
 ) -> dict:
     """
     生成完整的会议纪要
@@ -167,9 +181,8 @@ def generate_meeting_minutes(
         audio_data: 会议录音
         meeting_info: 会议信息
         language: 语言
+        audio_path: whisper-uploads Volume 中的录音路径，给出时代替 audio_data
     """
-    import os
-    
     if meeting_info is None:
         meeting_info = {
             "title": "会议",
@@ -186,7 +199,7 @@ def generate_meeting_minutes(
     # 1. 转录音频
     print("\n1️⃣ 转录会议录音...")
     transcript = transcriber.transcribe_meeting.remote(
-        audio_data, language, meeting_info
+        audio_data, language, meeting_info, audio_path=audio_path
     )
     
     # 2. 提取关键点
@@ -277,6 +290,9 @@ def main():
     print("curl -X POST -H 'Content-Type: audio/wav' \\")
     print("     --data-binary @meeting.wav \\")
     print("     'https://your-app--meeting-minutes-api.modal.run?title=周会'")
+    print("\n长录音可先上传到 Volume，再按路径生成:")
+    print("modal volume put whisper-uploads meeting.mp3")
+    print("generate_meeting_minutes.remote(audio_path='meeting.mp3')")
     print("\n💡 提示:")
     print("1. 支持 mp3, wav, m4a 等格式")
     print("2. 会议纪要保存在 meeting-minutes Volume")
@@ -13,30 +13,47 @@ image = (
     .pip_install(
         "openai-whisper",
         "torch==2.1.0",
+        # faster-whisper 后端；ctranslate2 4.4 与 torch 2.1 自带的 CUDA 12 / cuDNN 8 兼容
+        "faster-whisper==1.1.1",
+        "ctranslate2==4.4.0",
+        "fastapi[standard]==0.115.4",
     )
+    .env({"LD_LIBRARY_PATH": "/usr/local/lib/python3.11/site-packages/nvidia/cublas/lib:"
+                             "/usr/local/lib/python3.11/site-packages/nvidia/cudnn/lib"})
 )
 
 # 模型缓存
 model_volume = modal.Volume.from_name("whisper-models", create_if_missing=True)
+# 大文件先上传到该 Volume（modal volume put whisper-uploads meeting.mp3），再按路径转录
+upload_volume = modal.Volume.from_name("whisper-uploads", create_if_missing=True)
+
+# 推理后端：实时转录看重单条延迟，用 openai-whisper；改为 "faster-whisper" 走批量解码
+WHISPER_BACKEND = "openai-whisper"
+COMPUTE_TYPE = "float16"  # faster-whisper 权重精度：float16 / int8_float16（显存减半）
+
+UPLOAD_QUEUE_BLOCKS = 64  # 流式上传时排队等待解码的请求体分块数，超过后暂停读取请求体
 
 
 @app.cls(
     image=image,
     gpu="T4",  # Whisper 不需要太大的 GPU
-    volumes={"/models": model_volume},
-    timeout=600,
+    volumes={"/models": model_volume, "/uploads": upload_volume},
+    timeout=3600,  # 长音频由本容器切块、分发并等待拼接；实时会话最长 1 小时
+    mounts=[modal.Mount.from_local_python_packages("audio_pipeline")],
 )
 class WhisperSTT:
     @modal.enter()
     def load_model(self):
         """加载 Whisper 模型"""
-        import whisper
+        from audio_pipeline import load_model
         
-        print("🎤 加载 Whisper 模型...")
+        print(f"🎤 加载 Whisper 模型（{WHISPER_BACKEND}）...")
         
         # 可选: tiny, base, small, medium, large
-        self.model = whisper.load_model(
+        self.model = load_model(
             "medium",
+            backend=WHISPER_BACKEND,
+            compute_type=COMPUTE_TYPE,
             download_root="/models"
         )
         
@@ -45,9 +62,10 @@ class WhisperSTT:
     @modal.method()
     def transcribe(
         self,
-        audio_data: bytes,
+        audio_data: bytes = None,
         language: str = None,
-        task: str = "transcribe"
+        task: str = "transcribe",
+        audio_path: str = None
     ) -> dict:
         """
         语音转文字
@@ -56,44 +74,135 @@ class WhisperSTT:
             audio_data: 音频文件字节数据
             language: 语言代码 (zh, en, ja 等)，None 为自动检测
             task: "transcribe" 或 "translate" (翻译成英文)
+            audio_path: whisper-uploads Volume 中的文件路径，给出时代替 audio_data，适合大文件
         
         Returns:
             转录结果
+        
+        音频经 ffmpeg 管道边解码边转录；长音频按静音切块，分发到多个容器并行转录后拼接
         """
-        import tempfile
-        import os
+        from audio_pipeline import audio_source
+        
+        return self._transcribe_source(audio_source(audio_data, audio_path, upload_volume), language, task)
+    
+    @modal.method()
+    def transcribe_chunk(self, audio, language: str = None, task: str = "transcribe") -> dict:
+        """转录长音频中的一块（16 kHz PCM），时间戳相对块起点"""
+        from audio_pipeline import transcribe_array
         
-        # 保存临时文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as f:
-            f.write(audio_data)
-            temp_path = f.name
+        return transcribe_array(self.model, audio, language, task)
+    
+    @modal.asgi_app()
+    def web(self):
+        """
+        流式上传与实时转录端点
         
+        POST /transcribe?language=zh&task=transcribe
+        请求体可以分块上传（Transfer-Encoding: chunked），边接收、边解码、边转录，不在内存中保留整个文件
+        
+        WebSocket /ws?language=zh
+        客户端持续发送 16 kHz 单声道 s16le PCM 二进制帧（建议每帧 100~500 ms），发送文本 "end" 结束；
+        服务端推送 JSON {"type": "interim" | "final", "start", "end", "text"}，时间为相对会话开始的秒数。
+        interim 会被后续结果修正，final 不再变化。每个容器同一时间只服务一个会话，模型在容器内跨会话复用
+        """
+        from fastapi import FastAPI, Request, WebSocket
+        
+        web_app = FastAPI()
+        
+        @web_app.post("/transcribe")
+        async def transcribe_upload(request: Request, language: str = None, task: str = "transcribe"):
+            return await self._transcribe_request(request, language, task)
+        
+        @web_app.websocket("/ws")
+        async def transcribe_realtime(websocket: WebSocket, language: str = None, task: str = "transcribe"):
+            await websocket.accept()
+            await self._realtime_session(websocket, language, task)
+        
+        return web_app
+    
+    async def _transcribe_request(self, request, language: str, task: str) -> dict:
+        """把请求体分块经有界队列送入 ffmpeg 管道，转录在线程池中同时进行"""
+        import asyncio
+        import queue
+        
+        body = queue.Queue(maxsize=UPLOAD_QUEUE_BLOCKS)
+        loop = asyncio.get_running_loop()
+        result = loop.run_in_executor(
+            None, self._transcribe_source, iter(body.get, None), language, task
+        )
+        
+        async def put(item) -> bool:
+            # 队列满时让出事件循环等待解码消费；转录提前结束（出错）时停止投递
+            while not result.done():
+                try:
+                    body.put_nowait(item)
+                    return True
+                except queue.Full:
+                    await asyncio.sleep(0.01)
+            return False
+        
+        async for data in request.stream():
+            if data and not await put(data):
+                break
+        await put(None)
+        return await result
+    
+    async def _realtime_session(self, websocket, language: str, task: str):
+        """收帧在事件循环中进行，转录在线程池中一轮接一轮进行，每轮包含上一轮以来收到的全部音频"""
+        import asyncio
+        from fastapi import WebSocketDisconnect
+        from audio_pipeline import SAMPLE_RATE, RealtimeSession
+        
+        session = RealtimeSession(self.model, language, task)
+        loop = asyncio.get_running_loop()
+        ended = asyncio.Event()
+        disconnected = False
+        
+        async def receive():
+            nonlocal disconnected
+            try:
+                while True:
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        disconnected = True
+                        break
+                    if message.get("text") == "end":
+                        break
+                    if message.get("bytes"):
+                        session.feed(message["bytes"])
+            finally:
+                ended.set()
+        
+        print("🎙️ 实时转录会话开始")
+        receiver = asyncio.create_task(receive())
         try:
-            print(f"🎤 转录音频...")
-            
-            result = self.model.transcribe(
-                temp_path,
-                language=language,
-                task=task,
-                fp16=True
-            )
+            while not ended.is_set():
+                if not session.ready():
+                    await asyncio.sleep(0.05)
+                    continue
+                for event in await loop.run_in_executor(None, session.step):
+                    await websocket.send_json(event)
             
-            print(f"✓ 转录完成")
-            
-            return {
-                "text": result["text"],
-                "language": result.get("language"),
-                "segments": [
-                    {
-                        "start": seg["start"],
-                        "end": seg["end"],
-                        "text": seg["text"]
-                    }
-                    for seg in result.get("segments", [])
-                ]
-            }
+            if not disconnected:
+                for event in await loop.run_in_executor(None, session.step, True):
+                    await websocket.send_json(event)
+                await websocket.close()
+        except (WebSocketDisconnect, RuntimeError):
+            # 客户端在推送结果时断开
+            pass
         finally:
-            os.unlink(temp_path)
+            receiver.cancel()
+        print(f"✓ 实时转录会话结束（{session.received / SAMPLE_RATE:.0f} 秒音频）")
+    
+    def _transcribe_source(self, source, language: str, task: str) -> dict:
+        from audio_pipeline import stream_pcm, transcribe_stream
+        
+        print(f"🎤 转录音频...")
+        result = transcribe_stream(
+            self.model, stream_pcm(source), WhisperSTT().transcribe_chunk, language, task
+        )
+        print(f"✓ 转录完成")
+        return result
 
 
 @app.function(image=image)
@@ -107,6 +216,8 @@ def transcribe_audio(audio: bytes, language: str = None):
     
     Query params:
     - language: 语言代码 (可选)
+    
+    大文件请用 WhisperSTT.web 的 /transcribe 流式上传，或先上传到 whisper-uploads Volume 后按 audio_path 转录
     """
     whisper = WhisperSTT()
     result = whisper.transcribe.remote(audio, language=language)
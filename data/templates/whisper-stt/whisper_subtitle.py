@@ -25,11 +25,24 @@ image = (
     .pip_install(
         "openai-whisper",
         "torch==2.1.0",
+        # faster-whisper 后端；ctranslate2 4.4 与 torch 2.1 自带的 CUDA 12 / cuDNN 8 兼容
+        "faster-whisper==1.1.1",
+        "ctranslate2==4.4.0",
     )
+    .env({"LD_LIBRARY_PATH": "/usr/local/lib/python3.11/site-packages/nvidia/cublas/lib:"
+                             "/usr/local/lib/python3.11/site-packages/nvidia/cudnn/lib"})
 )
 
 model_volume = modal.Volume.from_name("whisper-models", create_if_missing=True)
 output_volume = modal.Volume.from_name("video-subtitles", create_if_missing=True)
+# 大文件先上传到该 Volume（modal volume put whisper-uploads video.mp4），再按路径生成字幕
+upload_volume = modal.Volume.from_name("whisper-uploads", create_if_missing=True)
+
+# 推理后端：批量生成字幕看重吞吐，用 faster-whisper 批量解码；改为 "openai-whisper" 用原版实现
+WHISPER_BACKEND = "faster-whisper"
+COMPUTE_TYPE = "float16"  # faster-whisper 权重精度：float16 / int8_float16（显存减半）
+
+MAX_PARALLEL_VIDEOS = 10  # 批量生成时同时处理的视频数（批量任务专用容器数上限，不影响交互式请求）
 
 
 def format_timestamp(seconds: float) -> str:
@@ -78,26 +91,30 @@ def generate_vtt(segments: list[dict]) -> str:
 @app.cls(
     image=image,
     gpu="T4",
-    volumes={"/models": model_volume, "/output": output_volume},
+    volumes={"/models": model_volume, "/output": output_volume, "/uploads": upload_volume},
     timeout=1800,
+    mounts=[modal.Mount.from_local_python_packages("audio_pipeline")],
 )
 class SubtitleGenerator:
     @modal.enter()
     def load_model(self):
-        import whisper
+        from audio_pipeline import load_model
         
-        print("🎤 加载 Whisper 模型...")
+        print(f"🎤 加载 Whisper 模型（{WHISPER_BACKEND}）...")
         # large 模型精度更高，适合字幕生成
-        self.model = whisper.load_model("medium", download_root="/models")
+        self.model = load_model(
+            "medium", backend=WHISPER_BACKEND, compute_type=COMPUTE_TYPE, download_root="/models"
+        )
         print("✓ 模型加载完成")
     
     @modal.method()
     def generate_subtitle(
         self,
-        audio_data: bytes,
+        audio_data: bytes = None,
         language: str = None,
         task: str = "transcribe",
-        output_format: str = "srt"
+        output_format: str = "srt",
+        audio_path: str = None
     ) -> dict:
         """
         生成视频字幕
@@ -107,122 +124,128 @@ class SubtitleGenerator:
             language: 源语言（None 自动检测）
             task: "transcribe"(转录) 或 "translate"(翻译成英文)
             output_format: "srt" 或 "vtt"
+            audio_path: whisper-uploads Volume 中的文件路径（音频或视频），给出时代替 audio_data
         
         Returns:
             字幕内容和元数据
         """
-        import tempfile
-        import os
+        from audio_pipeline import audio_source
+        
+        return self._generate(audio_source(audio_data, audio_path, upload_volume), language, task, output_format)
+    
+    @modal.method()
+    def generate_subtitle_file(
+        self,
+        name: str,
+        audio_path: str,
+        output_path: str,
+        language: str = None,
+        output_format: str = "srt",
+        audio_data: bytes = None
+    ) -> dict:
+        """
+        生成一个字幕文件并直接写入输出 Volume，供批量任务分发
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as f:
-            f.write(audio_data)
-            temp_path = f.name
+        出错时不抛异常，返回 {"name", "error"}，批量任务据此记录失败项
+        """
+        import os
+        import time
+        from audio_pipeline import audio_source
         
+        start = time.monotonic()
         try:
-            print(f"🎬 生成字幕 (语言: {language or '自动检测'}, 任务: {task})")
-            
-            result = self.model.transcribe(
-                temp_path,
-                language=language,
-                task=task,
-                fp16=True,
-                verbose=False
-            )
-            
-            segments = [
-                {
-                    "start": seg["start"],
-                    "end": seg["end"],
-                    "text": seg["text"]
-                }
-                for seg in result.get("segments", [])
-            ]
-            
-            # 生成字幕文件
-            if output_format == "vtt":
-                subtitle_content = generate_vtt(segments)
-            else:
-                subtitle_content = generate_srt(segments)
+            result = self._generate(audio_source(audio_data, audio_path, upload_volume), language, "transcribe", output_format)
             
-            duration = segments[-1]["end"] if segments else 0
-            
-            print(f"✓ 字幕生成完成: {len(segments)} 条, {duration/60:.1f} 分钟")
-            
-            return {
-                "subtitle": subtitle_content,
-                "format": output_format,
-                "language": result.get("language"),
-                "segments_count": len(segments),
-                "duration_seconds": duration,
-                "segments": segments  # 原始分段数据
-            }
-            
-        finally:
-            os.unlink(temp_path)
+            # 先写临时文件再改名，中途失败不会留下半个字幕文件
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(f"{output_path}.tmp", "w", encoding="utf-8") as f:
+                f.write(result["subtitle"])
+            os.replace(f"{output_path}.tmp", output_path)
+            output_volume.commit()
+        except Exception as e:
+            print(f"✗ {name} 失败: {e}")
+            return {"name": name, "error": str(e)}
+        
+        return {
+            "name": name,
+            "subtitle_file": os.path.basename(output_path),
+            "segments": result["segments_count"],
+            "duration": result["duration_seconds"],
+            "seconds": round(time.monotonic() - start, 1)
+        }
     
     @modal.method()
     def generate_bilingual_subtitle(
         self,
-        audio_data: bytes,
+        audio_data: bytes = None,
         source_language: str = "zh",
-        output_format: str = "srt"
+        output_format: str = "srt",
+        audio_path: str = None
     ) -> dict:
         """
         生成双语字幕（原文 + 英文翻译）
         """
-        import tempfile
-        import os
+        from audio_pipeline import audio_source, stream_pcm, transcribe_stream
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as f:
-            f.write(audio_data)
-            temp_path = f.name
+        source = audio_source(audio_data, audio_path, upload_volume)
         
-        try:
-            # 转录原文
-            print("🎬 转录原文...")
-            original = self.model.transcribe(
-                temp_path,
-                language=source_language,
-                task="transcribe",
-                fp16=True
-            )
-            
-            # 翻译成英文
-            print("🌐 翻译成英文...")
-            translated = self.model.transcribe(
-                temp_path,
-                language=source_language,
-                task="translate",
-                fp16=True
-            )
-            
-            # 合并双语字幕
-            bilingual_segments = []
-            for orig_seg, trans_seg in zip(
-                original.get("segments", []),
-                translated.get("segments", [])
-            ):
-                bilingual_segments.append({
-                    "start": orig_seg["start"],
-                    "end": orig_seg["end"],
-                    "text": f"{orig_seg['text'].strip()}\n{trans_seg['text'].strip()}"
-                })
-            
-            if output_format == "vtt":
-                subtitle_content = generate_vtt(bilingual_segments)
-            else:
-                subtitle_content = generate_srt(bilingual_segments)
-            
-            return {
-                "subtitle": subtitle_content,
-                "format": output_format,
-                "type": "bilingual",
-                "source_language": source_language,
-                "segments_count": len(bilingual_segments)
-            }
-            
-        finally:
-            os.unlink(temp_path)
+        # 转录原文（两遍各自重新解码，不在内存中保留整段 PCM）
+        print("🎬 转录原文...")
+        original = transcribe_stream(self.model, stream_pcm(source), None, source_language, "transcribe")
+        
+        # 翻译成英文
+        print("🌐 翻译成英文...")
+        translated = transcribe_stream(self.model, stream_pcm(source), None, source_language, "translate")
+        
+        # 合并双语字幕
+        bilingual_segments = []
+        for orig_seg, trans_seg in zip(original["segments"], translated["segments"]):
+            bilingual_segments.append({
+                "start": orig_seg["start"],
+                "end": orig_seg["end"],
+                "text": f"{orig_seg['text'].strip()}\n{trans_seg['text'].strip()}"
+            })
+        
+        if output_format == "vtt":
+            subtitle_content = generate_vtt(bilingual_segments)
+        else:
+            subtitle_content = generate_srt(bilingual_segments)
+        
+        return {
+            "subtitle": subtitle_content,
+            "format": output_format,
+            "type": "bilingual",
+            "source_language": source_language,
+            "segments_count": len(bilingual_segments)
+        }
+    
+    def _generate(self, source, language: str, task: str, output_format: str) -> dict:
+        from audio_pipeline import stream_pcm, transcribe_stream
+        
+        print(f"🎬 生成字幕 (语言: {language or '自动检测'}, 任务: {task})")
+        
+        # 本容器边解码边逐块转录
+        result = transcribe_stream(self.model, stream_pcm(source), None, language, task)
+        segments = result["segments"]
+        
+        # 生成字幕文件
+        if output_format == "vtt":
+            subtitle_content = generate_vtt(segments)
+        else:
+            subtitle_content = generate_srt(segments)
+        
+        duration = segments[-1]["end"] if segments else 0
+        
+        print(f"✓ 字幕生成完成: {len(segments)} 条, {duration/60:.1f} 分钟")
+        
+        return {
+            "subtitle": subtitle_content,
+            "format": output_format,
+            "language": result["language"],
+            "segments_count": len(segments),
+            "duration_seconds": duration,
+            "segments": segments  # 原始分段数据
+        }
 
 
 @app.function(
@@ -233,68 +256,110 @@ class SubtitleGenerator:
 def batch_generate_subtitles(
     videos: list[dict],
     language: str = None,
-    output_format: str = "srt"
+    output_format: str = "srt",
+    batch_id: str = None
 ) -> dict:
     """
     批量生成字幕
     
     Args:
-        videos: 视频列表 [{"name": "video1", "audio_data": bytes}]
+        videos: 视频列表 [{"name": "video1", "audio_path": "videos/video1.mp4"}]，
+            audio_path 为 whisper-uploads Volume 中的路径（兼容旧的 "audio_data": bytes）
         language: 语言
         output_format: 输出格式
+        batch_id: 批次 ID，默认由视频列表和参数生成；同一批次重跑时跳过已完成的视频
+    
+    各视频分发到多个容器并行生成（同时最多 MAX_PARALLEL_VIDEOS 个），字幕文件在生成容器中
+    写入 /output/<batch_id>/，进度逐条写入 progress.json 作为检查点
     """
+    import hashlib
+    import json
     import os
     
-    generator = SubtitleGenerator()
+    ext = "vtt" if output_format == "vtt" else "srt"
+    if batch_id is None:
+        spec = json.dumps([[v["name"], v.get("audio_path")] for v in videos] + [language, ext])
+        batch_id = f"batch_{hashlib.sha1(spec.encode()).hexdigest()[:12]}"
+    output_dir = f"/output/{batch_id}"
+    progress_path = f"{output_dir}/progress.json"
     
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_dir = f"/output/batch_{timestamp}"
+    output_volume.reload()
     os.makedirs(output_dir, exist_ok=True)
     
-    results = {
-        "total": len(videos),
-        "success": 0,
-        "failed": 0,
-        "files": []
+    # 读取检查点：已完成且字幕文件存在的视频跳过
+    progress = {}
+    if os.path.exists(progress_path):
+        with open(progress_path, encoding="utf-8") as f:
+            progress = json.load(f)["items"]
+    done = {
+        name for name, item in progress.items()
+        if "subtitle_file" in item and os.path.exists(f"{output_dir}/{item['subtitle_file']}")
     }
+    todo = [video for video in videos if video["name"] not in done]
+    
+    print(f"🎬 批量生成字幕: {len(videos)} 个视频（批次 {batch_id}）")
+    if done:
+        print(f"   ⏭️ 跳过已完成的 {len(done)} 个")
     
-    print(f"🎬 批量生成字幕: {len(videos)} 个视频")
+    def save_progress():
+        with open(f"{progress_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"batch_id": batch_id, "total": len(videos), "items": progress}, f, ensure_ascii=False, indent=2)
+        os.replace(f"{progress_path}.tmp", progress_path)
+        output_volume.commit()
     
-    for i, video in enumerate(videos, 1):
-        print(f"\n[{i}/{len(videos)}] 处理: {video['name']}")
+    # 输入只含路径；按完成顺序返回，每完成一个就记录进度
+    inputs = [
+        (
+            video["name"],
+            video.get("audio_path"),
+            f"{output_dir}/{video['name']}.{ext}",
+            language,
+            output_format,
+            video.get("audio_data"),
+        )
+        for video in todo
+    ]
+    
+    # 批量任务使用单独限额的变体，独立扩缩容，不占用 subtitle_api 等交互式请求的容器
+    generator = SubtitleGenerator.with_options(max_containers=MAX_PARALLEL_VIDEOS)()
+    finished = 0
+    for result in generator.generate_subtitle_file.starmap(
+        inputs, order_outputs=False, return_exceptions=True
+    ):
+        finished += 1
         
-        try:
-            result = generator.generate_subtitle.remote(
-                audio_data=video["audio_data"],
-                language=language,
-                output_format=output_format
-            )
-            
-            # 保存字幕文件
-            ext = "vtt" if output_format == "vtt" else "srt"
-            filename = f"{video['name']}.{ext}"
-            filepath = f"{output_dir}/{filename}"
-            
-            with open(filepath, "w", encoding="utf-8") as f:
-                f.write(result["subtitle"])
-            
-            results["files"].append({
-                "video": video["name"],
-                "subtitle_file": filename,
-                "segments": result["segments_count"],
-                "duration": result["duration_seconds"]
-            })
-            results["success"] += 1
-            
-            print(f"  ✓ 完成: {result['segments_count']} 条字幕")
-            
-        except Exception as e:
-            results["failed"] += 1
-            print(f"  ✗ 失败: {str(e)}")
+        if isinstance(result, Exception):
+            # 容器级失败（超时等）无法对应到视频，未记为完成，重跑时会重新处理
+            print(f"[{finished}/{len(todo)}] ✗ 失败: {result}")
+            continue
+        
+        progress[result["name"]] = result
+        save_progress()
+        if "error" in result:
+            print(f"[{finished}/{len(todo)}] ✗ {result['name']}: {result['error']}")
+        else:
+            print(f"[{finished}/{len(todo)}] ✓ {result['name']}: {result['segments']} 条字幕, {result['seconds']}s")
     
-    output_volume.commit()
+    files = [progress[video["name"]] for video in videos if "subtitle_file" in progress.get(video["name"], {})]
+    results = {
+        "batch_id": batch_id,
+        "output_dir": output_dir,
+        "total": len(videos),
+        "success": len(files),
+        "failed": len(videos) - len(files),
+        "skipped": len(done),
+        "files": [
+            {
+                "video": item["name"],
+                "subtitle_file": item["subtitle_file"],
+                "segments": item["segments"],
+                "duration": item["duration"]
+            }
+            for item in files
+        ]
+    }
     
-    print(f"\n✅ 批量处理完成: {results['success']} 成功, {results['failed']} 失败")
+    print(f"\n✅ 批量处理完成: {results['success']} 成功（含之前已完成的 {len(done)} 个）, {results['failed']} 失败")
     return results
 
 
@@ -354,6 +419,9 @@ def main():
     print("   ...?language=zh&bilingual=true")
     print("\n💡 提示:")
     print("1. 支持 SRT 和 WebVTT 两种格式")
-    print("2. 可先用 ffmpeg 从视频提取音频")
+    print("2. 可直接传视频文件；大文件先 modal volume put whisper-uploads 再按 audio_path 生成")
     print("3. 双语字幕适合学习类/国际化视频")
+    print("4. 批量生成: 视频先 modal volume put whisper-uploads，再调用")
+    print("   batch_generate_subtitles.remote([{'name': 'v1', 'audio_path': 'v1.mp4'}, ...])")
+    print("   中断后用同样的参数重跑，会跳过已完成的视频")
 